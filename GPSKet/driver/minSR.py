@@ -11,6 +11,7 @@ from netket.stats import Stats
 from netket.utils import mpi
 
 from GPSKet.vqs import MCStateUniqueSamples
+from GPSKet.vqs.mc.mc_state.local_energy_cache import get_local_energies
 
 from netket.optimizer.qgt.qgt_jacobian_common import choose_jacobian_mode
 
@@ -45,8 +46,8 @@ class minSRVMC(VMC):
         samples = samples.reshape((-1, samples.shape[-1]))
         counts = counts.reshape((-1,))
 
-        # Transpose as local_estimators function flips the axes
-        loc_ens = self.state.local_estimators(self._ham).T.reshape(-1)
+        # Local energies are cached on the state so that these can be reused for the same samples and parameters
+        loc_ens = get_local_energies(self.state, self._ham).reshape(-1)
 
         O = nk.jax.jacobian(self.state._apply_fun, self.state.parameters, samples,
                             self.state.model_state, mode = self.mode, pdf = counts, dense=True, center=True)
@@ -18,4 +18,5 @@ from .slater_jastrow import SlaterJastrow
 
 from .backflow import Backflow
 
-from .backflow_jastrow import BackflowJastrow
\ No newline at end of file
+from .backflow_jastrow import BackflowJastrow
+from .fast_update import apply_batched_fast_updates
@@ -147,7 +147,7 @@ class ARqGPSFull(AbstractARqGPS):
             if isinstance(self._epsilon, tuple):
                 old_contexts = [cont_prod.value for cont_prod in self._saved_context_product]
             else:
-                old_contexts = self._saved_context_product.value
+                old_contexts = jnp.swapaxes(self._saved_context_product.value, 0, 1) # (L, B, M, T)
 
             log_psi, context_products = jax.vmap(_conditionals, in_axes=(None, -1, -1, -1), out_axes=(-1, -1))(self, full_samples_sym, update_args, old_contexts) # (B, L, D, T), (L, B, M, T)
         else:
@@ -170,7 +170,8 @@ class ARqGPSFull(AbstractARqGPS):
                 for i in range(len(context_products)):
                     self._saved_context_product[i].value = context_products[i]
             else:
-                self._saved_context_product.value = context_products
+                # Stored with a leading batch axis (as all other cached intermediates)
+                self._saved_context_product.value = jnp.swapaxes(context_products, 0, 1) # (B, L, M, T)
             self._saved_configs.value = full_samples
 
         return log_psi_symm # (B,)
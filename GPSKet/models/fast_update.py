@@ -0,0 +1,34 @@
+import jax
+import jax.numpy as jnp
+
+"""
+Batched evaluation of connected configurations with the fast updating of the models (qGPS, PlaquetteqGPS, Slater,
+ARqGPSFull, ...). The intermediates cache of a single base configuration (as obtained by applying the model with
+cache_intermediates=True to a batch containing only this configuration) is shared between K connected configurations, each
+of which is specified by the updated sites and the new occupancies on these sites.
+All K log-amplitudes are then obtained from a single application of the model with a batch of K updates, i.e. this is a
+wrapper which broadcasts the cache of the base configuration over the updates and relies on the batched fast updating
+already implemented by each model (instead of e.g. a vmap over single updates). No model-specific batched update is
+implemented here, the (memory) cost is that of the model applied to K configurations with broadcast caches.
+The excitation_chunk_size specifies how many updates are evaluated simultaneously, the updates are padded (with copies of the
+first update) to a multiple of the chunk size.
+"""
+def apply_batched_fast_updates(logpsi, parameters, updated_occupancies, update_sites, excitation_chunk_size=None):
+    n_updates = update_sites.shape[0]
+    assert(updated_occupancies.shape == update_sites.shape)
+
+    def apply_updates(occupancies, sites):
+        batch_size = sites.shape[0]
+        cache = jax.tree_map(lambda x: jnp.broadcast_to(x, (batch_size,) + x.shape[1:]), parameters["intermediates_cache"])
+        return logpsi({**parameters, "intermediates_cache": cache}, occupancies, update_sites=sites).reshape(-1)
+
+    if excitation_chunk_size is None or excitation_chunk_size >= n_updates:
+        return apply_updates(updated_occupancies, update_sites)
+
+    n_chunks = -(-n_updates // excitation_chunk_size)
+    n_padding = n_chunks * excitation_chunk_size - n_updates
+    def pad_and_split(x):
+        x = jnp.concatenate((x, jnp.repeat(x[:1], n_padding, axis=0)))
+        return x.reshape((n_chunks, excitation_chunk_size) + x.shape[1:])
+    log_amps = jax.lax.map(lambda chunk: apply_updates(*chunk), (pad_and_split(updated_occupancies), pad_and_split(update_sites)))
+    return log_amps.reshape(-1)[:n_updates]
@@ -8,7 +8,7 @@ from typing import Tuple, Union, Optional
 from netket.hilbert.homogeneous import HomogeneousHilbert
 from GPSKet.nn.initializers import normal
 
-from GPSKet.models.qGPS import no_syms
+from GPSKet.models.qGPS import no_syms, map_over_symmetry_chunks
 
 
 import warnings
@@ -37,6 +37,18 @@ class PlaquetteqGPS(nn.Module):
     syms: Union[Callable, Tuple[Callable, Callable]] = no_syms()
     out_transformation: Callable = lambda argument : jnp.sum(argument, axis=(-3,-2,-1))
     apply_fast_update: bool = False # Careful with zero-valued parameters here, TODO: implement fallback...
+    """
+    If ratio_tables is set, a table of the ratios of the updated and the current plaquette factors for each site, each local
+    occupancy, each plaquette, each support dimension and each symmetry (with shape (B, L, D, P, M, T)) is set up when the
+    intermediates are cached, so that the update of the site products only requires one table lookup per updated site
+    (see also qGPS).
+    """
+    ratio_tables: bool = False
+    """
+    If symmetry_chunk_size is set, the site products are evaluated sequentially for chunks of symmetry operations
+    to bound the memory requirements for large symmetry groups (see also qGPS).
+    """
+    symmetry_chunk_size: Optional[int] = None
 
     def setup(self):
         if type(self.syms) == tuple:
@@ -82,6 +94,22 @@ class PlaquetteqGPS(nn.Module):
         if cache_intermediates or (update_sites is not None):
             site_product_save = self.variable("intermediates_cache", "site_prod", lambda : jnp.zeros(0, dtype=self.dtype))
             indices_save = self.variable("intermediates_cache", "samples", lambda : jnp.zeros(0, dtype=indices.dtype))
+            if self.ratio_tables:
+                site_ratios_save = self.variable("intermediates_cache", "site_ratios", lambda : jnp.zeros(0, dtype=self.dtype))
+
+        """ Returns the ratios of the plaquette factors for the given sites (with current occupancies occs) and all possible
+        new occupancies, the returned array has shape (#sites, D, P, M, T). """
+        def get_site_ratios(occs, sites):
+            inv_sym_old, inv_sym_sites = self.symmetries_inverse(occs, sites) # (#sites, T)
+            transformed_sites = jnp.asarray(inv_plaquette_ids)[:, inv_sym_sites] # (P, #sites, T)
+            valid_elements = jnp.expand_dims(transformed_sites != -1, -1)
+            plaquette_ids = np.arange(plaquettes.shape[0]).reshape((-1, 1, 1))
+            def ratios_for_occupancy(occ):
+                inv_sym_new, _ = self.symmetries_inverse(jnp.full_like(occs, occ), sites)
+                ratios = jnp.where(valid_elements, epsilon[inv_sym_new, plaquette_ids, :, transformed_sites], 1.)
+                return ratios / jnp.where(valid_elements, epsilon[inv_sym_old, plaquette_ids, :, transformed_sites], 1.) # (P, #sites, T, M)
+            ratios = jax.vmap(ratios_for_occupancy)(jnp.arange(self.local_dim, dtype=occs.dtype)) # (D, P, #sites, T, M)
+            return jnp.transpose(ratios, (2, 0, 1, 4, 3))
 
         if update_sites is None:
             def evaluate_site_product(sample):
@@ -91,10 +119,17 @@ class PlaquetteqGPS(nn.Module):
                 return jax.vmap(single_plaquette_eval, in_axes=(0, 1), out_axes=0)(plaquettes, epsilon)
 
             def get_site_prod(sample):
-                return jax.vmap(evaluate_site_product, in_axes=-1, out_axes=-1)(self.symmetries(sample))
+                return map_over_symmetry_chunks(jax.vmap(evaluate_site_product, in_axes=-1, out_axes=-1), self.symmetries(sample),
+                                                chunk_size=self.symmetry_chunk_size)
 
             transformed_samples = jnp.expand_dims(indices, (1, 2)) # required for the inner take_along_axis
             site_product = jax.vmap(get_site_prod)(transformed_samples)
+        elif self.ratio_tables:
+            def site_product_update_from_table(site_prod_old, site_ratios, sample_new, update_sites):
+                return site_prod_old * site_ratios[update_sites, sample_new].prod(axis=0)
+
+            site_product = jax.vmap(site_product_update_from_table, in_axes=(0, 0, 0, 0), out_axes=0)(site_product_save.value, site_ratios_save.value,
+                                                                                                      indices, update_sites)
         else:
             site_product_old = site_product_save.value
             new_samples = indices
@@ -113,7 +148,8 @@ class PlaquetteqGPS(nn.Module):
                 inv_sym_new, inv_sym_sites = self.symmetries_inverse(sample_new, update_sites)
                 inv_sym_old, inv_sym_sites = self.symmetries_inverse(sample_old, update_sites)
 
-                return jax.vmap(inner_site_product_update, in_axes=(-1, -1, -1, -1), out_axes=-1)(site_prod_old, inv_sym_new, inv_sym_old, inv_sym_sites)
+                return map_over_symmetry_chunks(jax.vmap(inner_site_product_update, in_axes=(-1, -1, -1, -1), out_axes=-1),
+                                                site_prod_old, inv_sym_new, inv_sym_old, inv_sym_sites, chunk_size=self.symmetry_chunk_size)
 
             site_product = jax.vmap(outer_site_product_update, in_axes=(0, 0, 0, 0), out_axes=0)(site_product_old, new_samples, old_samples, update_sites)
 
@@ -126,5 +162,15 @@ class PlaquetteqGPS(nn.Module):
             else:
                 indices_save.value = indices
 
+            if self.ratio_tables:
+                if update_sites is not None:
+                    # Only the ratios at the updated sites change
+                    def update_ratios(site_ratios, sample, update_sites):
+                        return site_ratios.at[update_sites].set(get_site_ratios(sample[update_sites], update_sites))
+                    site_ratios_save.value = jax.vmap(update_ratios, in_axes=(0, 0, 0), out_axes=0)(site_ratios_save.value, indices_save.value, update_sites)
+                else:
+                    all_sites = jnp.arange(self.L)
+                    site_ratios_save.value = jax.vmap(lambda sample: get_site_ratios(sample, all_sites))(indices_save.value)
+
         # site_product has dim N_batch x number of plaquettes x M x Number of syms
         return self.out_transformation(site_product)
\ No newline at end of file
@@ -67,6 +67,31 @@ def no_syms():
     inv_sym = lambda sample_at_indices, indices : (jnp.expand_dims(sample_at_indices, axis=-1), jnp.expand_dims(indices, axis=-1))
     return (symmetries, inv_sym)
 
+# helper function applying fun (which maps arrays with a trailing symmetry axis to a pytree of arrays with a trailing symmetry axis)
+# to chunks of chunk_size symmetry operations, the chunks are evaluated sequentially (with lax.map) to bound the memory requirements
+# for large numbers of symmetry operations (the symmetry axis is padded with copies of the first symmetry operation)
+def map_over_symmetry_chunks(fun, *args, chunk_size=None):
+    n_syms = args[0].shape[-1]
+    if chunk_size is None or chunk_size >= n_syms:
+        return fun(*args)
+    n_chunks = -(-n_syms // chunk_size)
+    n_padding = n_chunks * chunk_size - n_syms
+    def split(x):
+        x = jnp.concatenate((x, jnp.repeat(x[..., :1], n_padding, axis=-1)), axis=-1)
+        return jnp.moveaxis(x.reshape(x.shape[:-1] + (n_chunks, chunk_size)), -2, 0)
+    def merge(x):
+        x = jnp.moveaxis(x, 0, -2)
+        return x.reshape(x.shape[:-2] + (n_chunks * chunk_size,))[..., :n_syms]
+    return jax.tree_map(merge, jax.lax.map(lambda chunk: fun(*chunk), tuple(split(x) for x in args)))
+
+# helper function splitting the (site product) factors into their log-magnitudes, phases (unit complex numbers or the
+# signs for real parameters) and flags indicating exactly zero-valued factors (which are excluded from the log-magnitudes and phases)
+def log_factors(factors):
+    is_zero = (factors == 0)
+    safe_factors = jnp.where(is_zero, 1., factors)
+    abs_factors = jnp.abs(safe_factors)
+    return jnp.log(abs_factors), safe_factors / abs_factors, is_zero
+
 # TODO: the framework for the symmetrisation could (and should) definitely be improved at one point
 class qGPS(nn.Module):
     # TODO: add documentation
@@ -89,8 +114,32 @@ class qGPS(nn.Module):
     syms: Union[Callable, Tuple[Callable, Callable]] = no_syms()
     out_transformation: Callable = lambda argument : jnp.sum(argument, axis=(-2,-1))
     apply_fast_update: bool = True
+    """
+    If log_site_products is set, the site products are represented by their log-magnitude, their phase (the sign for real
+    parameters) and the number of exactly zero-valued factors for each (M, T) channel (see _log_site_products).
+    The fast updates then never divide by a parameter, so that these stay exact for zero-valued (or very small) parameters.
+    Note that the site products are still exponentiated before the out_transformation is applied, so that products which
+    are not representable in the parameter dtype overflow (or underflow) in the same way as without this option.
+    """
+    log_site_products: bool = False
+    """
+    If ratio_tables is set, a table of the ratios epsilon[new_occ]/epsilon[current_occ] for each site, each local occupancy,
+    each support dimension and each symmetry (with shape (B, L, D, M, T)) is set up when the intermediates are cached.
+    The update of the site products for any (single, double, ...) excitation of the cached configuration then only
+    requires one table lookup per updated site. This is mainly useful for evaluating many excitations of the same
+    configuration (e.g. in the on-the-fly local energy kernels), the table is updated for the changed sites if the cache is
+    updated (e.g. in the fast updating sampler).
+    """
+    ratio_tables: bool = False
+    """
+    If symmetry_chunk_size is set, the site products are evaluated sequentially for chunks of symmetry_chunk_size symmetry
+    operations (also in the fast updates), so that the (B, M, L) factors are only set up for one chunk of the symmetries at a time.
+    This bounds the memory requirements for large symmetry groups (e.g. full space groups of 2D lattices with spin flips).
+    """
+    symmetry_chunk_size: Optional[int] = None
 
     def setup(self):
+        assert (not (self.ratio_tables and self.log_site_products))
         if type(self.syms) == tuple:
             self.symmetries = self.syms[0]
             self.symmetries_inverse = self.syms[1]
@@ -120,12 +169,23 @@ class qGPS(nn.Module):
 
         epsilon = self.param("epsilon", init, (self.local_dim, self.M, self.L), self.dtype)
 
+        if self.log_site_products:
+            return self.out_transformation(self._log_site_products(epsilon, indices, cache_intermediates, update_sites))
+
         # Register the cache variables
         if update_sites is not None or cache_intermediates:
             saved_configs = self.variable("intermediates_cache", "samples", lambda : None)
             saved_site_product = self.variable("intermediates_cache", "site_prod", lambda : None)
+            if self.ratio_tables:
+                saved_site_ratios = self.variable("intermediates_cache", "site_ratios", lambda : None)
 
-        if update_sites is not None:
+        if update_sites is not None and self.ratio_tables:
+            def site_product_update_from_table(site_prod_old, site_ratios, sample_new, update_sites):
+                return site_prod_old * site_ratios[update_sites, sample_new].prod(axis=0)
+
+            site_product = jax.vmap(site_product_update_from_table, in_axes=(0, 0, 0, 0), out_axes=0)(saved_site_product.value, saved_site_ratios.value,
+                                                                                                      indices, update_sites)
+        elif update_sites is not None:
             indices_save = saved_configs.value
             old_samples = jax.vmap(jnp.take, in_axes=(0, 0), out_axes=0)(indices_save, update_sites)
 
@@ -137,7 +197,8 @@ class qGPS(nn.Module):
             def outer_site_product_update(site_prod_old, sample_new, sample_old, update_sites):
                 inv_sym_new, inv_sym_sites = self.symmetries_inverse(sample_new, update_sites)
                 inv_sym_old, inv_sym_sites = self.symmetries_inverse(sample_old, update_sites)
-                return jax.vmap(inner_site_product_update, in_axes=(-1, -1, -1, -1), out_axes=-1)(site_prod_old, inv_sym_new, inv_sym_old, inv_sym_sites)
+                return map_over_symmetry_chunks(jax.vmap(inner_site_product_update, in_axes=(-1, -1, -1, -1), out_axes=-1),
+                                                site_prod_old, inv_sym_new, inv_sym_old, inv_sym_sites, chunk_size=self.symmetry_chunk_size)
 
             site_product_old = saved_site_product.value
             site_product = jax.vmap(outer_site_product_update, in_axes=(0, 0, 0, 0), out_axes=0)(site_product_old, indices, old_samples, update_sites)
@@ -146,7 +207,8 @@ class qGPS(nn.Module):
                 return jnp.take_along_axis(epsilon, sample, axis=0).prod(axis=-1).reshape(-1)
 
             def get_site_prod(sample):
-                return jax.vmap(evaluate_site_product, in_axes=-1, out_axes=-1)(self.symmetries(sample))
+                return map_over_symmetry_chunks(jax.vmap(evaluate_site_product, in_axes=-1, out_axes=-1), self.symmetries(sample),
+                                                chunk_size=self.symmetry_chunk_size)
 
             transformed_samples = jnp.expand_dims(indices, (1, 2)) # required for the inner take_along_axis
 
@@ -165,4 +227,98 @@ class qGPS(nn.Module):
 
             saved_configs.value = full_samples
 
+            if self.ratio_tables:
+                if update_sites is not None:
+                    # Only the ratios at the updated sites change
+                    def update_ratios(site_ratios, sample, update_sites):
+                        return site_ratios.at[update_sites].set(self._site_ratios(epsilon, sample[update_sites], update_sites))
+                    saved_site_ratios.value = jax.vmap(update_ratios, in_axes=(0, 0, 0), out_axes=0)(saved_site_ratios.value, full_samples, update_sites)
+                else:
+                    all_sites = jnp.arange(self.L)
+                    saved_site_ratios.value = jax.vmap(lambda sample: self._site_ratios(epsilon, sample, all_sites))(full_samples)
+
         return self.out_transformation(site_product)
+
+    """
+    Returns the ratios epsilon[new_occ]/epsilon[occ] for the given sites (with current occupancies occs) and all possible
+    new occupancies, the returned array has shape (#sites, D, M, T).
+    """
+    def _site_ratios(self, epsilon, occs, sites):
+        inv_sym_old, inv_sym_sites = self.symmetries_inverse(occs, sites) # (#sites, T)
+        def ratios_for_occupancy(occ):
+            inv_sym_new, _ = self.symmetries_inverse(jnp.full_like(occs, occ), sites)
+            return epsilon[inv_sym_new, :, inv_sym_sites] / epsilon[inv_sym_old, :, inv_sym_sites] # (#sites, T, M)
+        ratios = jax.vmap(ratios_for_occupancy)(jnp.arange(self.local_dim, dtype=occs.dtype)) # (D, #sites, T, M)
+        return jnp.transpose(ratios, (1, 0, 3, 2))
+
+    """
+    Evaluates the site products in the log-domain, the intermediates cache holds the log-magnitudes, the phases and the
+    zero counts of the site products, which are updated additively (or multiplicatively for the phases) in the fast updates.
+    For the full evaluation, the site products are set up such that gradients with respect to a single zero-valued factor are
+    still correct.
+    """
+    def _log_site_products(self, epsilon, indices, cache_intermediates, update_sites):
+        if update_sites is not None or cache_intermediates:
+            saved_configs = self.variable("intermediates_cache", "samples", lambda : None)
+            saved_log_site_product = self.variable("intermediates_cache", "log_site_prod", lambda : None)
+            saved_site_product_phase = self.variable("intermediates_cache", "site_prod_phase", lambda : None)
+            saved_site_product_zeros = self.variable("intermediates_cache", "site_prod_zeros", lambda : None)
+
+        if update_sites is not None:
+            indices_save = saved_configs.value
+            old_samples = jax.vmap(jnp.take, in_axes=(0, 0), out_axes=0)(indices_save, update_sites)
+
+            def inner_site_product_update(log_prod_old, phase_old, zeros_old, new_occs, old_occs, sites):
+                log_abs_old, phases_old, is_zero_old = log_factors(epsilon[old_occs,:,sites])
+                log_abs_new, phases_new, is_zero_new = log_factors(epsilon[new_occs,:,sites])
+                log_prod = log_prod_old - log_abs_old.sum(axis=0) + log_abs_new.sum(axis=0)
+                # The phases have unit magnitude so that their inverse is given by the complex conjugate
+                phase = phase_old * jnp.conj(phases_old).prod(axis=0) * phases_new.prod(axis=0)
+                zeros = zeros_old - is_zero_old.sum(axis=0) + is_zero_new.sum(axis=0)
+                return log_prod, phase, zeros
+
+            def outer_site_product_update(log_prod_old, phase_old, zeros_old, sample_new, sample_old, update_sites):
+                inv_sym_new, inv_sym_sites = self.symmetries_inverse(sample_new, update_sites)
+                inv_sym_old, inv_sym_sites = self.symmetries_inverse(sample_old, update_sites)
+                return map_over_symmetry_chunks(jax.vmap(inner_site_product_update, in_axes=(-1, -1, -1, -1, -1, -1), out_axes=-1),
+                                                log_prod_old, phase_old, zeros_old, inv_sym_new, inv_sym_old, inv_sym_sites,
+                                                chunk_size=self.symmetry_chunk_size)
+
+            log_site_product, site_product_phase, site_product_zeros = jax.vmap(outer_site_product_update, in_axes=(0, 0, 0, 0, 0, 0), out_axes=0)(
+                saved_log_site_product.value, saved_site_product_phase.value, saved_site_product_zeros.value, indices, old_samples, update_sites)
+            site_product = jnp.where(site_product_zeros == 0, jnp.exp(log_site_product) * site_product_phase, 0.)
+        else:
+            def evaluate_site_product(sample):
+                factors = jnp.take_along_axis(epsilon, sample, axis=0).reshape((self.M, self.L))
+                log_abs, phases, is_zero = log_factors(factors)
+                # Carries the gradient with respect to a single zero-valued factor (the value itself is zero)
+                zero_factor = jnp.sum(jnp.where(is_zero, factors, 0.), axis=-1)
+                return log_abs.sum(axis=-1), phases.prod(axis=-1), is_zero.sum(axis=-1, dtype=jnp.int32), zero_factor
+
+            def get_site_prod(sample):
+                return map_over_symmetry_chunks(jax.vmap(evaluate_site_product, in_axes=-1, out_axes=-1), self.symmetries(sample),
+                                                chunk_size=self.symmetry_chunk_size)
+
+            transformed_samples = jnp.expand_dims(indices, (1, 2)) # required for the inner take_along_axis
+
+            log_site_product, site_product_phase, site_product_zeros, zero_factor = jax.vmap(get_site_prod)(transformed_samples)
+            prefactor = jnp.where(site_product_zeros == 0, 1., jnp.where(site_product_zeros == 1, zero_factor, 0.))
+            site_product = prefactor * jnp.exp(log_site_product) * site_product_phase
+
+        if cache_intermediates:
+            saved_log_site_product.value = log_site_product
+            # Renormalization of the phases avoids the accumulation of rounding errors in their magnitudes
+            saved_site_product_phase.value = site_product_phase / jnp.abs(site_product_phase)
+            saved_site_product_zeros.value = site_product_zeros
+            if update_sites is not None:
+                def update_fun(saved_config, update_sites, occs):
+                    def scan_fun(carry, count):
+                        return (carry.at[update_sites[count]].set(occs[count]), None)
+                    return jax.lax.scan(scan_fun, saved_config, jnp.arange(update_sites.shape[0]), reverse=True)[0]
+                full_samples = jax.vmap(update_fun, in_axes=(0, 0, 0), out_axes=0)(saved_configs.value, update_sites, indices)
+            else:
+                full_samples = indices
+
+            saved_configs.value = full_samples
+
+        return site_product
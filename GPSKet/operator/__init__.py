@@ -1 +1,3 @@
-from . import hamiltonian
\ No newline at end of file
+from . import hamiltonian
+from .local_operator import LocalOperatorOnTheFly
+from .local_operator import expect_multiple
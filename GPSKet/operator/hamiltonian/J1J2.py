@@ -5,14 +5,19 @@ import netket.jax as nkjax
 from netket.vqs.mc.mc_state.state import MCState
 from GPSKet.models import qGPS
 import GPSKet.vqs.mc.mc_state.expect
+from GPSKet.operator.hamiltonian.mixed_precision import get_mixed_precision_logpsi
 
 from typing import Optional
+from functools import partial
 
-# dummy class used if the local energy should be evaluated on the fly (allowing for fast updating)
+# dummy class used if the local energy should be evaluated on the fly (allowing for fast updating),
+# if mixed_precision is set, the model is evaluated in single precision (see get_mixed_precision_logpsi)
 class HeisenbergOnTheFly(nk.operator.Heisenberg):
-    pass
+    def __init__(self, *args, mixed_precision: bool=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mixed_precision = mixed_precision
 
-def get_J1_J2_Hamiltonian(Lx, Ly=None, J1=1., J2=0., sign_rule=True, total_sz=0.0, on_the_fly_en=False, pbc = True):
+def get_J1_J2_Hamiltonian(Lx, Ly=None, J1=1., J2=0., sign_rule=True, total_sz=0.0, on_the_fly_en=False, pbc = True, mixed_precision=False):
     if J2 != 0.:
         nb_order = 2
     else:
@@ -31,7 +36,7 @@ def get_J1_J2_Hamiltonian(Lx, Ly=None, J1=1., J2=0., sign_rule=True, total_sz=0.
     are applied or not.
     """
     if on_the_fly_en:
-        classtype = HeisenbergOnTheFly
+        classtype = partial(HeisenbergOnTheFly, mixed_precision=mixed_precision)
     else:
         classtype = nk.operator.Heisenberg
 
@@ -53,7 +58,9 @@ it explicitly requires that each operator in the Hamiltonian acts on a pair of s
 and connects the test configuration to at most one other different configuration.
 """
 
-def local_en_on_the_fly(states_to_local_indices, logpsi, pars, samples, args, use_fast_update=False, chunk_size=None):
+def local_en_on_the_fly(states_to_local_indices, logpsi, pars, samples, args, use_fast_update=False, chunk_size=None, mixed_precision=False):
+    if mixed_precision:
+        logpsi = get_mixed_precision_logpsi(logpsi)
     operators = args[0]
     acting_on = args[1]
     def vmap_fun(sample):
@@ -95,4 +102,5 @@ def get_local_kernel(vstate: nk.vqs.MCState, op: HeisenbergOnTheFly, chunk_size:
         use_fast_update = vstate.model.apply_fast_update
     except:
         use_fast_update = False
-    return nkjax.HashablePartial(local_en_on_the_fly, op.hilbert.states_to_local_indices, use_fast_update=use_fast_update, chunk_size=chunk_size)
+    return nkjax.HashablePartial(local_en_on_the_fly, op.hilbert.states_to_local_indices, use_fast_update=use_fast_update, chunk_size=chunk_size,
+                                 mixed_precision=op.mixed_precision)
@@ -1,7 +1,12 @@
 from .J1J2 import get_J1_J2_Hamiltonian
 from .ab_initio import AbInitioHamiltonian
 from .ab_initio import AbInitioHamiltonianOnTheFly
+from .ab_initio import AbInitioHamiltonianFactorized
+from .ab_initio import get_accumulated_RDMs
 from .ab_initio_sparse import AbInitioHamiltonianSparse
+from .ab_initio_integrals import load_ab_initio_hamiltonian
 from .hubbard import FermiHubbard
 from .hubbard import FermiHubbardOnTheFly
+from .hubbard import get_Fermi_Hubbard_Hamiltonian
+from .hubbard import get_hopping_from_graph
 from .asep import AsymmetricSimpleExclusionProcess
\ No newline at end of file
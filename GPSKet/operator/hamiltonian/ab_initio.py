@@ -2,7 +2,7 @@ import numpy as np
 import netket as nk
 import jax.numpy as jnp
 import jax
-from numba import jit
+from numba import jit, prange
 import netket.jax as nkjax
 
 from typing import Optional
@@ -10,11 +10,15 @@ from typing import Optional
 from functools import partial
 
 from netket.utils.types import DType
+from netket.utils.mpi import mpi_sum as _mpi_sum, mpi_sum_jax as _mpi_sum_jax
 from GPSKet.operator.fermion import FermionicDiscreteOperator, apply_hopping
+from GPSKet.operator.hamiltonian.shared_memory import move_attributes_to_shared_memory, free_shared_memory, to_device_array
+from GPSKet.operator.hamiltonian.mixed_precision import get_mixed_precision_logpsi
 from GPSKet.models import qGPS
+from GPSKet.models.fast_update import apply_batched_fast_updates
 
 class AbInitioHamiltonian(FermionicDiscreteOperator):
-    def __init__(self, hilbert, h_mat, eri_mat):
+    def __init__(self, hilbert, h_mat, eri_mat, use_shared_memory=False):
         """ Though not entirely necessary it makes our life a little bit easier to restrict
         ourselves to fixed electron number/magnetization hilbert spaces. """
         assert(hilbert._n_elec is not None)
@@ -25,35 +29,86 @@ class AbInitioHamiltonian(FermionicDiscreteOperator):
         # See [Neuscamman (2013), https://doi.org/10.1063/1.4829835] for the definition of t
         self.t_mat = self.h_mat - 0.5 * np.einsum("prrq->pq", eri_mat)
 
+        """ Coulomb and exchange tables used by the on-the-fly local energy evaluation.
+        j_mat[p,q] = eri[p,p,q,q] and k_mat[p,q] = eri[p,q,q,p] give all diagonal contributions,
+        eri_j[p,q,r] = eri[p,q,r,r] and eri_k[p,q,r] = eri[p,r,r,q] give the (Fock-like) prefactors
+        of the single excitations by contraction with the occupancies of a sample. """
+        self.j_mat = np.einsum("ppqq->pq", eri_mat)
+        self.k_mat = np.einsum("pqqp->pq", eri_mat)
+        self.eri_j = np.einsum("pqrr->pqr", eri_mat)
+        self.eri_k = np.einsum("prrq->pqr", eri_mat)
+
+        """ If use_shared_memory is set, all the arrays are stored in MPI-3 shared memory windows, so that only one copy
+        is held per node (see move_attributes_to_shared_memory). The windows are freed when the Hamiltonian is deleted. """
+        if use_shared_memory:
+            move_attributes_to_shared_memory(self)
+
+    # The function is bound as a default argument, as the module globals can already be cleared at interpreter shutdown
+    def __del__(self, _free_shared_memory=free_shared_memory):
+        if getattr(self, "_shared_memory_windows", None):
+            _free_shared_memory(self)
+
     @property
     def is_hermitian(self) -> bool:
         return True
 
     @property
     def dtype(self) -> DType:
-        return float
+        return np.result_type(self.t_mat, float)
 
     # Pad argument is just a dummy at the moment,
     # TODO: include padding for unconstrained Hilbert spaces
     def get_conn_flattened(self, x, sections, pad=True):
         assert(not pad or self.hilbert.constrained)
 
-        x_primes, mels = self._get_conn_flattened_kernel(np.asarray(x, dtype = np.uint8),
-                                                         sections, self.t_mat, self.eri_mat)
+        x = np.asarray(x, dtype = np.uint8)
+
+        # First pass: count the connected configurations so that the output can be allocated exactly once
+        n_conns = self._count_connected_kernel(x)
+        np.cumsum(n_conns, out=sections)
+
+        # Second pass: fill the preallocated buffers (parallelized over the samples)
+        x_primes, mels = self._get_conn_flattened_kernel(x, sections, self.t_mat, self.eri_mat)
 
         return x_primes, mels
 
-    # This implementation follows the approach outlined in [Neuscamman (2013), https://doi.org/10.1063/1.4829835].
     @staticmethod
     @jit(nopython=True)
+    def _count_connected_kernel(x):
+        n_conns = np.empty(x.shape[0], dtype=np.int64)
+        for batch_id in range(x.shape[0]):
+            n_up = np.sum(x[batch_id] & 1)
+            n_down = np.sum((x[batch_id] & 2) >> 1)
+            n_empty_up = x.shape[1] - n_up
+            n_empty_down = x.shape[1] - n_down
+
+            connected_con = 1
+            connected_con += n_up * n_empty_up
+            connected_con += n_down * n_empty_down
+            connected_con += n_down * n_empty_down * (n_down - 1) * (n_empty_down - 1)
+            connected_con += n_up * n_empty_up * (n_up - 1) * (n_empty_up - 1)
+            connected_con += n_up * n_empty_up * n_down * n_empty_down
+            n_conns[batch_id] = connected_con
+        return n_conns
+
+    # This implementation follows the approach outlined in [Neuscamman (2013), https://doi.org/10.1063/1.4829835].
+    # The sections array needs to hold the (cumulative) end index of the connected configurations of each sample.
+    @staticmethod
+    @jit(nopython=True, parallel=True)
     def _get_conn_flattened_kernel(x, sections, t, eri):
         range_indices = np.arange(x.shape[-1])
 
-        x_prime = np.empty((0, x.shape[1]), dtype=np.uint8)
-        mels = np.empty(0, dtype=np.complex128)
+        n_conn_total = sections[-1] if x.shape[0] > 0 else 0
+        x_prime = np.empty((n_conn_total, x.shape[1]), dtype=np.uint8)
+        # The matrix elements are real (complex) for real (complex) integrals
+        mels = np.empty(n_conn_total, dtype=t.dtype)
+
+        for batch_id in prange(x.shape[0]):
+            if batch_id == 0:
+                c = 0
+            else:
+                c = sections[batch_id - 1]
 
-        c = 0
-        for batch_id in range(x.shape[0]):
             is_occ_up = (x[batch_id] & 1).astype(np.bool8)
             is_occ_down = (x[batch_id] & 2).astype(np.bool8)
 
@@ -68,16 +123,6 @@ class AbInitioHamiltonian(FermionicDiscreteOperator):
             up_unocc_inds = range_indices[is_empty_up]
             down_unocc_inds = range_indices[is_empty_down]
 
-            connected_con = 1
-            connected_con += len(up_occ_inds) * len(up_unocc_inds)
-            connected_con += len(down_occ_inds) * len(down_unocc_inds)
-            connected_con += len(down_occ_inds) * len(down_unocc_inds) * (len(down_occ_inds) - 1) * (len(down_unocc_inds) - 1)
-            connected_con += len(up_occ_inds) * len(up_unocc_inds) * (len(up_occ_inds) - 1) * (len(up_unocc_inds) - 1)
-            connected_con += len(up_occ_inds) * len(up_unocc_inds) * len(down_occ_inds) * len(down_unocc_inds)
-
-            x_prime = np.append(x_prime, np.empty((connected_con, x.shape[1]), dtype=np.uint8), axis=0)
-            mels = np.append(mels, np.empty(connected_con))
-
             diag_element = 0.0
             for i in up_occ_inds:
                 diag_element += t[i, i]
@@ -188,12 +233,175 @@ class AbInitioHamiltonian(FermionicDiscreteOperator):
                                                            cummulative_count=down_count)
                             mels[c] = multiplicator * eri[i,a,j,b]
                             c += 1
-            sections[batch_id] = c
         return x_prime, mels
 
-""" Wrapper class which can be used to apply the on-the-fly updating"""
+""" Helper functions for the permutation symmetry compressed storage of the two-electron integrals.
+The integrals eri[p,q,r,s] = (pq|rs) obey the symmetries (pq|rs) = (rs|pq) and (pq|rs) = (qp|sr)^*,
+as well as (pq|rs) = (qp|rs) if the orbitals are real. Orbital pairs (p,q) are indexed by the
+triangular index of (max(p,q), min(p,q)), and only the pairs of pair indices with the first
+index >= the second index are stored. For real integrals this gives the usual 8-fold packing
+(array of shape (T*(T+1)/2,) with T = L*(L+1)/2). For complex integrals, an additional trailing axis of
+size two distinguishes whether the order of the two orbital pairs is the same (0) or opposite (1), which
+gives a 4-fold packing (array of shape (T*(T+1)/2, 2)).
+"""
+def pack_eri(eri_mat):
+    n_orbs = eri_mat.shape[0]
+    p, q = np.tril_indices(n_orbs)
+    pair_first, pair_second = np.tril_indices(len(p))
+    if np.iscomplexobj(eri_mat):
+        eri_packed = np.empty((len(pair_first), 2), dtype=eri_mat.dtype)
+        eri_packed[:, 0] = eri_mat[p[pair_first], q[pair_first], p[pair_second], q[pair_second]]
+        eri_packed[:, 1] = eri_mat[p[pair_first], q[pair_first], q[pair_second], p[pair_second]]
+    else:
+        eri_packed = eri_mat[p[pair_first], q[pair_first], p[pair_second], q[pair_second]]
+    return eri_packed
+
+def unpack_eri(eri_packed, n_orbs):
+    p, q, r, s = np.indices((n_orbs,)*4, sparse=True)
+    return get_packed_eri_element(eri_packed, p, q, r, s, xp=np)
+
+""" Returns the index into the packed integrals for the elements eri[p,q,r,s] (the index arrays are broadcast against each other).
+For complex integrals, the second returned array gives the index into the trailing axis of the packed integrals, and the third
+array specifies whether the stored value needs to be conjugated."""
+def get_packed_eri_index(p, q, r, s, xp=jnp):
+    def pair_index(i, j):
+        larger = xp.maximum(i, j)
+        return (larger * (larger + 1))//2 + xp.minimum(i, j), i < j
+    pq, pq_flipped = pair_index(p, q)
+    rs, rs_flipped = pair_index(r, s)
+    swap_pairs = pq < rs
+    first = xp.where(swap_pairs, rs, pq)
+    second = xp.where(swap_pairs, pq, rs)
+    packed_index = (first * (first + 1))//2 + second
+    return packed_index, (pq_flipped ^ rs_flipped).astype(int), xp.where(swap_pairs, rs_flipped, pq_flipped)
+
+""" Returns the elements eri[p,q,r,s] from the packed integrals (the index arrays are broadcast against each other).
+This is jittable and used inside the local energy kernels. """
+def get_packed_eri_element(eri_packed, p, q, r, s, xp=jnp):
+    packed_index, order_flipped, conjugate = get_packed_eri_index(p, q, r, s, xp=xp)
+    if eri_packed.ndim == 1:
+        return eri_packed[packed_index]
+    else:
+        value = eri_packed[packed_index, order_flipped]
+        return xp.where(conjugate, xp.conj(value), value)
+
+""" Wrapper class which can be used to apply the on-the-fly updating.
+If use_packed_eri is set, the two-electron integrals are only stored in the permutation symmetry compressed
+format (see pack_eri), and the dense eri_mat is only reconstructed if connected configurations
+are explicitly generated (e.g. for exact diagonalization).
+Alternatively, the packed integrals can be passed directly as eri_packed (with eri_mat set to None),
+in which case the dense eri_mat is never constructed in the setup.
+If mixed_precision is set, the model is evaluated in single precision in the local energy evaluation
+(see get_mixed_precision_logpsi), while the amplitude ratios and the local energies are accumulated in double precision.
+"""
 class AbInitioHamiltonianOnTheFly(AbInitioHamiltonian):
-    pass
+    def __init__(self, hilbert, h_mat, eri_mat, use_packed_eri=False, excitation_chunk_size=None, eri_packed=None, mixed_precision=False,
+                 use_shared_memory=False):
+        if eri_mat is None:
+            assert(hilbert._n_elec is not None)
+            FermionicDiscreteOperator.__init__(self, hilbert)
+            self.h_mat = h_mat
+            self.eri_mat = None
+            self.eri_packed = eri_packed
+            self._set_up_tables_from_packed()
+        else:
+            super().__init__(hilbert, h_mat, eri_mat)
+            if use_packed_eri:
+                self.eri_packed = pack_eri(self.eri_mat)
+                self.eri_mat = None
+            else:
+                self.eri_packed = None
+        self.excitation_chunk_size = excitation_chunk_size
+        self.mixed_precision = mixed_precision
+        if use_shared_memory:
+            move_attributes_to_shared_memory(self)
+
+    def _set_up_tables_from_packed(self):
+        """
+        Sets up t_mat and the Coulomb and exchange tables (see AbInitioHamiltonian) from the packed integrals.
+        """
+        p, q, r = np.ogrid[:self.h_mat.shape[0], :self.h_mat.shape[0], :self.h_mat.shape[0]]
+        self.eri_j = get_packed_eri_element(self.eri_packed, p, q, r, r, xp=np)
+        self.eri_k = get_packed_eri_element(self.eri_packed, p, r, r, q, xp=np)
+        self.t_mat = self.h_mat - 0.5 * np.sum(self.eri_k, axis=-1)
+        self.j_mat = get_packed_eri_element(self.eri_packed, p[:, :, 0], p[:, :, 0], q[:, :, 0], q[:, :, 0], xp=np)
+        self.k_mat = get_packed_eri_element(self.eri_packed, p[:, :, 0], q[:, :, 0], q[:, :, 0], p[:, :, 0], xp=np)
+
+    def get_dense_eri(self):
+        if self.eri_mat is None:
+            return unpack_eri(self.eri_packed, self.h_mat.shape[0])
+        else:
+            return self.eri_mat
+
+    def get_conn_flattened(self, x, sections, pad=True):
+        if self.eri_mat is None:
+            # The dense integrals are only reconstructed temporarily
+            x = np.asarray(x, dtype = np.uint8)
+            n_conns = self._count_connected_kernel(x)
+            np.cumsum(n_conns, out=sections)
+            return self._get_conn_flattened_kernel(x, sections, self.t_mat, self.get_dense_eri())
+        else:
+            return super().get_conn_flattened(x, sections, pad=pad)
+
+""" Ab initio Hamiltonian where the two-electron integrals are specified in a factorized form
+(e.g. as obtained from a Cholesky decomposition or density fitting), i.e.
+eri[p,q,r,s] = sum_P eri_factors[P,p,q] * eri_factors[P,r,s].
+The local energy is evaluated by contracting the matrix elements of the double excitations
+through the auxiliary index so that no tensor with O(L^4) elements is ever constructed.
+All one-body and diagonal contributions are computed from O(L^3) tables set up in the constructor.
+"""
+class AbInitioHamiltonianFactorized(AbInitioHamiltonianOnTheFly):
+    def __init__(self, hilbert, h_mat, eri_factors, excitation_chunk_size=None, mixed_precision=False, use_shared_memory=False):
+        assert(hilbert._n_elec is not None)
+        FermionicDiscreteOperator.__init__(self, hilbert)
+        self.excitation_chunk_size = excitation_chunk_size
+        self.mixed_precision = mixed_precision
+        self.h_mat = h_mat
+        self.eri_factors = eri_factors
+        self.eri_mat = None
+        self.eri_packed = None
+
+        self.t_mat = self.h_mat - 0.5 * np.einsum("Ppr,Prq->pq", eri_factors, eri_factors)
+        diag_factors = np.einsum("Ppp->Pp", eri_factors)
+        self.j_mat = np.einsum("Pp,Pq->pq", diag_factors, diag_factors)
+        self.k_mat = np.einsum("Ppq,Pqp->pq", eri_factors, eri_factors)
+        self.eri_j = np.einsum("Ppq,Pr->pqr", eri_factors, diag_factors)
+        self.eri_k = np.einsum("Ppr,Prq->pqr", eri_factors, eri_factors)
+        if use_shared_memory:
+            move_attributes_to_shared_memory(self)
+
+    def get_dense_eri(self):
+        return np.einsum("Ppq,Prs->pqrs", self.eri_factors, self.eri_factors)
+
+""" Pivoted (incomplete) Cholesky decomposition of the two-electron integrals, returns the factors
+eri_factors with shape (N_aux, L, L) such that eri[p,q,r,s] = sum_P eri_factors[P,p,q] * eri_factors[P,r,s]
+up to the specified threshold. Only the diagonal and the columns eri_mat[:, :, r, s] of the selected pivots
+are accessed, so that eri_mat can also be a memory-mapped array. The integrals can also be passed in the
+packed format (see pack_eri), in which case the number of orbitals n_orbs needs to be specified."""
+def cholesky_decompose_eri(eri_mat, threshold=1.e-8, max_vectors=None, n_orbs=None):
+    if eri_mat.ndim == 4:
+        n_orbs = eri_mat.shape[0]
+        residual_diag = np.array(np.einsum("pqpq->pq", eri_mat)).reshape(-1)
+        get_column = lambda r, s: np.array(eri_mat[:, :, r, s])
+    else:
+        assert(n_orbs is not None)
+        p, q = np.ogrid[:n_orbs, :n_orbs]
+        residual_diag = get_packed_eri_element(eri_mat, p, q, p, q, xp=np).reshape(-1)
+        get_column = lambda r, s: get_packed_eri_element(eri_mat, p, q, r, s, xp=np)
+    if max_vectors is None:
+        max_vectors = n_orbs * n_orbs
+    factors = np.zeros((max_vectors, n_orbs * n_orbs), dtype=residual_diag.dtype)
+    n_vectors = 0
+    while n_vectors < max_vectors:
+        pivot = np.argmax(abs(residual_diag))
+        if abs(residual_diag[pivot]) < threshold:
+            break
+        r, s = divmod(pivot, n_orbs)
+        column = get_column(r, s).reshape(-1) - factors[:n_vectors].T.dot(factors[:n_vectors, pivot])
+        factors[n_vectors] = column / np.sqrt(residual_diag[pivot])
+        residual_diag -= factors[n_vectors] * factors[n_vectors]
+        n_vectors += 1
+    return factors[:n_vectors].reshape((n_vectors, n_orbs, n_orbs))
 
 """ Helper function which returns the parity for an electron hop by counting
 how many electrons the hopping electron moved past. Careful!, this
@@ -206,17 +414,211 @@ def get_parity_multiplicator_hop(update_sites, cummulative_el_count):
     # Type promotion is important, gives incorrect results if not cast to unsigned int
     return (jnp.int32(1) - 2 * (parity_count & 1))
 
+""" Evaluates fun(i, a) for all pairs of the indices in first_inds and second_inds (e.g. occupied and unoccupied orbitals),
+returning the outputs as arrays of shape (len(first_inds), len(second_inds), ...). The flattened list of pairs is
+evaluated in chunks of size excitation_chunk_size (all at once if None), which bounds the number of connected
+configurations which are processed simultaneously."""
+def vmap_excitations(fun, first_inds, second_inds, excitation_chunk_size=None):
+    first, second = jnp.meshgrid(first_inds, second_inds, indexing="ij")
+    out = nkjax.vmap_chunked(fun, in_axes=(0, 0), chunk_size=excitation_chunk_size)(first.flatten(), second.flatten())
+    return jax.tree_map(lambda x: x.reshape(first.shape + x.shape[1:]), out)
+
+""" Returns a function get_eri(p, q, r, s) giving the (broadcast) elements of the two-electron integrals.
+These are either passed as dense array, in the packed format (see pack_eri),
+or in factorized form as an array of shape (L, L, N_aux) (see AbInitioHamiltonianFactorized).
+A callable get_eri(p, q, r, s) is returned unchanged."""
+def get_eri_accessor(eri):
+    if callable(eri):
+        return eri
+    if eri.ndim == 4:
+        return lambda p, q, r, s: eri[p, q, r, s]
+    elif eri.ndim == 3:
+        return lambda p, q, r, s: jnp.sum(eri[p, q] * eri[r, s], axis=-1)
+    else:
+        return partial(get_packed_eri_element, eri)
+
+""" Returns the ratios exp(log_amps_connected - log_amp) of the amplitudes. If real_arithmetic is set, the amplitudes are
+assumed to be real (where a negative sign can be encoded by an imaginary part of pi in the log amplitudes), and the
+ratios are evaluated as real numbers without any complex exponentials."""
+def get_amplitude_ratios(log_amps_connected, log_amp, real_arithmetic=False):
+    log_ratios = log_amps_connected - log_amp
+    if real_arithmetic and jnp.iscomplexobj(log_ratios):
+        return jnp.exp(log_ratios.real) * jnp.cos(log_ratios.imag)
+    return jnp.exp(log_ratios)
+
+""" Returns True if the local energies of the operator can be evaluated fully in real arithmetic for the variational state.
+This is the case if the matrix elements of the operator are real, and the model specifies a real dtype and only has real
+parameters (so that the amplitudes are real)."""
+def use_real_arithmetic(vstate, op):
+    if jnp.iscomplexobj(np.empty(0, dtype=op.dtype)):
+        return False
+    model_dtype = getattr(vstate.model, "dtype", None)
+    if model_dtype is None or jnp.iscomplexobj(np.empty(0, dtype=model_dtype)):
+        return False
+    return not any(jnp.iscomplexobj(par) for par in jax.tree_util.tree_leaves(vstate.parameters))
+
+""" Returns all the diagonal contributions to the local energy of a sample (gathered from the precomputed Coulomb
+and exchange tables), as well as the Fock-like matrices giving the prefactors of the single excitations i -> a.
+For spin up these are given by
+t[i,a] + sum_{k occ} eri[i,a,k,k] + 0.5 * sum_{k up unocc} eri[i,k,k,a] - 0.5 * sum_{k up occ} eri[k,a,i,k]
+= h[i,a] + sum_k (n_up[k] + n_down[k]) eri[i,a,k,k] - sum_k n_up[k] eri[i,k,k,a],
+where we used the definition of t as well as the symmetry eri[k,a,i,k] = eri[i,k,k,a]."""
+def get_diagonal_energy_and_fock(args, is_occ_up, is_occ_down, up_occ_inds, down_occ_inds, up_unocc_inds, down_unocc_inds):
+    t, _, h, j_mat, k_mat, eri_j, eri_k = args
+    local_en = jnp.sum(t[up_occ_inds, up_occ_inds])
+    local_en += jnp.sum(t[down_occ_inds, down_occ_inds])
+    local_en += jnp.sum(j_mat[jnp.ix_(up_occ_inds, down_occ_inds)])
+    local_en += 0.5 * jnp.sum(j_mat[jnp.ix_(up_occ_inds, up_occ_inds)])
+    local_en += 0.5 * jnp.sum(k_mat[jnp.ix_(up_occ_inds, up_unocc_inds)])
+    local_en += 0.5 * jnp.sum(j_mat[jnp.ix_(down_occ_inds, down_occ_inds)])
+    local_en += 0.5 * jnp.sum(k_mat[jnp.ix_(down_occ_inds, down_unocc_inds)])
+
+    coulomb_contraction = eri_j.dot(is_occ_up + is_occ_down)
+    fock_up = h + coulomb_contraction - eri_k.dot(is_occ_up)
+    fock_down = h + coulomb_contraction - eri_k.dot(is_occ_down)
+    return local_en, fock_up, fock_down
+
+""" Local energy kernel based on a flat list of all the excitations of a sample.
+For each sample, first a (fixed size) table of the update sites, the new occupancies, the parities and the matrix elements
+of all single and double excitations is set up. The amplitudes of all connected configurations are then evaluated with one
+batched (fast updating) call of the model, and the local energy is obtained with a single contraction.
+All excitations are represented with four update sites. Single excitations, as well as the up-down double excitations
+acting on the same site twice, contain dummy updates (repeating a previous update site with its original occupancy)
+which do not affect the amplitude.
+Same-spin double excitations are only included once for each pair of (i<j, a<b), the matrix element is given by
+eri[i,a,j,b] - eri[i,b,j,a].
+If the flag return_local_RDMs is set to true, the evaluation is delegated to local_en_on_the_fly_blockwise.
+If real_arithmetic is set (see use_real_arithmetic), the amplitude ratios and the local energies are evaluated as real numbers.
+If mixed_precision is set, the model is evaluated in single precision (see get_mixed_precision_logpsi).
+The excitation_chunk_size specifies how many excitations of a sample are evaluated simultaneously,
+so that the peak memory is bounded by chunk_size * excitation_chunk_size connected configurations.
 """
+def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=False, chunk_size=None, return_local_RDMs=False, excitation_chunk_size=None,
+                        real_arithmetic=False, mixed_precision=False):
+    if return_local_RDMs:
+        return local_en_on_the_fly_blockwise(n_elecs, logpsi, pars, samples, args, use_fast_update=use_fast_update, chunk_size=chunk_size,
+                                             return_local_RDMs=True, excitation_chunk_size=excitation_chunk_size, real_arithmetic=real_arithmetic,
+                                             mixed_precision=mixed_precision)
+
+    if mixed_precision:
+        logpsi = get_mixed_precision_logpsi(logpsi)
+
+    get_eri = get_eri_accessor(args[1])
+    n_sites = samples.shape[-1]
+
+    def vmap_fun(sample):
+        sample = jnp.asarray(sample, jnp.uint8)
+        is_occ_up = (sample & 1)
+        is_occ_down = (sample & 2) >> 1
+        up_count = jnp.cumsum(is_occ_up, dtype=int)
+        down_count = jnp.cumsum(is_occ_down, dtype=int)
+        is_empty_up = 1 >> is_occ_up
+        is_empty_down = 1 >> is_occ_down
+
+        up_occ_inds, = jnp.nonzero(is_occ_up, size=n_elecs[0])
+        down_occ_inds, = jnp.nonzero(is_occ_down, size=n_elecs[1])
+        up_unocc_inds, = jnp.nonzero(is_empty_up, size=n_sites-n_elecs[0])
+        down_unocc_inds, = jnp.nonzero(is_empty_down, size=n_sites-n_elecs[1])
+
+        local_en, fock_up, fock_down = get_diagonal_energy_and_fock(args, is_occ_up, is_occ_down, up_occ_inds, down_occ_inds, up_unocc_inds, down_unocc_inds)
+
+        get_parity_multiplicators = jax.vmap(get_parity_multiplicator_hop, in_axes=(0, None))
+
+        def single_excitations(occ_inds, unocc_inds, spin_int, cumulative_count, fock):
+            i, a = [inds.flatten() for inds in jnp.meshgrid(occ_inds, unocc_inds, indexing="ij")]
+            update_sites = jnp.stack((i, a, i, a), axis=-1)
+            new_occ = jnp.stack((sample[i]-spin_int, sample[a]+spin_int, sample[i], sample[a]), axis=-1)
+            parity_multiplicator = get_parity_multiplicators(jnp.stack((i, a), axis=-1), cumulative_count)
+            return update_sites, new_occ, parity_multiplicator, fock[i, a]
+
+        def same_spin_double_excitations(occ_inds, unocc_inds, spin_int, cumulative_count):
+            occ_pairs = jnp.triu_indices(len(occ_inds), k=1)
+            unocc_pairs = jnp.triu_indices(len(unocc_inds), k=1)
+            occ_ids, unocc_ids = [inds.flatten() for inds in jnp.meshgrid(jnp.arange(len(occ_pairs[0])), jnp.arange(len(unocc_pairs[0])), indexing="ij")]
+            i = occ_inds[occ_pairs[0][occ_ids]]
+            j = occ_inds[occ_pairs[1][occ_ids]]
+            a = unocc_inds[unocc_pairs[0][unocc_ids]]
+            b = unocc_inds[unocc_pairs[1][unocc_ids]]
+            update_sites = jnp.stack((i, a, j, b), axis=-1)
+            new_occ = jnp.stack((sample[i]-spin_int, sample[a]+spin_int, sample[j]-spin_int, sample[b]+spin_int), axis=-1)
+
+            # Parity of the two hops, the second one corrected for the first hop
+            parity_multiplicator = get_parity_multiplicators(jnp.stack((i, a), axis=-1), cumulative_count)
+            parity_multiplicator *= get_parity_multiplicators(jnp.stack((j, b), axis=-1), cumulative_count)
+            left_lim = jnp.minimum(j, b)
+            right_lim = jnp.maximum(j, b) - 1
+            parity_multiplicator = jnp.where((i <= right_lim) & (i > left_lim), -parity_multiplicator, parity_multiplicator)
+            parity_multiplicator = jnp.where((a <= right_lim) & (a > left_lim), -parity_multiplicator, parity_multiplicator)
+            return update_sites, new_occ, parity_multiplicator, get_eri(i, a, j, b) - get_eri(i, b, j, a)
+
+        """ Adds an update of the given site to the updates, if the site is already updated, the occupancy of the first
+        update of this site is modified and a dummy update is appended (see also local_en_on_the_fly_blockwise)."""
+        def add_update(new_occ, update_sites, site_index, spin_update):
+            update_sites = jnp.append(update_sites, site_index)
+            new_occ = jnp.append(new_occ, sample[site_index])
+            first_matching_index = jnp.nonzero(update_sites == site_index, size=1)[0][0]
+            return new_occ.at[first_matching_index].add(spin_update), update_sites
+
+        def up_down_double_excitation(i, a, j, b):
+            new_occ, update_sites = add_update(jnp.array([sample[i]-1, sample[a]+1], dtype=jnp.uint8), jnp.array([i, a]), j, -2)
+            return add_update(new_occ, update_sites, b, 2)
+
+        def up_down_double_excitations():
+            i, a, j, b = [inds.flatten() for inds in jnp.meshgrid(up_occ_inds, up_unocc_inds, down_occ_inds, down_unocc_inds, indexing="ij")]
+            new_occ, update_sites = jax.vmap(up_down_double_excitation)(i, a, j, b)
+            parity_multiplicator = get_parity_multiplicators(jnp.stack((i, a), axis=-1), up_count)
+            parity_multiplicator *= get_parity_multiplicators(jnp.stack((j, b), axis=-1), down_count)
+            return update_sites, new_occ, parity_multiplicator, get_eri(i, a, j, b)
+
+        excitations = [single_excitations(up_occ_inds, up_unocc_inds, 1, up_count, fock_up),
+                       single_excitations(down_occ_inds, down_unocc_inds, 2, down_count, fock_down),
+                       same_spin_double_excitations(up_occ_inds, up_unocc_inds, 1, up_count),
+                       same_spin_double_excitations(down_occ_inds, down_unocc_inds, 2, down_count),
+                       up_down_double_excitations()]
+        update_sites, new_occ, parity_multiplicator, mels = [jnp.concatenate(table) for table in zip(*excitations)]
+        new_occ = new_occ.astype(jnp.uint8)
+
+        # Evaluate the amplitudes of all connected configurations
+        if use_fast_update:
+            log_amp, intermediates_cache = logpsi(pars, jnp.expand_dims(sample, 0), mutable="intermediates_cache", cache_intermediates=True)
+            parameters = {**pars, **intermediates_cache}
+            log_amps_connected = apply_batched_fast_updates(logpsi, parameters, new_occ, update_sites, excitation_chunk_size)
+        else:
+            log_amp = logpsi(pars, jnp.expand_dims(sample, 0))
+            def get_connected_log_amp(updated_occ_partial, update_sites):
+                # Reverse order so that the actual updates (which come first in the array) are applied and not the dummy updates
+                def scan_fun(carry, count):
+                    return (carry.at[update_sites[count]].set(updated_occ_partial[count]), None)
+                updated_config = jax.lax.scan(scan_fun, sample, jnp.arange(len(update_sites)), reverse=True)[0]
+                return logpsi(pars, jnp.expand_dims(updated_config, 0))
+            log_amps_connected = nkjax.vmap_chunked(get_connected_log_amp, in_axes=(0, 0), chunk_size=excitation_chunk_size)(new_occ, update_sites)
+        amp_ratios = get_amplitude_ratios(log_amps_connected.reshape(-1), log_amp, real_arithmetic)
+
+        return local_en + jnp.sum(mels * parity_multiplicator * amp_ratios)
+    return nkjax.vmap_chunked(vmap_fun, chunk_size=chunk_size)(samples)
+
+"""
+Blockwise evaluation of the local energy, where the contributions of the different excitation types are evaluated in separate
+loops (following the construction of the connected configurations in get_conn_flattened).
 If the flag return_local_RDMs is set to true, this function also returns objects resembling the 1-RDMS and 2-RDMS for the samples.
 In particular, two t_RDM and eri_RDM are evaluated for each sample which describe the linear dependency
 of the local energy on the t_mat and eri_mat, in the sense that local_en = np.sum(t_mat * t_RDM) + np.sum(eri_mat * eri_RDM).
 Storing these can be useful to interpolate between different calculations with analytic continuation type approaches.
+The excitation_chunk_size specifies how many excitations of a sample are evaluated simultaneously (see vmap_excitations),
+so that the peak memory is bounded by chunk_size * excitation_chunk_size connected configurations.
+If real_arithmetic is set (see use_real_arithmetic), the local energies and RDMs are evaluated as real numbers.
+If mixed_precision is set, the model is evaluated in single precision (see get_mixed_precision_logpsi).
 """
-def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=False, chunk_size=None, return_local_RDMs=False):
+def local_en_on_the_fly_blockwise(n_elecs, logpsi, pars, samples, args, use_fast_update=False, chunk_size=None, return_local_RDMs=False, excitation_chunk_size=None,
+                                  real_arithmetic=False, mixed_precision=False):
     t = args[0]
-    eri = args[1]
+    rdm_dtype = float if real_arithmetic else complex
+    if mixed_precision:
+        logpsi = get_mixed_precision_logpsi(logpsi)
 
     n_sites = samples.shape[-1]
+
+    get_eri = get_eri_accessor(args[1])
     def vmap_fun(sample):
         sample = jnp.asarray(sample, jnp.uint8)
         is_occ_up = (sample & 1)
@@ -235,18 +637,12 @@ def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=Fa
         as applied in the get_conn_flattened method which is maybe more readable. This is based
         on the approach as presented in [Neuscamman (2013), https://doi.org/10.1063/1.4829835]."""
 
-        # All the diagonal contributions
-        local_en = jnp.sum(t[up_occ_inds, up_occ_inds])
-        local_en += jnp.sum(t[down_occ_inds, down_occ_inds])
-        local_en += jnp.sum(eri[up_occ_inds, up_occ_inds, :, :][:, down_occ_inds, down_occ_inds])
-        local_en += 0.5 * jnp.sum(eri[up_occ_inds, up_occ_inds, :, :][:, up_occ_inds, up_occ_inds])
-        local_en += 0.5 * jnp.sum(eri[up_occ_inds, :, :, up_occ_inds][:, up_unocc_inds, up_unocc_inds])
-        local_en += 0.5 * jnp.sum(eri[down_occ_inds, down_occ_inds, :, :][:, down_occ_inds, down_occ_inds])
-        local_en += 0.5 * jnp.sum(eri[down_occ_inds, :, :, down_occ_inds][:, down_unocc_inds, down_unocc_inds])
+        # All the diagonal contributions and the Fock-like matrices for the single excitations
+        local_en, fock_up, fock_down = get_diagonal_energy_and_fock(args, is_occ_up, is_occ_down, up_occ_inds, down_occ_inds, up_unocc_inds, down_unocc_inds)
 
         if return_local_RDMs:
-            t_RDM = jnp.zeros(t.shape, dtype = complex)
-            eri_RDM = jnp.zeros(eri.shape, dtype = complex)
+            t_RDM = jnp.zeros(t.shape, dtype = rdm_dtype)
+            eri_RDM = jnp.zeros((n_sites,)*4, dtype = rdm_dtype)
             t_RDM = t_RDM.at[up_occ_inds, up_occ_inds].add(1)
             t_RDM = t_RDM.at[down_occ_inds, down_occ_inds].add(1)
 
@@ -316,27 +712,23 @@ def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=Fa
 
             # Evaluate amplitude ratio
             log_amp_connected = get_connected_log_amp(new_occ, update_sites)
-            amp_ratio = jnp.squeeze(jnp.exp(log_amp_connected - log_amp))
-            value = t[i, a]
-            value += jnp.sum(eri[i, a, up_occ_inds, up_occ_inds])
-            value += jnp.sum(eri[i, a, down_occ_inds, down_occ_inds])
-            value += 0.5 * jnp.sum(eri[i, up_unocc_inds, up_unocc_inds, a])
-            value -= 0.5 * jnp.sum(eri[up_occ_inds, a, i, up_occ_inds])
+            amp_ratio = jnp.squeeze(get_amplitude_ratios(log_amp_connected, log_amp, real_arithmetic))
+            value = fock_up[i, a]
             if return_local_RDMs:
                 t_contribution = amp_ratio * parity_multiplicator
-                eri_contribution_1 = jnp.zeros((eri.shape[2], eri.shape[3]), dtype=complex)
+                eri_contribution_1 = jnp.zeros((n_sites, n_sites), dtype=rdm_dtype)
                 eri_contribution_1 = eri_contribution_1.at[up_occ_inds, up_occ_inds].add(t_contribution)
                 eri_contribution_1 = eri_contribution_1.at[down_occ_inds, down_occ_inds].add(t_contribution)
-                eri_contribution_2 = jnp.zeros((eri.shape[1], eri.shape[2]), dtype=complex)
+                eri_contribution_2 = jnp.zeros((n_sites, n_sites), dtype=rdm_dtype)
                 eri_contribution_2 = eri_contribution_2.at[up_unocc_inds, up_unocc_inds].add(0.5 * t_contribution)
-                eri_contribution_3 = jnp.zeros((eri.shape[0], eri.shape[3]), dtype=complex)
+                eri_contribution_3 = jnp.zeros((n_sites, n_sites), dtype=rdm_dtype)
                 eri_contribution_3 = eri_contribution_3.at[up_occ_inds, up_occ_inds].add(-0.5 * t_contribution)
                 return value * t_contribution, t_contribution, eri_contribution_1, eri_contribution_2, eri_contribution_3
             else:
                 return value * amp_ratio * parity_multiplicator
 
         if return_local_RDMs:
-            val = jax.vmap(jax.vmap(get_one_body_term_up, in_axes=(None, 0)), in_axes=(0, None))(up_occ_inds, up_unocc_inds)
+            val = vmap_excitations(get_one_body_term_up, up_occ_inds, up_unocc_inds, excitation_chunk_size)
             local_en += jnp.sum(val[0])
             t_RDM = t_RDM.at[jnp.ix_(up_occ_inds, up_unocc_inds)].add(val[1])
             eri_RDM = eri_RDM.at[jnp.ix_(up_occ_inds, up_unocc_inds, jnp.arange(eri_RDM.shape[2]), jnp.arange(eri_RDM.shape[3]))].add(val[2])
@@ -347,7 +739,7 @@ def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=Fa
             ix = jnp.ix_(jnp.arange(eri_RDM.shape[1]), up_unocc_inds, up_occ_inds, jnp.arange(eri_RDM.shape[2]))
             eri_RDM = eri_RDM.at[ix].add(jnp.transpose(val[4], axes=(2, 1, 0, 3)))
         else:
-            local_en += jnp.sum(jax.vmap(jax.vmap(get_one_body_term_up, in_axes=(None, 0)), in_axes=(0, None))(up_occ_inds, up_unocc_inds))
+            local_en += jnp.sum(vmap_excitations(get_one_body_term_up, up_occ_inds, up_unocc_inds, excitation_chunk_size))
 
         def get_one_body_term_down(i, a):
             # Updated config at update sites
@@ -359,27 +751,23 @@ def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=Fa
 
             # Evaluate amplitude ratio
             log_amp_connected = get_connected_log_amp(new_occ, update_sites)
-            amp_ratio = jnp.squeeze(jnp.exp(log_amp_connected - log_amp))
-            value = t[i, a]
-            value += jnp.sum(eri[i, a, down_occ_inds, down_occ_inds])
-            value += jnp.sum(eri[i, a, up_occ_inds, up_occ_inds])
-            value += 0.5 * jnp.sum(eri[i, down_unocc_inds, down_unocc_inds, a])
-            value -= 0.5 * jnp.sum(eri[down_occ_inds, a, i, down_occ_inds])
+            amp_ratio = jnp.squeeze(get_amplitude_ratios(log_amp_connected, log_amp, real_arithmetic))
+            value = fock_down[i, a]
             if return_local_RDMs:
                 t_contribution = amp_ratio * parity_multiplicator
-                eri_contribution_1 = jnp.zeros((eri.shape[2], eri.shape[3]), dtype=complex)
+                eri_contribution_1 = jnp.zeros((n_sites, n_sites), dtype=rdm_dtype)
                 eri_contribution_1 = eri_contribution_1.at[down_occ_inds, down_occ_inds].add(t_contribution)
                 eri_contribution_1 = eri_contribution_1.at[up_occ_inds, up_occ_inds].add(t_contribution)
-                eri_contribution_2 = jnp.zeros((eri.shape[1], eri.shape[2]), dtype=complex)
+                eri_contribution_2 = jnp.zeros((n_sites, n_sites), dtype=rdm_dtype)
                 eri_contribution_2 = eri_contribution_2.at[down_unocc_inds, down_unocc_inds].add(0.5 * t_contribution)
-                eri_contribution_3 = jnp.zeros((eri.shape[0], eri.shape[3]), dtype=complex)
+                eri_contribution_3 = jnp.zeros((n_sites, n_sites), dtype=rdm_dtype)
                 eri_contribution_3 = eri_contribution_3.at[down_occ_inds, down_occ_inds].add(-0.5 * t_contribution)
                 return value * t_contribution, t_contribution, eri_contribution_1, eri_contribution_2, eri_contribution_3
             else:
                 return value * amp_ratio * parity_multiplicator
 
         if return_local_RDMs:
-            val = jax.vmap(jax.vmap(get_one_body_term_down, in_axes=(None, 0)), in_axes=(0, None))(down_occ_inds, down_unocc_inds)
+            val = vmap_excitations(get_one_body_term_down, down_occ_inds, down_unocc_inds, excitation_chunk_size)
             local_en += jnp.sum(val[0])
             t_RDM = t_RDM.at[jnp.ix_(down_occ_inds, down_unocc_inds)].add(val[1])
             eri_RDM = eri_RDM.at[jnp.ix_(down_occ_inds, down_unocc_inds, jnp.arange(eri_RDM.shape[2]), jnp.arange(eri_RDM.shape[3]))].add(val[2])
@@ -388,7 +776,7 @@ def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=Fa
             ix = jnp.ix_(jnp.arange(eri_RDM.shape[1]), down_unocc_inds, down_occ_inds, jnp.arange(eri_RDM.shape[2]))
             eri_RDM = eri_RDM.at[ix].add(jnp.transpose(val[4], axes=(2, 1, 0, 3)))
         else:
-            local_en += jnp.sum(jax.vmap(jax.vmap(get_one_body_term_down, in_axes=(None, 0)), in_axes=(0, None))(down_occ_inds, down_unocc_inds))
+            local_en += jnp.sum(vmap_excitations(get_one_body_term_down, down_occ_inds, down_unocc_inds, excitation_chunk_size))
 
         def two_body_up_up_occ(index_outer, val_outer):
             i = up_occ_inds[index_outer]
@@ -425,16 +813,16 @@ def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=Fa
 
                     # Get amplitude ratio
                     log_amp_connected = get_connected_log_amp(new_occ, update_sites)
-                    amp_ratio = jnp.squeeze(jnp.exp(log_amp_connected - log_amp))
+                    amp_ratio = jnp.squeeze(get_amplitude_ratios(log_amp_connected, log_amp, real_arithmetic))
 
                     return (parity_multiplicator * amp_ratio)
-                inner_loops = jax.vmap(jax.vmap(inner_loop, in_axes=(None, 0)), in_axes=(0, None))(occ_inds_outer_removed, unocc_inds_outer_removed)
+                inner_loops = vmap_excitations(inner_loop, occ_inds_outer_removed, unocc_inds_outer_removed, excitation_chunk_size)
                 if return_local_RDMs:
-                    en = val_inner[0] + 0.5 * jnp.sum(eri[jnp.ix_(jnp.array([i]),jnp.array([a]),occ_inds_outer_removed,unocc_inds_outer_removed)] * inner_loops)
+                    en = val_inner[0] + 0.5 * jnp.sum(get_eri(i, a, occ_inds_outer_removed[:, None], unocc_inds_outer_removed[None, :]) * inner_loops)
                     eri_RDM_contrib = val_inner[1].at[jnp.ix_(jnp.array([i]),jnp.array([a]),occ_inds_outer_removed,unocc_inds_outer_removed)].add(0.5 * inner_loops)
                     return en, eri_RDM_contrib
                 else:
-                    return val_inner + 0.5 * jnp.sum(eri[jnp.ix_(jnp.array([i]),jnp.array([a]),occ_inds_outer_removed,unocc_inds_outer_removed)] * inner_loops)
+                    return val_inner + 0.5 * jnp.sum(get_eri(i, a, occ_inds_outer_removed[:, None], unocc_inds_outer_removed[None, :]) * inner_loops)
             return jax.lax.fori_loop(0, len(up_unocc_inds), two_body_up_up_unocc, val_outer)
         if return_local_RDMs:
             local_en, eri_RDM = jax.lax.fori_loop(0, len(up_occ_inds), two_body_up_up_occ, (local_en, eri_RDM))
@@ -477,16 +865,16 @@ def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=Fa
 
                     # Get amplitude ratio
                     log_amp_connected = get_connected_log_amp(new_occ, update_sites)
-                    amp_ratio = jnp.squeeze(jnp.exp(log_amp_connected - log_amp))
+                    amp_ratio = jnp.squeeze(get_amplitude_ratios(log_amp_connected, log_amp, real_arithmetic))
 
                     return (parity_multiplicator * amp_ratio)
-                inner_loops = jax.vmap(jax.vmap(inner_loop, in_axes=(None, 0)), in_axes=(0, None))(occ_inds_outer_removed, unocc_inds_outer_removed)
+                inner_loops = vmap_excitations(inner_loop, occ_inds_outer_removed, unocc_inds_outer_removed, excitation_chunk_size)
                 if return_local_RDMs:
-                    en = val_inner[0] + 0.5 * jnp.sum(eri[jnp.ix_(jnp.array([i]),jnp.array([a]),occ_inds_outer_removed,unocc_inds_outer_removed)] * inner_loops)
+                    en = val_inner[0] + 0.5 * jnp.sum(get_eri(i, a, occ_inds_outer_removed[:, None], unocc_inds_outer_removed[None, :]) * inner_loops)
                     eri_RDM_contrib = val_inner[1].at[jnp.ix_(jnp.array([i]),jnp.array([a]),occ_inds_outer_removed,unocc_inds_outer_removed)].add(0.5 * inner_loops)
                     return en, eri_RDM_contrib
                 else:
-                    return val_inner + 0.5 * jnp.sum(eri[jnp.ix_(jnp.array([i]),jnp.array([a]),occ_inds_outer_removed,unocc_inds_outer_removed)] * inner_loops)
+                    return val_inner + 0.5 * jnp.sum(get_eri(i, a, occ_inds_outer_removed[:, None], unocc_inds_outer_removed[None, :]) * inner_loops)
             return jax.lax.fori_loop(0, len(down_unocc_inds), two_body_down_down_unocc, val_outer)
         if return_local_RDMs:
             local_en, eri_RDM = jax.lax.fori_loop(0, len(down_occ_inds), two_body_down_down_occ, (local_en, eri_RDM))
@@ -538,16 +926,16 @@ def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=Fa
 
                     # Get amplitude ratio
                     log_amp_connected = get_connected_log_amp(new_occ_final, update_sites_final)
-                    amp_ratio = jnp.squeeze(jnp.exp(log_amp_connected - log_amp))
+                    amp_ratio = jnp.squeeze(get_amplitude_ratios(log_amp_connected, log_amp, real_arithmetic))
 
                     return (parity_multiplicator * amp_ratio)
-                inner_loops = jax.vmap(jax.vmap(inner_loop, in_axes=(None, 0)), in_axes=(0, None))(down_occ_inds, down_unocc_inds)
+                inner_loops = vmap_excitations(inner_loop, down_occ_inds, down_unocc_inds, excitation_chunk_size)
                 if return_local_RDMs:
-                    en = val_inner[0] + jnp.sum(eri[jnp.ix_(jnp.array([i]),jnp.array([a]),down_occ_inds,down_unocc_inds)] * inner_loops)
+                    en = val_inner[0] + jnp.sum(get_eri(i, a, down_occ_inds[:, None], down_unocc_inds[None, :]) * inner_loops)
                     eri_RDM_contrib = val_inner[1].at[jnp.ix_(jnp.array([i]),jnp.array([a]),down_occ_inds,down_unocc_inds)].add(inner_loops)
                     return en, eri_RDM_contrib
                 else:
-                    return val_inner + jnp.sum(eri[jnp.ix_(jnp.array([i]),jnp.array([a]),down_occ_inds,down_unocc_inds)] * inner_loops)
+                    return val_inner + jnp.sum(get_eri(i, a, down_occ_inds[:, None], down_unocc_inds[None, :]) * inner_loops)
 
 
             return jax.lax.fori_loop(0, len(up_unocc_inds), two_body_up_down_unocc, val_outer)
@@ -565,9 +953,21 @@ def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=Fa
 @nk.vqs.get_local_kernel_arguments.dispatch
 def get_local_kernel_arguments(vstate: nk.vqs.MCState, op: AbInitioHamiltonianOnTheFly):
     samples = vstate.samples
-    t = jnp.array(op.t_mat)
-    eri = jnp.array(op.eri_mat)
-    return (samples, (t, eri))
+    # Arrays in shared memory are passed to the kernel without a copy (see to_device_array)
+    t = to_device_array(op.t_mat)
+    if isinstance(op, AbInitioHamiltonianFactorized):
+        # The auxiliary index is moved to the last axis so that the factors of an orbital pair are contiguous
+        eri = jnp.array(np.moveaxis(op.eri_factors, 0, -1))
+    elif op.eri_mat is None:
+        eri = to_device_array(op.eri_packed)
+    else:
+        eri = to_device_array(op.eri_mat)
+    h = to_device_array(op.h_mat)
+    j_mat = to_device_array(op.j_mat)
+    k_mat = to_device_array(op.k_mat)
+    eri_j = to_device_array(op.eri_j)
+    eri_k = to_device_array(op.eri_k)
+    return (samples, (t, eri, h, j_mat, k_mat, eri_j, eri_k))
 
 @nk.vqs.get_local_kernel.dispatch(precedence=1)
 def get_local_kernel(vstate: nk.vqs.MCState, op: AbInitioHamiltonianOnTheFly, chunk_size: Optional[int] = None):
@@ -575,4 +975,133 @@ def get_local_kernel(vstate: nk.vqs.MCState, op: AbInitioHamiltonianOnTheFly, ch
         use_fast_update = vstate.model.apply_fast_update
     except:
         use_fast_update = False
-    return nkjax.HashablePartial(local_en_on_the_fly, vstate.hilbert._n_elec, use_fast_update=use_fast_update, chunk_size=chunk_size)
+    return nkjax.HashablePartial(local_en_on_the_fly, vstate.hilbert._n_elec, use_fast_update=use_fast_update, chunk_size=chunk_size,
+                                 excitation_chunk_size=op.excitation_chunk_size, real_arithmetic=use_real_arithmetic(vstate, op),
+                                 mixed_precision=op.mixed_precision)
+
+"""
+Evaluates the (weighted) mean of the local energies, together with the (weighted) mean t_RDM and eri_RDM over the samples,
+which describe the linear dependency of the mean energy on the integrals, without storing the local RDMs of individual samples.
+The samples are processed in chunks of size chunk_size, and the weighted contributions of each chunk are directly
+scatter-added into the accumulators (as the derivatives of the weighted local energy sum with respect to the integrals).
+As the eri_RDM is only defined up to the permutation symmetries of the integrals, the (full or subset) eri_RDM is returned
+symmetrized over these (see symmetrize_eri_RDM), i.e. over the 8-fold symmetries for real integrals and over the exchange
+of the two index pairs for complex integrals. The t_RDM and the symmetrized eri_RDM are equal to the means of the local RDMs
+of local_en_on_the_fly_blockwise (after the same symmetrization of the eri_RDM).
+If orbital_subset is specified, only the elements of the RDMs with all indices in the subset are accumulated.
+If packed is set to True, the eri_RDM is accumulated in the packed format of the two-electron integrals (see pack_eri)
+where each packed element contains the sum over all the (symmetry equivalent) elements mapped to it,
+i.e. local_en = np.sum(t_mat * t_RDM) + np.sum(pack_eri(eri_mat) * eri_RDM). This requires real integrals.
+The weights (default: uniform over all samples) need to be normalized over all MPI ranks.
+If real_arithmetic is set (see use_real_arithmetic), all accumulators are real.
+"""
+@partial(jax.jit, static_argnums=(0, 1), static_argnames=("use_fast_update", "chunk_size", "packed", "excitation_chunk_size", "real_arithmetic",
+                                                       "mixed_precision"))
+def local_RDMs_accumulated(n_elecs, logpsi, pars, samples, args, weights=None, use_fast_update=False, chunk_size=None, orbital_subset=None, packed=False,
+                           excitation_chunk_size=None, real_arithmetic=False, mixed_precision=False):
+    rdm_dtype = float if real_arithmetic else complex
+    samples = samples.reshape((-1, samples.shape[-1]))
+    n_samples = samples.shape[0]
+    n_sites = samples.shape[-1]
+    if weights is None:
+        weights = jnp.ones(n_samples) / _mpi_sum(n_samples)
+
+    if chunk_size is None:
+        chunk_size = n_samples
+    n_chunks = -(-n_samples // chunk_size)
+
+    # Pad samples (with zero weight) so that all chunks are of the same size
+    padding = n_chunks * chunk_size - n_samples
+    samples = jnp.concatenate((samples, jnp.repeat(samples[:1], padding, axis=0)))
+    weights = jnp.concatenate((weights, jnp.zeros(padding, dtype=weights.dtype)))
+
+    # The accumulated RDMs are the derivatives of the weighted local energy sum with respect to the integrals, these are obtained
+    # from the flat kernel evaluated with the integrals shifted by (zero) perturbations. The eri perturbation is given in the
+    # layout of the accumulator, so that its (transposed) gathers scatter-add the weighted contributions directly into it.
+    if packed:
+        assert(orbital_subset is None)
+        n_pairs = (n_sites * (n_sites + 1))//2
+        eri_RDM_size = (n_pairs * (n_pairs + 1))//2
+        get_accumulator_index = lambda p, q, r, s: get_packed_eri_index(p, q, r, s)[0]
+    elif orbital_subset is not None:
+        n_subset = len(orbital_subset)
+        eri_RDM_size = n_subset**4
+        subset_ids = jnp.full(n_sites, -1, dtype=int).at[orbital_subset].set(jnp.arange(n_subset))
+        def get_accumulator_index(p, q, r, s):
+            p, q, r, s = subset_ids[p], subset_ids[q], subset_ids[r], subset_ids[s]
+            in_subset = (p >= 0) & (q >= 0) & (r >= 0) & (s >= 0)
+            # Elements outside of the subset are mapped out of bounds and dropped
+            return jnp.where(in_subset, ((p * n_subset + q) * n_subset + r) * n_subset + s, eri_RDM_size)
+    else:
+        eri_RDM_size = n_sites**4
+        get_accumulator_index = lambda p, q, r, s: ((p * n_sites + q) * n_sites + r) * n_sites + s
+
+    t, eri, h, j_mat, k_mat, eri_j, eri_k = args
+    get_eri = get_eri_accessor(eri)
+    p2, q2 = jnp.indices((n_sites,)*2, sparse=True)
+    p3, q3, r3 = jnp.indices((n_sites,)*3, sparse=True)
+
+    def weighted_local_en_sum(t_delta, eri_delta, chunk_samples, chunk_weights):
+        get_eri_delta = lambda p, q, r, s: jnp.take(eri_delta, get_accumulator_index(p, q, r, s), mode="fill", fill_value=0.)
+        eri_k_delta = get_eri_delta(p3, r3, r3, q3)
+        shifted_args = (t + t_delta, lambda p, q, r, s: get_eri(p, q, r, s) + get_eri_delta(p, q, r, s),
+                        h + t_delta + 0.5 * jnp.sum(eri_k_delta, axis=-1), j_mat + get_eri_delta(p2, p2, q2, q2),
+                        k_mat + get_eri_delta(p2, q2, q2, p2), eri_j + get_eri_delta(p3, q3, r3, r3), eri_k + eri_k_delta)
+        local_en = local_en_on_the_fly(n_elecs, logpsi, pars, chunk_samples, shifted_args, use_fast_update=use_fast_update,
+                                       excitation_chunk_size=excitation_chunk_size, real_arithmetic=real_arithmetic,
+                                       mixed_precision=mixed_precision)
+        return jnp.sum(chunk_weights * local_en)
+
+    t_delta = jnp.zeros((n_sites, n_sites), dtype=rdm_dtype)
+    eri_delta = jnp.zeros(eri_RDM_size, dtype=rdm_dtype)
+
+    def accumulate(carry, chunk):
+        local_en_mean, t_RDM_mean, eri_RDM_mean = carry
+        local_en_sum, vjp_fun = jax.vjp(lambda t_d, eri_d: weighted_local_en_sum(t_d, eri_d, *chunk), t_delta, eri_delta)
+        t_RDM, eri_RDM = vjp_fun(jnp.ones_like(local_en_sum))
+        return (local_en_mean + local_en_sum, t_RDM_mean + t_RDM, eri_RDM_mean + eri_RDM), None
+
+    chunks = (samples.reshape((n_chunks, chunk_size, n_sites)), weights.reshape((n_chunks, chunk_size)))
+    init = (jnp.array(0., dtype=rdm_dtype), t_delta, eri_delta)
+    (local_en_mean, t_RDM_mean, eri_RDM_mean), _ = jax.lax.scan(accumulate, init, chunks)
+
+    if orbital_subset is not None:
+        t_RDM_mean = t_RDM_mean[jnp.ix_(orbital_subset, orbital_subset)]
+    if not packed:
+        real_integrals = not any(jnp.iscomplexobj(arg) for arg in args)
+        eri_RDM_mean = symmetrize_eri_RDM(eri_RDM_mean.reshape((t_RDM_mean.shape[0],)*4), real_integrals=real_integrals)
+
+    return _mpi_sum_jax(local_en_mean)[0], _mpi_sum_jax(t_RDM_mean)[0], _mpi_sum_jax(eri_RDM_mean)[0]
+
+""" Symmetrizes the eri_RDM over the permutation symmetries of the integrals, i.e. over the 8-fold symmetries
+eri[p,q,r,s] = eri[q,p,s,r] = eri[r,s,p,q] = eri[p,q,s,r] = ... for real integrals and only over the exchange
+of the two index pairs, eri[p,q,r,s] = eri[r,s,p,q], otherwise. The contraction with symmetric integrals is unchanged. """
+def symmetrize_eri_RDM(eri_RDM, real_integrals=True, xp=jnp):
+    if real_integrals:
+        permutations = [(0, 1, 2, 3), (1, 0, 3, 2), (2, 3, 0, 1), (3, 2, 1, 0), (1, 0, 2, 3), (0, 1, 3, 2), (2, 3, 1, 0), (3, 2, 0, 1)]
+    else:
+        permutations = [(0, 1, 2, 3), (2, 3, 0, 1)]
+    return sum(xp.transpose(eri_RDM, permutation) for permutation in permutations) / len(permutations)
+
+""" Convenience function evaluating the mean energy and RDMs (see local_RDMs_accumulated) for a variational state.
+For states which provide sample counts (e.g. MCStateUniqueSamples), the samples are weighted by their counts.
+This relies on the RDM evaluation of local_en_on_the_fly and is therefore not available for the sparse Hamiltonian."""
+def get_accumulated_RDMs(vstate, op: AbInitioHamiltonianOnTheFly, chunk_size=None, orbital_subset=None, packed=False):
+    if packed:
+        assert(not np.iscomplexobj(op.h_mat) and not np.iscomplexobj(op.eri_j))
+    assert(not hasattr(op, "h2_nonzero_range"))
+    samples, args = get_local_kernel_arguments(vstate, op)
+    if hasattr(vstate, "samples_with_counts"):
+        samples, weights = vstate.samples_with_counts
+    else:
+        weights = None
+    try:
+        use_fast_update = vstate.model.apply_fast_update
+    except:
+        use_fast_update = False
+    if orbital_subset is not None:
+        orbital_subset = jnp.array(orbital_subset)
+    return local_RDMs_accumulated(tuple(vstate.hilbert._n_elec), vstate._apply_fun, vstate.variables, samples, args, weights=weights,
+                                  use_fast_update=use_fast_update, chunk_size=chunk_size, orbital_subset=orbital_subset, packed=packed,
+                                  excitation_chunk_size=op.excitation_chunk_size, real_arithmetic=use_real_arithmetic(vstate, op),
+                                  mixed_precision=op.mixed_precision)
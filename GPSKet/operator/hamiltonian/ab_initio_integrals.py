@@ -0,0 +1,161 @@
+import numpy as np
+import re
+
+from itertools import islice
+
+from GPSKet.hilbert.discrete_fermion import FermionicDiscreteHilbert
+from GPSKet.operator.hamiltonian.ab_initio import AbInitioHamiltonianOnTheFly, AbInitioHamiltonianFactorized, get_packed_eri_index, unpack_eri, cholesky_decompose_eri
+from GPSKet.operator.hamiltonian.ab_initio_sparse import AbInitioHamiltonianSparse
+
+"""
+Loaders for the one- and two-electron integrals (in chemists' notation) which directly set up the ab initio Hamiltonians
+without ever constructing (or communicating) the dense two-electron integrals. The integrals are read in chunks
+(the files are not memory-mapped, only the current chunk and the packed integrals are held in memory) and written into
+the packed 8-fold symmetric format (see pack_eri), where all integrals with magnitude not larger than threshold are discarded. This requires real integrals. As all MPI ranks read the integrals from the file themselves,
+no broadcast of the integrals is required.
+"""
+
+""" Writes the (chunk of) integrals eri[p,q,r,s] = values into the packed array, discarding values below the threshold. """
+def _add_to_packed(eri_packed, p, q, r, s, values, threshold):
+    values = np.where(abs(values) > threshold, values, 0.)
+    eri_packed[get_packed_eri_index(p, q, r, s, xp=np)[0]] = values
+
+"""
+Reads the integrals from a file in the FCIDUMP format, streaming through the file in chunks of chunk_size lines.
+Returns the one-electron integrals h1, the packed two-electron integrals, the core energy as well as the
+number of up and down electrons (as specified in the header).
+"""
+def read_fcidump(filename, threshold=0., chunk_size=2**20):
+    with open(filename, "r") as file:
+        header = ""
+        for line in file:
+            header += line
+            if "&END" in line.upper() or line.strip() == "/":
+                break
+        header = header.upper()
+        n_orbs = int(re.search(r"NORB\s*=\s*(\d+)", header).group(1))
+        n_elec = int(re.search(r"NELEC\s*=\s*(\d+)", header).group(1))
+        ms2 = re.search(r"MS2\s*=\s*(-?\d+)", header)
+        ms2 = int(ms2.group(1)) if ms2 is not None else 0
+
+        n_pairs = (n_orbs * (n_orbs + 1))//2
+        h1 = np.zeros((n_orbs, n_orbs))
+        eri_packed = np.zeros((n_pairs * (n_pairs + 1))//2)
+        core_energy = 0.
+
+        while True:
+            # Fortran style exponents are converted
+            lines = [line.replace("D", "E").replace("d", "e") for line in islice(file, chunk_size)]
+            if len(lines) == 0:
+                break
+            data = np.loadtxt(lines, ndmin=2)
+            values = data[:, 0]
+            i, j, k, l = (data[:, 1:].astype(int) - 1).T
+
+            two_body = (k >= 0)
+            _add_to_packed(eri_packed, i[two_body], j[two_body], k[two_body], l[two_body], values[two_body], threshold)
+
+            one_body = (k < 0) & (j >= 0)
+            h1[i[one_body], j[one_body]] = values[one_body]
+            h1[j[one_body], i[one_body]] = values[one_body]
+
+            core_energy += np.sum(values[i < 0])
+
+    return h1, eri_packed, core_energy, ((n_elec + ms2)//2, (n_elec - ms2)//2)
+
+"""
+Reads the integrals from a HDF5 file (this requires h5py). The one-electron integrals are read from the dataset h1_key,
+the two-electron integrals from the dataset eri_key, which can either hold the full integrals (shape (L, L, L, L)),
+the 4-fold symmetric integrals over the lower triangular orbital pairs (shape (T, T) with T = L*(L+1)/2, as written e.g.
+by pyscf.ao2mo) or the 8-fold packed integrals (shape (T*(T+1)/2,)). The datasets are read in chunks of (approximately)
+chunk_size elements. Returns the one-electron integrals h1, the packed two-electron integrals, and the core energy
+(read from the dataset core_energy_key if present, zero otherwise).
+"""
+def read_hdf5_integrals(filename, threshold=0., chunk_size=2**20, h1_key="h1", eri_key="eri", core_energy_key="core_energy"):
+    import h5py
+
+    with h5py.File(filename, "r") as file:
+        h1 = np.array(file[h1_key])
+        assert(not np.iscomplexobj(h1) and not np.iscomplexobj(file[eri_key]))
+        n_orbs = h1.shape[0]
+        n_pairs = (n_orbs * (n_orbs + 1))//2
+        eri_packed = np.zeros((n_pairs * (n_pairs + 1))//2, dtype=h1.dtype)
+        eri = file[eri_key]
+        if eri.ndim == 4:
+            n_rows = max(chunk_size // n_orbs**3, 1)
+            for start in range(0, n_orbs, n_rows):
+                chunk = np.array(eri[start:start+n_rows])
+                p, q, r, s = np.indices(chunk.shape)
+                _add_to_packed(eri_packed, p.flatten() + start, q.flatten(), r.flatten(), s.flatten(), chunk.flatten(), threshold)
+        elif eri.ndim == 2:
+            n_rows = max(chunk_size // n_pairs, 1)
+            for start in range(0, n_pairs, n_rows):
+                chunk = np.array(eri[start:start+n_rows])
+                first, second = np.indices(chunk.shape)
+                first += start
+                lower = (second <= first)
+                packed_ids = (first[lower] * (first[lower] + 1))//2 + second[lower]
+                eri_packed[packed_ids] = np.where(abs(chunk[lower]) > threshold, chunk[lower], 0.)
+        else:
+            for start in range(0, len(eri_packed), chunk_size):
+                chunk = np.array(eri[start:start+chunk_size])
+                eri_packed[start:start+chunk_size] = np.where(abs(chunk) > threshold, chunk, 0.)
+        if core_energy_key in file:
+            core_energy = float(np.array(file[core_energy_key]))
+        else:
+            core_energy = 0.
+    return h1, eri_packed, core_energy
+
+""" Returns the COO list (indices of shape (N, 4) and values) of all nonzero elements eri[i,a,j,b] of the packed integrals. """
+def packed_eri_to_coo(eri_packed, n_orbs):
+    p, q = np.tril_indices(n_orbs)
+    packed_ids = np.nonzero(eri_packed)[0]
+    first = ((np.sqrt(8 * packed_ids + 1) - 1)//2).astype(int)
+    # Correct for possible rounding errors
+    first -= ((first * (first + 1))//2 > packed_ids)
+    first += (((first + 1) * (first + 2))//2 <= packed_ids)
+    second = packed_ids - (first * (first + 1))//2
+    i, a, j, b = p[first], q[first], p[second], q[second]
+    indices = np.concatenate([np.stack(perm, axis=-1) for perm in [(i, a, j, b), (a, i, j, b), (i, a, b, j), (a, i, b, j),
+                                                                    (j, b, i, a), (b, j, i, a), (j, b, a, i), (b, j, a, i)]])
+    indices = np.unique(indices, axis=0).astype(np.int32)
+    return indices, eri_packed[get_packed_eri_index(*indices.T, xp=np)[0]]
+
+"""
+Loads the integrals from a file (either in the FCIDUMP or the HDF5 format, by default inferred from the file extension)
+and directly sets up the ab initio Hamiltonian of the specified type. Possible types are
+"packed": AbInitioHamiltonianOnTheFly with the packed integrals,
+"dense": AbInitioHamiltonianOnTheFly with the dense integrals,
+"sparse": AbInitioHamiltonianSparse (set up from the COO list of the nonzero integrals),
+"factorized": AbInitioHamiltonianFactorized (from a pivoted Cholesky decomposition of the packed integrals up to cholesky_threshold).
+If no hilbert space is given, it is constructed from the number of electrons specified in the FCIDUMP header.
+Additional keyword arguments are passed to the constructor of the Hamiltonian.
+Returns the Hamiltonian and the core energy.
+"""
+def load_ab_initio_hamiltonian(filename, hilbert=None, hamiltonian_type="packed", file_format=None, threshold=0., chunk_size=2**20,
+                               cholesky_threshold=1.e-8, **kwargs):
+    if file_format is None:
+        file_format = "hdf5" if filename.lower().endswith((".h5", ".hdf5")) else "fcidump"
+    if file_format == "fcidump":
+        h1, eri_packed, core_energy, n_elec = read_fcidump(filename, threshold=threshold, chunk_size=chunk_size)
+    else:
+        assert(file_format == "hdf5")
+        h1, eri_packed, core_energy = read_hdf5_integrals(filename, threshold=threshold, chunk_size=chunk_size)
+        n_elec = None
+    n_orbs = h1.shape[0]
+
+    if hilbert is None:
+        assert(n_elec is not None)
+        hilbert = FermionicDiscreteHilbert(n_orbs, n_elec=n_elec)
+
+    if hamiltonian_type == "packed":
+        ha = AbInitioHamiltonianOnTheFly(hilbert, h1, None, eri_packed=eri_packed, **kwargs)
+    elif hamiltonian_type == "dense":
+        ha = AbInitioHamiltonianOnTheFly(hilbert, h1, unpack_eri(eri_packed, n_orbs), **kwargs)
+    elif hamiltonian_type == "sparse":
+        ha = AbInitioHamiltonianSparse(hilbert, h1, None, eri_coo=packed_eri_to_coo(eri_packed, n_orbs), **kwargs)
+    else:
+        assert(hamiltonian_type == "factorized")
+        eri_factors = cholesky_decompose_eri(eri_packed, threshold=cholesky_threshold, n_orbs=n_orbs)
+        ha = AbInitioHamiltonianFactorized(hilbert, h1, eri_factors, **kwargs)
+    return ha, core_energy
@@ -9,21 +9,71 @@ from typing import Optional
 
 from functools import partial
 
-from GPSKet.operator.hamiltonian.ab_initio import AbInitioHamiltonianOnTheFly, get_parity_multiplicator_hop
+from GPSKet.operator.hamiltonian.ab_initio import AbInitioHamiltonianOnTheFly, get_parity_multiplicator_hop, get_amplitude_ratios, use_real_arithmetic
 
 from netket.utils.types import DType
 from GPSKet.operator.fermion import FermionicDiscreteOperator, apply_hopping
+from GPSKet.operator.hamiltonian.shared_memory import move_attributes_to_shared_memory, to_device_array
+from GPSKet.operator.hamiltonian.mixed_precision import get_mixed_precision_logpsi
 from GPSKet.models import qGPS
 
 class AbInitioHamiltonianSparse(AbInitioHamiltonianOnTheFly):
     """ Implementation of an ab initio Hamiltonian utilizing sparse structure in the
     one- and two-electron integrals. If a localized basis is used, this gives a reduction to O(N^2)
-    terms which need to be evaluated for each local energy. Currently, the sparse structure is set
-    up in the constructor resulting in a bit of memory overhead.
-    TODO: Improve memory footprint.
+    terms which need to be evaluated for each local energy. The sparse structure is set up
+    in the constructor, where all integrals with magnitude not larger than the pruning_threshold are discarded.
+    Instead of the dense eri_mat, the two-electron integrals can also be specified as a (thresholded) COO list
+    eri_coo = (indices, values), where indices is an array of shape (N, 4) holding the index tuples (i,a,j,b)
+    of all nonzero elements eri[i,a,j,b] (i.e. including all elements related by permutation symmetry),
+    in which case the dense eri_mat is never constructed (apart from explicitly generating connected configurations).
+
+    If a screening_threshold is specified, the local energy is evaluated with a semistochastic
+    (heat-bath style) estimator. All double excitations with |eri[i,a,j,b]| >= screening_threshold
+    are evaluated exactly, and the contribution of the remaining excitations is estimated
+    (without bias) from n_stochastic_excitations excitations per sample which are drawn with a
+    probability proportional to |eri[i,a,j,b]|. If n_stochastic_excitations is zero, the
+    screened-out excitations are simply neglected.
+
+    The excitation_chunk_size specifies how many occupied (i,j) pairs of a sample are processed
+    simultaneously in the local energy evaluation.
+
+    If use_flat_work_list is set, the exactly evaluated two-body terms are not computed in a loop over the
+    entries of each occupied (i,j) pair, but all entries of all occupied pairs of a sample are enumerated into a
+    single list (padded to a fixed size, see get_max_work_list_size) and evaluated together. This avoids the
+    padding of the loops to the longest row (under vmap) if the number of entries varies strongly between pairs
+    (the excitation_chunk_size then specifies the number of list entries evaluated simultaneously).
+
+    If mixed_precision is set, the model is evaluated in single precision in the local energy evaluation
+    (see get_mixed_precision_logpsi), while the local energies are accumulated in double precision.
+
+    If use_shared_memory is set, all the arrays are stored in MPI-3 shared memory windows (one copy per node, see
+    move_attributes_to_shared_memory), which are passed to the local energy kernel without a copy.
     """
-    def __init__(self, hilbert, h_mat, eri_mat):
-        super().__init__(hilbert, h_mat, eri_mat)
+    def __init__(self, hilbert, h_mat, eri_mat=None, screening_threshold=None, n_stochastic_excitations=8, excitation_chunk_size=None,
+                 pruning_threshold=0., eri_coo=None, use_flat_work_list=False, mixed_precision=False, use_shared_memory=False):
+        if eri_mat is not None:
+            super().__init__(hilbert, h_mat, eri_mat, excitation_chunk_size=excitation_chunk_size, mixed_precision=mixed_precision)
+            eri_coo_ids = np.array(np.nonzero(abs(eri_mat) > pruning_threshold), dtype=np.int32).T
+            eri_coo_vals = eri_mat[tuple(eri_coo_ids.T)]
+        else:
+            assert(hilbert._n_elec is not None)
+            FermionicDiscreteOperator.__init__(self, hilbert)
+            self.excitation_chunk_size = excitation_chunk_size
+            self.mixed_precision = mixed_precision
+            self.h_mat = h_mat
+            self.eri_mat = None
+            self.eri_packed = None
+            eri_coo_ids = np.asarray(eri_coo[0], dtype=np.int32)
+            eri_coo_vals = np.asarray(eri_coo[1])
+            pruned = abs(eri_coo_vals) > pruning_threshold
+            eri_coo_ids = eri_coo_ids[pruned]
+            eri_coo_vals = eri_coo_vals[pruned]
+            self._set_up_tables_from_coo(eri_coo_ids, eri_coo_vals)
+
+        self.screening_threshold = screening_threshold
+        self.n_stochastic_excitations = n_stochastic_excitations
+        self.pruning_threshold = pruning_threshold
+        self.use_flat_work_list = use_flat_work_list
 
         # Set up the sparse structure
 
@@ -35,16 +85,11 @@ class AbInitioHamiltonianSparse(AbInitioHamiltonianOnTheFly):
         non_zero_ids(i) = non_zero_ids_flattened[start_id[i]:end_id[i]]
         non_zero_vals(i) = non_zero_vals_flattened[start_id[i]:end_id[i]]
         """
-        self.h1_nonzero_range = np.zeros(self.h_mat.shape[0]+1, dtype=int)
-        self.h1_nonzero_ids_flat = np.zeros(0, dtype=int)
-        self.h1_nonzero_vals_flat = np.zeros(0, dtype=self.h_mat.dtype)
-
-        # Construct flattened arrays
-        for i in range(self.h_mat.shape[0]):
-            nonzeros = np.nonzero(self.h_mat[i,:])[0]
-            self.h1_nonzero_range[i+1] = self.h1_nonzero_range[i] + len(nonzeros)
-            self.h1_nonzero_ids_flat = np.append(self.h1_nonzero_ids_flat, nonzeros)
-            self.h1_nonzero_vals_flat = np.append(self.h1_nonzero_vals_flat, self.h_mat[i,nonzeros])
+        n_orbs = self.h_mat.shape[0]
+        h1_nonzeros = np.nonzero(abs(self.h_mat) > pruning_threshold)
+        self.h1_nonzero_range = get_csr_range(h1_nonzeros[0], n_orbs)
+        self.h1_nonzero_ids_flat = h1_nonzeros[1].astype(np.int32)
+        self.h1_nonzero_vals_flat = self.h_mat[h1_nonzeros]
 
         """
         Start/end ids into the flattened arrays holding the nonzero
@@ -53,22 +98,104 @@ class AbInitioHamiltonianSparse(AbInitioHamiltonianOnTheFly):
         end_id[i,j] = self.h2_nonzero_start[i, j+1]
         non_zero_ids(i,j) = non_zero_ids_flattened[start_id[i,j]:end_id[i,j]] -> index pair(a,b)
         non_zero_vals(i,j) = non_zero_vals_flattened[start_id[i,j]:end_id[i,j]]
+        (where the last end id of a row i is stored in self.h2_nonzero_start[i, L])
+        """
+        # Sort the elements by the (i,j) pair (and then by a and b)
+        i, a, j, b = eri_coo_ids.T
+        sorting = np.lexsort((b, a, j, i))
+        pair_ids = (i * n_orbs + j)[sorting]
+        self.h2_nonzero_ids_flat = np.stack((a[sorting], b[sorting]), axis=-1)
+        self.h2_nonzero_vals_flat = eri_coo_vals[sorting]
+        pair_range = get_csr_range(pair_ids, n_orbs * n_orbs)
+        self.h2_nonzero_range = np.concatenate((pair_range[:-1].reshape((n_orbs, n_orbs)), pair_range[n_orbs::n_orbs].reshape((n_orbs, 1))), axis=1)
+
+        self._set_up_screening()
+
+        if use_shared_memory:
+            move_attributes_to_shared_memory(self)
+
+    def _set_up_tables_from_coo(self, eri_coo_ids, eri_coo_vals):
+        """
+        Sets up t_mat and the Coulomb and exchange tables (see AbInitioHamiltonian) from the COO list of the integrals.
+        """
+        n_orbs = self.h_mat.shape[0]
+        dtype = np.result_type(self.h_mat, eri_coo_vals)
+        i, a, j, b = eri_coo_ids.T
+        self.t_mat = np.array(self.h_mat, dtype=dtype)
+        self.j_mat = np.zeros((n_orbs, n_orbs), dtype=dtype)
+        self.k_mat = np.zeros((n_orbs, n_orbs), dtype=dtype)
+        self.eri_j = np.zeros((n_orbs, n_orbs, n_orbs), dtype=dtype)
+        self.eri_k = np.zeros((n_orbs, n_orbs, n_orbs), dtype=dtype)
+        selection = (a == j)
+        np.add.at(self.t_mat, (i[selection], b[selection]), -0.5 * eri_coo_vals[selection])
+        np.add.at(self.eri_k, (i[selection], b[selection], a[selection]), eri_coo_vals[selection])
+        selection = (i == a) & (j == b)
+        np.add.at(self.j_mat, (i[selection], j[selection]), eri_coo_vals[selection])
+        selection = (a == j) & (b == i)
+        np.add.at(self.k_mat, (i[selection], a[selection]), eri_coo_vals[selection])
+        selection = (j == b)
+        np.add.at(self.eri_j, (i[selection], a[selection], j[selection]), eri_coo_vals[selection])
+
+    def get_max_work_list_size(self):
+        """
+        Upper bound for the number of exactly evaluated two-body entries of all occupied (i,j) pairs of any configuration,
+        given by the sum over the largest rows for the same-spin pairs (with i<j) and the opposite-spin pairs respectively.
+        """
+        n_up, n_down = self.hilbert._n_elec
+        row_lengths = self.h2_screened_end - self.h2_nonzero_range[:, :-1]
+        same_spin_lengths = np.sort(row_lengths[np.triu_indices(row_lengths.shape[0], k=1)])[::-1]
+        all_lengths = np.sort(row_lengths.flatten())[::-1]
+        max_size = np.sum(same_spin_lengths[:(n_up * (n_up - 1))//2]) + np.sum(same_spin_lengths[:(n_down * (n_down - 1))//2])
+        max_size += np.sum(all_lengths[:n_up * n_down])
+        return int(max_size)
+
+    def get_dense_eri(self):
+        if self.eri_mat is None:
+            n_orbs = self.h_mat.shape[0]
+            eri_mat = np.zeros((n_orbs,)*4, dtype=self.h2_nonzero_vals_flat.dtype)
+            pair_ids = np.repeat(np.arange(n_orbs * n_orbs), np.diff(self.h2_nonzero_range, axis=1).flatten())
+            eri_mat[pair_ids // n_orbs, self.h2_nonzero_ids_flat[:, 0], pair_ids % n_orbs, self.h2_nonzero_ids_flat[:, 1]] = self.h2_nonzero_vals_flat
+            return eri_mat
+        else:
+            return self.eri_mat
+
+    def _set_up_screening(self):
+        """
+        Sorts the entries for each (i,j) pair by decreasing magnitude and sets up the arrays for the screening.
+        h2_screened_end[i,j] is the end id (into the flattened arrays) of the exactly evaluated entries of the (i,j) pair,
+        all following entries up to the end of the pair range are treated stochastically.
+        h2_stochastic_weights[i,j] is the sum of the absolute values of the stochastically treated entries of the (i,j) pair and
+        h2_stochastic_cumsum is the cumulative sum of the absolute values of all stochastically treated entries
+        (with a leading zero), used to sample the excitations by inverse transform sampling.
         """
-        self.h2_nonzero_range = np.zeros((self.eri_mat.shape[0], self.eri_mat.shape[2]+1), dtype=int)
-        self.h2_nonzero_ids_flat = np.zeros((0,2), dtype=int)
-        self.h2_nonzero_vals_flat = np.zeros(0, dtype=self.eri_mat.dtype)
-
-        # Construct flattened arrays
-        for i in range(self.eri_mat.shape[0]):
-            for j in range(self.eri_mat.shape[2]):
-                nonzeros = np.array(np.nonzero(self.eri_mat[i,:, j, :]))
-                self.h2_nonzero_range[i,j+1] = self.h2_nonzero_range[i,j] + nonzeros.shape[1]
-                if j == self.eri_mat.shape[2]-1 and i != self.eri_mat.shape[0]-1:
-                    self.h2_nonzero_range[i+1,0] = self.h2_nonzero_range[i,j] + nonzeros.shape[1]
-                self.h2_nonzero_ids_flat = np.append(self.h2_nonzero_ids_flat, nonzeros.T, axis=0)
-                self.h2_nonzero_vals_flat = np.append(self.h2_nonzero_vals_flat, self.eri_mat[i,nonzeros[0,:], j, nonzeros[1,:]])
-
-def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=False, chunk_size=None):
+        n_orbs = self.h_mat.shape[0]
+        row_ids = np.repeat(np.arange(n_orbs * n_orbs), np.diff(self.h2_nonzero_range, axis=1).flatten())
+        abs_vals = abs(self.h2_nonzero_vals_flat)
+        sorting = np.lexsort((-abs_vals, row_ids))
+        self.h2_nonzero_ids_flat = self.h2_nonzero_ids_flat[sorting]
+        self.h2_nonzero_vals_flat = self.h2_nonzero_vals_flat[sorting]
+        abs_vals = abs_vals[sorting]
+
+        if self.screening_threshold is None:
+            exact = np.ones(len(abs_vals), dtype=bool)
+        else:
+            exact = abs_vals >= self.screening_threshold
+        n_exact = np.bincount(row_ids, weights=exact, minlength=n_orbs * n_orbs).astype(int)
+        self.h2_screened_end = (self.h2_nonzero_range[:, :-1] + n_exact.reshape((n_orbs, n_orbs))).astype(np.int32)
+
+        stochastic_vals = np.where(exact, 0., abs_vals)
+        self.h2_stochastic_weights = np.bincount(row_ids, weights=stochastic_vals, minlength=n_orbs * n_orbs).reshape((n_orbs, n_orbs))
+        self.h2_stochastic_cumsum = np.concatenate((np.zeros(1), np.cumsum(stochastic_vals)))
+
+""" Returns the (CSR style) range array for the sorted row ids of the nonzero elements, i.e. the elements of row k
+are stored at positions range[k]:range[k+1] of the flattened arrays."""
+def get_csr_range(row_ids, n_rows):
+    csr_range = np.zeros(n_rows + 1, dtype=np.int32)
+    np.cumsum(np.bincount(row_ids, minlength=n_rows), out=csr_range[1:])
+    return csr_range
+
+def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=False, chunk_size=None, n_stochastic_excitations=0, excitation_chunk_size=None,
+                        max_work_list_size=None, real_arithmetic=False, mixed_precision=False):
     h1_nonzero_range = args[0]
     h1_nonzero_ids_flat = args[1]
     h1_nonzero_vals_flat = args[2]
@@ -76,9 +203,19 @@ def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=Fa
     h2_nonzero_range = args[3]
     h2_nonzero_ids_flat = args[4]
     h2_nonzero_vals_flat = args[5]
+    h2_screened_end = args[6]
+
+    # Arguments for the stochastic estimate of the screened contributions
+    if n_stochastic_excitations > 0:
+        h2_stochastic_weights = args[7]
+        h2_stochastic_cumsum = args[8]
+        stochastic_key = args[9]
+
+    if mixed_precision:
+        logpsi = get_mixed_precision_logpsi(logpsi)
 
     n_sites = samples.shape[-1]
-    def vmap_fun(sample):
+    def vmap_fun(sample, key):
         sample = jnp.asarray(sample, jnp.uint8)
         is_occ_up = (sample & 1)
         is_occ_down = (sample & 2) >> 1
@@ -99,6 +236,9 @@ def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=Fa
         else:
             log_amp = logpsi(pars, jnp.expand_dims(sample, 0))
 
+        # Dtype of the amplitude ratios (real if real_arithmetic is set, see use_real_arithmetic, and complex otherwise)
+        amp_dtype = log_amp.real.dtype if real_arithmetic else jnp.promote_types(log_amp.dtype, jnp.complex64)
+
         """ This function returns the log_amp of the connected configuration which is only specified
         by the occupancy on the updated sites as well as the indices of the sites updated."""
         def get_connected_log_amp(updated_occ_partial, update_sites):
@@ -130,12 +270,12 @@ def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=Fa
                     parity_multiplicator = get_parity_multiplicator_hop(update_sites, up_count)
                     # Evaluate amplitude ratio
                     log_amp_connected = get_connected_log_amp(new_occ, update_sites)
-                    amp_ratio = jnp.squeeze(jnp.exp(log_amp_connected - log_amp))
-                    return (amp_ratio * parity_multiplicator)
+                    amp_ratio = jnp.squeeze(get_amplitude_ratios(log_amp_connected, log_amp, real_arithmetic))
+                    return (amp_ratio * parity_multiplicator).astype(amp_dtype)
                 def invalid_hop():
-                    return jax.lax.select(i==a, jnp.array(1, dtype=log_amp.dtype), jnp.array(0, dtype=log_amp.dtype))
+                    return jax.lax.select(i==a, jnp.array(1, dtype=amp_dtype), jnp.array(0, dtype=amp_dtype))
                 return val + h1_nonzero_vals_flat[a_index] * jax.lax.cond(is_empty_up[a], valid_hop, invalid_hop)
-            return jax.lax.fori_loop(h1_nonzero_range[i], h1_nonzero_range[i+1], inner_loop, jnp.array(0, dtype=log_amp.dtype))
+            return jax.lax.fori_loop(h1_nonzero_range[i], h1_nonzero_range[i+1], inner_loop, jnp.array(0, dtype=amp_dtype))
 
         local_en = jnp.sum(jax.vmap(compute_1B_up)(up_occ_inds))
 
@@ -150,12 +290,12 @@ def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=Fa
                     parity_multiplicator = get_parity_multiplicator_hop(update_sites, down_count)
                     # Evaluate amplitude ratio
                     log_amp_connected = get_connected_log_amp(new_occ, update_sites)
-                    amp_ratio = jnp.squeeze(jnp.exp(log_amp_connected - log_amp))
-                    return (amp_ratio * parity_multiplicator)
+                    amp_ratio = jnp.squeeze(get_amplitude_ratios(log_amp_connected, log_amp, real_arithmetic))
+                    return (amp_ratio * parity_multiplicator).astype(amp_dtype)
                 def invalid_hop():
-                    return jax.lax.select(i==a, jnp.array(1, dtype=log_amp.dtype), jnp.array(0, dtype=log_amp.dtype))
+                    return jax.lax.select(i==a, jnp.array(1, dtype=amp_dtype), jnp.array(0, dtype=amp_dtype))
                 return val + h1_nonzero_vals_flat[a_index] * jax.lax.cond(is_empty_down[a], valid_hop, invalid_hop)
-            return jax.lax.fori_loop(h1_nonzero_range[i], h1_nonzero_range[i+1], inner_loop, jnp.array(0, dtype=log_amp.dtype))
+            return jax.lax.fori_loop(h1_nonzero_range[i], h1_nonzero_range[i+1], inner_loop, jnp.array(0, dtype=amp_dtype))
 
         local_en += jnp.sum(jax.vmap(compute_1B_down)(down_occ_inds))
 
@@ -168,108 +308,203 @@ def local_en_on_the_fly(n_elecs, logpsi, pars, samples, args, use_fast_update=Fa
             updated_conf = updated_conf.at[first_matching_index].add(jax.lax.select(create, spin_int, -spin_int))
             return updated_conf, valid, update_sites
 
-        def two_body_up_up_occ(inds):
-            i = up_occ_inds[inds[0]]
-            j = up_occ_inds[inds[1]]
+        """ The following functions return the contribution of the double excitation specified by the index ab_index
+        into the flattened arrays for the occupied orbitals i and j (returning zero if the excitation is not valid)."""
+        def two_body_up_up_element(i, j, ab_index):
             update_sites_ij = jnp.array([i, j])
             new_occ_ij = jnp.array([sample[i]-1, sample[j]-1], dtype=jnp.uint8)
             parity_count_ij = up_count[i] + up_count[j] - 2
 
-            def inner_loop(ab_index, val):
-                a = h2_nonzero_ids_flat[ab_index, 0]
-                b = h2_nonzero_ids_flat[ab_index, 1]
+            a = h2_nonzero_ids_flat[ab_index, 0]
+            b = h2_nonzero_ids_flat[ab_index, 1]
 
-                new_occ_ijb, valid_b, update_sites_ijb = update_config(b, update_sites_ij, new_occ_ij, 1, True)
-                new_occ, valid_a, update_sites = update_config(a, update_sites_ijb, new_occ_ijb, 1, True)
-                valid = valid_a & valid_b
+            new_occ_ijb, valid_b, update_sites_ijb = update_config(b, update_sites_ij, new_occ_ij, 1, True)
+            new_occ, valid_a, update_sites = update_config(a, update_sites_ijb, new_occ_ijb, 1, True)
+            valid = valid_a & valid_b
 
-                def get_val():
-                    parity_count = parity_count_ij + up_count[a] + up_count[b]
-                    parity_count -= (a >= j).astype(int) + (a >= i).astype(int) + (b >= j).astype(int) + (b >= i).astype(int) - (a >= b).astype(int) + (j > i).astype(int)
-                    parity_multiplicator = -2*(parity_count & 1) + 1
-                    log_amp_connected = get_connected_log_amp(new_occ, update_sites)
-                    amp_ratio = jnp.squeeze(jnp.exp(log_amp_connected - log_amp))
-                    return (h2_nonzero_vals_flat[ab_index] * amp_ratio * parity_multiplicator)
+            def get_val():
+                parity_count = parity_count_ij + up_count[a] + up_count[b]
+                parity_count -= (a >= j).astype(int) + (a >= i).astype(int) + (b >= j).astype(int) + (b >= i).astype(int) - (a >= b).astype(int) + (j > i).astype(int)
+                parity_multiplicator = -2*(parity_count & 1) + 1
+                log_amp_connected = get_connected_log_amp(new_occ, update_sites)
+                amp_ratio = jnp.squeeze(get_amplitude_ratios(log_amp_connected, log_amp, real_arithmetic))
+                return (h2_nonzero_vals_flat[ab_index] * amp_ratio * parity_multiplicator).astype(amp_dtype)
 
-                value = jax.lax.cond(valid, get_val, lambda : jnp.array(0., dtype=log_amp.dtype))
-                return val + value
-            return jax.lax.fori_loop(h2_nonzero_range[i,j], h2_nonzero_range[i,j+1], inner_loop, jnp.array(0, dtype=log_amp.dtype))
-        local_en += jnp.sum(jax.vmap(two_body_up_up_occ)(jnp.triu_indices(up_occ_inds.shape[0], k=1)))
+            return jax.lax.cond(valid, get_val, lambda : jnp.array(0., dtype=amp_dtype))
 
-        def two_body_down_down_occ(inds):
-            i = down_occ_inds[inds[0]]
-            j = down_occ_inds[inds[1]]
+        def two_body_down_down_element(i, j, ab_index):
             update_sites_ij = jnp.array([i, j])
             new_occ_ij = jnp.array([sample[i]-2, sample[j]-2], dtype=jnp.uint8)
             parity_count_ij = down_count[i] + down_count[j] - 2
 
-            def inner_loop(ab_index, val):
-                a = h2_nonzero_ids_flat[ab_index, 0]
-                b = h2_nonzero_ids_flat[ab_index, 1]
+            a = h2_nonzero_ids_flat[ab_index, 0]
+            b = h2_nonzero_ids_flat[ab_index, 1]
 
-                new_occ_ijb, valid_b, update_sites_ijb = update_config(b, update_sites_ij, new_occ_ij, 2, True)
-                new_occ, valid_a, update_sites = update_config(a, update_sites_ijb, new_occ_ijb, 2, True)
-                valid = valid_a & valid_b
+            new_occ_ijb, valid_b, update_sites_ijb = update_config(b, update_sites_ij, new_occ_ij, 2, True)
+            new_occ, valid_a, update_sites = update_config(a, update_sites_ijb, new_occ_ijb, 2, True)
+            valid = valid_a & valid_b
 
-                def get_val():
-                    parity_count = parity_count_ij + down_count[a] + down_count[b]
-                    parity_count -= (a >= j).astype(int) + (a >= i).astype(int) + (b >= j).astype(int) + (b >= i).astype(int) - (a >= b).astype(int) + (j > i).astype(int)
-                    parity_multiplicator = -2*(parity_count & 1) + 1
-                    log_amp_connected = get_connected_log_amp(new_occ, update_sites)
-                    amp_ratio = jnp.squeeze(jnp.exp(log_amp_connected - log_amp))
-                    return (h2_nonzero_vals_flat[ab_index] * amp_ratio * parity_multiplicator)
+            def get_val():
+                parity_count = parity_count_ij + down_count[a] + down_count[b]
+                parity_count -= (a >= j).astype(int) + (a >= i).astype(int) + (b >= j).astype(int) + (b >= i).astype(int) - (a >= b).astype(int) + (j > i).astype(int)
+                parity_multiplicator = -2*(parity_count & 1) + 1
+                log_amp_connected = get_connected_log_amp(new_occ, update_sites)
+                amp_ratio = jnp.squeeze(get_amplitude_ratios(log_amp_connected, log_amp, real_arithmetic))
+                return (h2_nonzero_vals_flat[ab_index] * amp_ratio * parity_multiplicator).astype(amp_dtype)
 
-                value = jax.lax.cond(valid, get_val, lambda : jnp.array(0., dtype=log_amp.dtype))
-                return val + value
-            return jax.lax.fori_loop(h2_nonzero_range[i,j], h2_nonzero_range[i,j+1], inner_loop, jnp.array(0, dtype=log_amp.dtype))
-        local_en += jnp.sum(jax.vmap(two_body_down_down_occ)(jnp.triu_indices(down_occ_inds.shape[0], k=1)))
+            return jax.lax.cond(valid, get_val, lambda : jnp.array(0., dtype=amp_dtype))
 
-        def two_body_up_down_occ(inds):
-            i = up_occ_inds[inds[0]]
-            j = down_occ_inds[inds[1]]
+        def two_body_up_down_element(i, j, ab_index):
             update_sites_i = jnp.array([i])
             new_occ_i = jnp.array([sample[i]-1], dtype=jnp.uint8)
             new_occ_ij, _, update_sites_ij = update_config(j, update_sites_i, new_occ_i, 2, False)
             parity_count_ij = up_count[i] + down_count[j] - 2
 
+            a = h2_nonzero_ids_flat[ab_index, 0]
+            b = h2_nonzero_ids_flat[ab_index, 1]
+
+            new_occ_ijb, valid_b, update_sites_ijb = update_config(b, update_sites_ij, new_occ_ij, 2, True)
+            new_occ, valid_a, update_sites = update_config(a, update_sites_ijb, new_occ_ijb, 1, True)
+            valid = valid_a & valid_b
+
+            def get_val():
+                parity_count = parity_count_ij + up_count[a] + down_count[b]
+                parity_count -= (a >= i).astype(int) + (b >= j).astype(int)
+                parity_multiplicator = -2*(parity_count & 1) + 1
+                log_amp_connected = get_connected_log_amp(new_occ, update_sites)
+                amp_ratio = jnp.squeeze(get_amplitude_ratios(log_amp_connected, log_amp, real_arithmetic))
+                return (h2_nonzero_vals_flat[ab_index] * amp_ratio * parity_multiplicator).astype(amp_dtype)
+
+            return jax.lax.cond(valid, get_val, lambda : jnp.array(0., dtype=amp_dtype))
+
+        # Exactly evaluated (i.e. not screened) contributions of the (i,j) pairs
+        def sum_over_exact_entries(element_fun, i, j):
             def inner_loop(ab_index, val):
+                return val + element_fun(i, j, ab_index)
+            return jax.lax.fori_loop(h2_nonzero_range[i,j], h2_screened_end[i,j], inner_loop, jnp.array(0, dtype=amp_dtype))
+
+        up_up_pairs = jnp.triu_indices(up_occ_inds.shape[0], k=1)
+        down_down_pairs = jnp.triu_indices(down_occ_inds.shape[0], k=1)
+        row_inds, col_inds = jnp.indices((up_occ_inds.shape[0], down_occ_inds.shape[0]))
+        up_down_pairs = (row_inds.flatten(), col_inds.flatten())
+
+        # All occupied (i,j) pairs with their types (0: up-up, 1: down-down, 2: up-down)
+        pairs_i = jnp.concatenate((up_occ_inds[up_up_pairs[0]], down_occ_inds[down_down_pairs[0]], up_occ_inds[up_down_pairs[0]]))
+        pairs_j = jnp.concatenate((up_occ_inds[up_up_pairs[1]], down_occ_inds[down_down_pairs[1]], down_occ_inds[up_down_pairs[1]]))
+        pair_types = jnp.concatenate((jnp.zeros(len(up_up_pairs[0]), dtype=int), jnp.ones(len(down_down_pairs[0]), dtype=int),
+                                      2 * jnp.ones(len(up_down_pairs[0]), dtype=int)))
+
+        if max_work_list_size is None:
+            def two_body_up_up_occ(inds):
+                return sum_over_exact_entries(two_body_up_up_element, up_occ_inds[inds[0]], up_occ_inds[inds[1]])
+            local_en += jnp.sum(nkjax.vmap_chunked(two_body_up_up_occ, chunk_size=excitation_chunk_size)(up_up_pairs))
+
+            def two_body_down_down_occ(inds):
+                return sum_over_exact_entries(two_body_down_down_element, down_occ_inds[inds[0]], down_occ_inds[inds[1]])
+            local_en += jnp.sum(nkjax.vmap_chunked(two_body_down_down_occ, chunk_size=excitation_chunk_size)(down_down_pairs))
+
+            def two_body_up_down_occ(inds):
+                return sum_over_exact_entries(two_body_up_down_element, up_occ_inds[inds[0]], down_occ_inds[inds[1]])
+            local_en += jnp.sum(nkjax.vmap_chunked(two_body_up_down_occ, chunk_size=excitation_chunk_size)(up_down_pairs))
+        elif max_work_list_size > 0 and len(pair_types) > 0:
+            """ Flat work list of all the exactly evaluated entries of all occupied (i,j) pairs, padded to the fixed size
+            max_work_list_size. For each slot of the list, the corresponding pair is found from the cumulative row lengths.
+            Invalid excitations and padding slots are replaced by dummy updates and masked out, so that all the amplitudes
+            can be evaluated in one batched call of the model."""
+            row_starts = h2_nonzero_range[pairs_i, pairs_j]
+            row_lengths = h2_screened_end[pairs_i, pairs_j] - row_starts
+            row_ends = jnp.cumsum(row_lengths)
+            slots = jnp.arange(max_work_list_size)
+            slot_pairs = jnp.minimum(jnp.searchsorted(row_ends, slots, side="right"), len(pair_types) - 1)
+            in_list = slots < row_ends[-1]
+            ab_indices = jnp.where(in_list, row_starts[slot_pairs] + slots - (row_ends[slot_pairs] - row_lengths[slot_pairs]), 0)
+
+            def work_list_entry(pair_id, ab_index):
+                i = pairs_i[pair_id]
+                j = pairs_j[pair_id]
                 a = h2_nonzero_ids_flat[ab_index, 0]
                 b = h2_nonzero_ids_flat[ab_index, 1]
+                spin_int_i = jnp.where(pair_types[pair_id] == 1, 2, 1)
+                spin_int_j = jnp.where(pair_types[pair_id] == 0, 1, 2)
+                new_occ_i = jnp.array([sample[i]-spin_int_i], dtype=jnp.uint8)
+                new_occ_ij, _, update_sites_ij = update_config(j, jnp.array([i]), new_occ_i, spin_int_j, False)
+                new_occ_ijb, valid_b, update_sites_ijb = update_config(b, update_sites_ij, new_occ_ij, spin_int_j, True)
+                new_occ, valid_a, update_sites = update_config(a, update_sites_ijb, new_occ_ijb, spin_int_i, True)
+
+                count_i = jnp.where(spin_int_i == 1, up_count, down_count)
+                count_j = jnp.where(spin_int_j == 1, up_count, down_count)
+                parity_count = count_i[i] + count_j[j] - 2 + count_i[a] + count_j[b]
+                parity_count_same_spin = parity_count - ((a >= j).astype(int) + (a >= i).astype(int) + (b >= j).astype(int) + (b >= i).astype(int) - (a >= b).astype(int) + (j > i).astype(int))
+                parity_count_opposite_spin = parity_count - ((a >= i).astype(int) + (b >= j).astype(int))
+                parity_count = jnp.where(pair_types[pair_id] == 2, parity_count_opposite_spin, parity_count_same_spin)
+                parity_multiplicator = -2*(parity_count & 1) + 1
 
-                new_occ_ijb, valid_b, update_sites_ijb = update_config(b, update_sites_ij, new_occ_ij, 2, True)
-                new_occ, valid_a, update_sites = update_config(a, update_sites_ijb, new_occ_ijb, 1, True)
                 valid = valid_a & valid_b
-
-                def get_val():
-                    parity_count = parity_count_ij + up_count[a] + down_count[b]
-                    parity_count -= (a >= i).astype(int) + (b >= j).astype(int)
-                    parity_multiplicator = -2*(parity_count & 1) + 1
-                    log_amp_connected = get_connected_log_amp(new_occ, update_sites)
-                    amp_ratio = jnp.squeeze(jnp.exp(log_amp_connected - log_amp))
-                    return (h2_nonzero_vals_flat[ab_index] * amp_ratio * parity_multiplicator)
-
-                value = jax.lax.cond(valid, get_val, lambda : jnp.array(0., dtype=log_amp.dtype))
-                return val + value
-            return jax.lax.fori_loop(h2_nonzero_range[i,j], h2_nonzero_range[i,j+1], inner_loop, jnp.array(0, dtype=log_amp.dtype))
-        row_inds, col_inds = jnp.indices((up_occ_inds.shape[0], down_occ_inds.shape[0]))
-        local_en += jnp.sum(jax.vmap(two_body_up_down_occ)((row_inds.flatten(), col_inds.flatten())))
+                new_occ = jnp.where(valid, new_occ, sample[update_sites])
+                return new_occ, update_sites, parity_multiplicator, valid
+
+            new_occ, update_sites, parity_multiplicator, valid = jax.vmap(work_list_entry)(slot_pairs, ab_indices)
+            valid = valid & in_list
+            log_amps_connected = nkjax.vmap_chunked(get_connected_log_amp, in_axes=(0, 0), chunk_size=excitation_chunk_size)(new_occ, update_sites)
+            amp_ratios = get_amplitude_ratios(log_amps_connected.reshape(-1), log_amp, real_arithmetic)
+            local_en += jnp.sum(jnp.where(valid, h2_nonzero_vals_flat[ab_indices] * parity_multiplicator * amp_ratios, 0.))
+
+        """ Stochastic estimate of the screened contributions. First an occupied (i,j) pair is sampled with a probability
+        proportional to the summed magnitudes of its screened entries, then an entry of this pair is sampled proportionally
+        to its magnitude. Each excitation is therefore sampled with probability |eri[i,a,j,b]|/total_weight. Invalid
+        excitations (i.e. if a or b is occupied) contribute zero, which keeps the estimator unbiased."""
+        if n_stochastic_excitations > 0:
+            pair_weights = h2_stochastic_weights[pairs_i, pairs_j]
+            total_weight = jnp.sum(pair_weights)
+
+            key_pairs, key_entries = jax.random.split(key)
+            sampled_pairs = jax.random.categorical(key_pairs, jnp.log(jnp.where(total_weight > 0., pair_weights, 1.)), shape=(n_stochastic_excitations,))
+            uniforms = jax.random.uniform(key_entries, shape=(n_stochastic_excitations,))
+
+            def stochastic_term(pair_id, uniform):
+                i = pairs_i[pair_id]
+                j = pairs_j[pair_id]
+                start_id = h2_screened_end[i, j]
+                end_id = h2_nonzero_range[i, j+1]
+                target = h2_stochastic_cumsum[start_id] + uniform * (h2_stochastic_cumsum[end_id] - h2_stochastic_cumsum[start_id])
+                ab_index = jnp.clip(jnp.searchsorted(h2_stochastic_cumsum, target, side="right") - 1, start_id, jnp.maximum(end_id - 1, start_id))
+                value = jax.lax.switch(pair_types[pair_id], [two_body_up_up_element, two_body_down_down_element, two_body_up_down_element], i, j, ab_index)
+                abs_val = jnp.abs(h2_nonzero_vals_flat[ab_index])
+                return jnp.where(abs_val > 0., value / jnp.where(abs_val > 0., abs_val, 1.), 0.)
+
+            if len(pair_types) > 0:
+                local_en += total_weight * jnp.mean(nkjax.vmap_chunked(stochastic_term, in_axes=(0, 0), chunk_size=excitation_chunk_size)(sampled_pairs, uniforms))
 
         return local_en
-    return nkjax.vmap_chunked(vmap_fun, chunk_size=chunk_size)(samples)
+    if n_stochastic_excitations > 0:
+        keys = jax.random.split(stochastic_key, samples.shape[0])
+        return nkjax.vmap_chunked(vmap_fun, in_axes=(0, 0), chunk_size=chunk_size)(samples, keys)
+    else:
+        return nkjax.vmap_chunked(lambda sample: vmap_fun(sample, None), chunk_size=chunk_size)(samples)
 
 @nk.vqs.get_local_kernel_arguments.dispatch
 def get_local_kernel_arguments(vstate: nk.vqs.MCState, op: AbInitioHamiltonianSparse):
     samples = vstate.samples
-    h1_nonzero_range = jnp.array(op.h1_nonzero_range)
-    h1_nonzero_ids_flat = jnp.array(op.h1_nonzero_ids_flat)
-    h1_nonzero_vals_flat = jnp.array(op.h1_nonzero_vals_flat)
+    h1_nonzero_range = to_device_array(op.h1_nonzero_range)
+    h1_nonzero_ids_flat = to_device_array(op.h1_nonzero_ids_flat)
+    h1_nonzero_vals_flat = to_device_array(op.h1_nonzero_vals_flat)
+
+    h2_nonzero_range = to_device_array(op.h2_nonzero_range)
+    h2_nonzero_ids_flat = to_device_array(op.h2_nonzero_ids_flat)
+    h2_nonzero_vals_flat = to_device_array(op.h2_nonzero_vals_flat)
+    h2_screened_end = to_device_array(op.h2_screened_end)
+
+    args = (h1_nonzero_range, h1_nonzero_ids_flat, h1_nonzero_vals_flat,
+            h2_nonzero_range, h2_nonzero_ids_flat, h2_nonzero_vals_flat, h2_screened_end)
 
-    h2_nonzero_range = jnp.array(op.h2_nonzero_range)
-    h2_nonzero_ids_flat = jnp.array(op.h2_nonzero_ids_flat)
-    h2_nonzero_vals_flat = jnp.array(op.h2_nonzero_vals_flat)
+    if op.screening_threshold is not None and op.n_stochastic_excitations > 0:
+        h2_stochastic_weights = to_device_array(op.h2_stochastic_weights)
+        h2_stochastic_cumsum = to_device_array(op.h2_stochastic_cumsum)
+        # The stochastic estimate is fixed for a given set of samples (the key changes whenever new samples are drawn)
+        stochastic_key = jax.random.fold_in(vstate.sampler_state.rng, 0)
+        args = (*args, h2_stochastic_weights, h2_stochastic_cumsum, stochastic_key)
 
-    return (samples, (h1_nonzero_range, h1_nonzero_ids_flat, h1_nonzero_vals_flat,
-                      h2_nonzero_range, h2_nonzero_ids_flat, h2_nonzero_vals_flat))
+    return (samples, args)
 
 @nk.vqs.get_local_kernel.dispatch(precedence=1)
 def get_local_kernel(vstate: nk.vqs.MCState, op: AbInitioHamiltonianSparse, chunk_size: Optional[int] = None):
@@ -277,4 +512,15 @@ def get_local_kernel(vstate: nk.vqs.MCState, op: AbInitioHamiltonianSparse, chun
         use_fast_update = vstate.model.apply_fast_update
     except:
         use_fast_update = False
-    return nkjax.HashablePartial(local_en_on_the_fly, vstate.hilbert._n_elec, use_fast_update=use_fast_update, chunk_size=chunk_size)
+    if op.screening_threshold is not None:
+        n_stochastic_excitations = op.n_stochastic_excitations
+    else:
+        n_stochastic_excitations = 0
+    if op.use_flat_work_list:
+        max_work_list_size = op.get_max_work_list_size()
+    else:
+        max_work_list_size = None
+    return nkjax.HashablePartial(local_en_on_the_fly, vstate.hilbert._n_elec, use_fast_update=use_fast_update, chunk_size=chunk_size,
+                                 n_stochastic_excitations=n_stochastic_excitations, excitation_chunk_size=op.excitation_chunk_size,
+                                 max_work_list_size=max_work_list_size, real_arithmetic=use_real_arithmetic(vstate, op),
+                                 mixed_precision=op.mixed_precision)
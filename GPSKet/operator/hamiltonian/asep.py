@@ -1,5 +1,5 @@
 import numpy as np
-from numba import jit
+from numba import jit, prange
 from netket.utils.types import DType
 from netket.operator import DiscreteOperator
 from netket.hilbert import Qubit
@@ -28,73 +28,102 @@ class AsymmetricSimpleExclusionProcess(DiscreteOperator):
     def dtype(self) -> DType:
         return float
 
-    # pad argument is just a dummy atm -> TODO: improve this!
+    # Only non-zero matrix elements are returned (with all diagonal contributions merged into the first connected element).
+    # If pad is set, the connected configurations of all samples are padded (with zero matrix elements) to the same number.
     def get_conn_flattened(self, x, sections, pad=True):
-        x_primes, mels = self._get_conn_flattened_kernel(np.asarray(x), sections, self.lambd, self.alpha, self.beta, self.gamma, self.delta, self.p, self.q)
+        x = np.asarray(x)
+
+        # First pass: count the connected configurations so that the output can be allocated exactly once
+        n_conns = self._count_connected_kernel(x, self.alpha, self.beta, self.gamma, self.delta, self.p, self.q)
+        if pad and len(n_conns) > 0:
+            n_conns[:] = np.max(n_conns)
+        np.cumsum(n_conns, out=sections)
+
+        # Second pass: fill the preallocated buffers (parallelized over the samples)
+        x_primes, mels = self._get_conn_flattened_kernel(x, sections, self.lambd, self.alpha, self.beta, self.gamma, self.delta, self.p, self.q)
         return x_primes, mels
 
     @staticmethod
     @jit(nopython=True)
+    def _count_connected_kernel(x, alpha, beta, gamma, delta, p, q):
+        L = x.shape[-1]
+        n_conns = np.empty(x.shape[0], dtype=np.int64)
+        for batch_id in range(x.shape[0]):
+            connected_con = 1
+            # creation/annihilation at the left boundary (alpha/gamma) and the right boundary (beta/delta)
+            if (x[batch_id, 0] == 0 and alpha != 0) or (x[batch_id, 0] != 0 and gamma != 0):
+                connected_con += 1
+            if (x[batch_id, L-1] == 0 and beta != 0) or (x[batch_id, L-1] != 0 and delta != 0):
+                connected_con += 1
+            # hopping to the right (p) or to the left (q)
+            for i in range(L-1):
+                if (x[batch_id, i] != 0 and x[batch_id, i+1] == 0 and p != 0) or (x[batch_id, i] == 0 and x[batch_id, i+1] != 0 and q != 0):
+                    connected_con += 1
+            n_conns[batch_id] = connected_con
+        return n_conns
+
+    # The sections array needs to hold the (cumulative) end index of the connected configurations of each sample.
+    @staticmethod
+    @jit(nopython=True, parallel=True)
     def _get_conn_flattened_kernel(x, sections, lambd, alpha, beta, gamma, delta, p, q):
         exp_lambd = np.exp(lambd)
         exp_minus_lambd = np.exp(-lambd)
         L = x.shape[-1]
 
-        n_conn = x.shape[0] * 4*(1+L)
-        x_prime = np.empty((n_conn, x.shape[1]), dtype=x.dtype)
-        mels = np.empty(n_conn, dtype=np.float64)
+        n_conn_total = sections[-1] if x.shape[0] > 0 else 0
+        x_prime = np.empty((n_conn_total, x.shape[1]), dtype=x.dtype)
+        mels = np.empty(n_conn_total, dtype=np.float64)
 
-        count = 0
-        for batch_id in range(x.shape[0]):
-            # alpha term
-            x_prime[count, :] = x[batch_id, :]
-            mels[count] = alpha * exp_lambd * apply_creation(0, x_prime[count])
-            count += 1
-            x_prime[count, :] = x[batch_id, :]
-            mels[count] = -alpha * (1-x_prime[count, 0])
-            count += 1
+        for batch_id in prange(x.shape[0]):
+            if batch_id == 0:
+                c = 0
+            else:
+                c = sections[batch_id - 1]
 
-            # gamma term
-            x_prime[count, :] = x[batch_id, :]
-            mels[count] = gamma * exp_minus_lambd * apply_annihilation(0, x_prime[count])
-            count += 1
-            x_prime[count, :] = x[batch_id, :]
-            mels[count] = -gamma * x_prime[count, 0]
-            count += 1
+            # diagonal element (merged contributions of all terms)
+            diag_element = -alpha * (1-x[batch_id, 0]) - gamma * x[batch_id, 0]
+            diag_element += -beta * (1-x[batch_id, L-1]) - delta * x[batch_id, L-1]
+            for i in range(L-1):
+                diag_element -= p * apply_particle_hole(i, i+1, x[batch_id])
+                diag_element -= q * apply_particle_hole(i+1, i, x[batch_id])
+            x_prime[c, :] = x[batch_id, :]
+            mels[c] = diag_element
+            c += 1
 
-            # beta term
-            x_prime[count, :] = x[batch_id, :]
-            mels[count] = beta * exp_minus_lambd * apply_creation(L-1, x_prime[count])
-            count += 1
-            x_prime[count, :] = x[batch_id, :]
-            mels[count] = -beta * (1-x_prime[count, L-1])
-            count += 1
+            # alpha/gamma term
+            if x[batch_id, 0] == 0 and alpha != 0:
+                x_prime[c, :] = x[batch_id, :]
+                mels[c] = alpha * exp_lambd * apply_creation(0, x_prime[c])
+                c += 1
+            elif x[batch_id, 0] != 0 and gamma != 0:
+                x_prime[c, :] = x[batch_id, :]
+                mels[c] = gamma * exp_minus_lambd * apply_annihilation(0, x_prime[c])
+                c += 1
 
-            # delta term
-            x_prime[count, :] = x[batch_id, :]
-            mels[count] = delta * exp_lambd * apply_annihilation(L-1, x_prime[count])
-            count += 1
-            x_prime[count, :] = x[batch_id, :]
-            mels[count] = -delta * x_prime[count, L-1]
-            count += 1
+            # beta/delta term
+            if x[batch_id, L-1] == 0 and beta != 0:
+                x_prime[c, :] = x[batch_id, :]
+                mels[c] = beta * exp_minus_lambd * apply_creation(L-1, x_prime[c])
+                c += 1
+            elif x[batch_id, L-1] != 0 and delta != 0:
+                x_prime[c, :] = x[batch_id, :]
+                mels[c] = delta * exp_lambd * apply_annihilation(L-1, x_prime[c])
+                c += 1
 
+            # p/q terms
             for i in range(L-1):
-                # p term
-                x_prime[count, :] = x[batch_id, :]
-                mels[count] = p * exp_lambd * apply_hopping(i, i+1, x_prime[count])
-                count += 1
-                x_prime[count, :] = x[batch_id, :]
-                mels[count] = -p * apply_particle_hole(i, i+1, x_prime[count])
-                count += 1
+                if x[batch_id, i] != 0 and x[batch_id, i+1] == 0 and p != 0:
+                    x_prime[c, :] = x[batch_id, :]
+                    mels[c] = p * exp_lambd * apply_hopping(i, i+1, x_prime[c])
+                    c += 1
+                elif x[batch_id, i] == 0 and x[batch_id, i+1] != 0 and q != 0:
+                    x_prime[c, :] = x[batch_id, :]
+                    mels[c] = q * exp_minus_lambd * apply_hopping(i+1, i, x_prime[c])
+                    c += 1
 
-                # q term
-                x_prime[count, :] = x[batch_id, :]
-                mels[count] = q * exp_minus_lambd * apply_hopping(i+1, i, x_prime[count])
-                count += 1
-                x_prime[count, :] = x[batch_id, :]
-                mels[count] = -q * apply_particle_hole(i+1, i, x_prime[count])
-                count += 1
-
-            sections[batch_id] = count
+            # padding
+            while c < sections[batch_id]:
+                x_prime[c, :] = x[batch_id, :]
+                mels[c] = 0.
+                c += 1
         return x_prime, mels
-
@@ -3,23 +3,25 @@ import jax.numpy as jnp
 import numpy as np
 import netket as nk
 import netket.jax as nkjax
-from numba import jit
-from typing import List, Tuple, Union, Optional
+from numba import jit, prange
+from typing import List, Sequence, Tuple, Union, Optional
 from netket.utils.types import DType
 from GPSKet.hilbert.discrete_fermion import FermionicDiscreteHilbert
 from GPSKet.operator.fermion import FermionicDiscreteOperator, apply_hopping
-from GPSKet.operator.hamiltonian.ab_initio import get_parity_multiplicator_hop
+from GPSKet.operator.hamiltonian.ab_initio import get_parity_multiplicator_hop, get_amplitude_ratios, use_real_arithmetic
+from GPSKet.operator.hamiltonian.mixed_precision import get_mixed_precision_logpsi
+from GPSKet.models.fast_update import apply_batched_fast_updates
 
 
 class FermiHubbard(FermionicDiscreteOperator):
-    def __init__(self, hilbert: FermionicDiscreteHilbert, edges: List[Tuple[int, int]], U: float=0.0, t: Union[float, List[float]]=1.):
+    def __init__(self, hilbert: FermionicDiscreteHilbert, edges: List[Tuple[int, int]], U: float=0.0, t: Union[float, Sequence[float]]=1.):
         super().__init__(hilbert)
         self.U = U
         self.edges = np.array(edges, dtype=int).reshape((-1,2))
-        if isinstance(t, List):
-            self.t = np.array(t)
-        else:
+        if np.ndim(t) == 0:
             self.t = np.ones(self.edges.shape[0]) * t
+        else:
+            self.t = np.array(t)
 
     @property
     def is_hermitian(self) -> bool:
@@ -29,25 +31,60 @@ class FermiHubbard(FermionicDiscreteOperator):
     def dtype(self) -> DType:
         return float
 
-    # pad argument is just a dummy atm -> TODO: improve this!
+    # Only non-zero matrix elements are returned (with all diagonal contributions merged into the first connected element).
+    # If pad is set, the connected configurations of all samples are padded (with zero matrix elements) to the same number.
     def get_conn_flattened(self, x, sections, pad=True):
-        x_primes, mels = self._get_conn_flattened_kernel(np.asarray(x, dtype = np.uint8),
-                                                         sections, self.U, self.edges, self.t)
+        x = np.asarray(x, dtype = np.uint8)
+
+        # First pass: count the connected configurations so that the output can be allocated exactly once
+        n_conns = self._count_connected_kernel(x, self.edges, self.t)
+        if pad and len(n_conns) > 0:
+            n_conns[:] = np.max(n_conns)
+        np.cumsum(n_conns, out=sections)
+
+        # Second pass: fill the preallocated buffers (parallelized over the samples)
+        x_primes, mels = self._get_conn_flattened_kernel(x, sections, self.U, self.edges, self.t)
         return x_primes, mels
 
     @staticmethod
     @jit(nopython=True)
+    def _count_connected_kernel(x, edges, t):
+        n_conns = np.empty(x.shape[0], dtype=np.int64)
+        for batch_id in range(x.shape[0]):
+            connected_con = 1
+            for edge_count in range(edges.shape[0]):
+                if t[edge_count] != 0:
+                    for spin_int in (1, 2):
+                        occ_0 = (x[batch_id, edges[edge_count, 0]] & spin_int) != 0
+                        occ_1 = (x[batch_id, edges[edge_count, 1]] & spin_int) != 0
+                        if occ_0 != occ_1:
+                            connected_con += 1
+            n_conns[batch_id] = connected_con
+        return n_conns
+
+    # The sections array needs to hold the (cumulative) end index of the connected configurations of each sample.
+    @staticmethod
+    @jit(nopython=True, parallel=True)
     def _get_conn_flattened_kernel(x, sections, U, edges, t):
-        n_conn = x.shape[0] * (1 + edges.shape[0]*4)
-        x_prime = np.empty((n_conn, x.shape[1]), dtype=np.uint8)
-        mels = np.empty(n_conn, dtype=np.float64)
+        n_conn_total = sections[-1] if x.shape[0] > 0 else 0
+        x_prime = np.empty((n_conn_total, x.shape[1]), dtype=np.uint8)
+        mels = np.empty(n_conn_total, dtype=np.float64)
 
-        count = 0
-        for batch_id in range(x.shape[0]):
-            # diagonal element
-            x_prime[count, :] = x[batch_id, :]
-            mels[count] = U * np.sum(x[batch_id, :] == 3)
-            count += 1
+        for batch_id in prange(x.shape[0]):
+            if batch_id == 0:
+                c = 0
+            else:
+                c = sections[batch_id - 1]
+
+            # diagonal element (including the number operator terms of potential self-loop edges)
+            diag_element = U * np.sum(x[batch_id, :] == 3)
+            for edge_count in range(edges.shape[0]):
+                if edges[edge_count, 0] == edges[edge_count, 1]:
+                    site_occ = x[batch_id, edges[edge_count, 0]]
+                    diag_element -= 2 * t[edge_count] * (((site_occ & 1) != 0) + ((site_occ & 2) != 0))
+            x_prime[c, :] = x[batch_id, :]
+            mels[c] = diag_element
+            c += 1
 
             is_occ_up = (x[batch_id] & 1).astype(np.bool8)
             is_occ_down = (x[batch_id] & 2).astype(np.bool8)
@@ -55,37 +92,94 @@ class FermiHubbard(FermionicDiscreteOperator):
             up_count = np.cumsum(is_occ_up)
             down_count = np.cumsum(is_occ_down)
 
-            # hopping
+            # hopping (only the allowed hops are generated)
             for edge_count in range(edges.shape[0]):
-                edge = edges[edge_count]
-
-                # spin up
-                x_prime[count, :] = x[batch_id, :]
-                mels[count] = -t[edge_count] * apply_hopping(edge[0], edge[1], x_prime[count], 1, cummulative_count=up_count)
-                count += 1
-                x_prime[count, :] = x[batch_id, :]
-                mels[count] = -t[edge_count] * apply_hopping(edge[1], edge[0], x_prime[count], 1, cummulative_count=up_count)
-                count += 1
-
-                # spin down
-                x_prime[count, :] = x[batch_id, :]
-                mels[count] = -t[edge_count] * apply_hopping(edge[0], edge[1], x_prime[count], 2, cummulative_count=down_count)
-                count += 1
-                x_prime[count, :] = x[batch_id, :]
-                mels[count] = -t[edge_count] * apply_hopping(edge[1], edge[0], x_prime[count], 2, cummulative_count=down_count)
-                count += 1
-
-                sections[batch_id] = count
+                if t[edge_count] != 0:
+                    for spin_int in (1, 2):
+                        if spin_int == 1:
+                            cumulative_count = up_count
+                        else:
+                            cumulative_count = down_count
+                        occ_0 = (x[batch_id, edges[edge_count, 0]] & spin_int) != 0
+                        occ_1 = (x[batch_id, edges[edge_count, 1]] & spin_int) != 0
+                        if occ_0 != occ_1:
+                            if occ_0:
+                                annihilate_site, create_site = edges[edge_count, 0], edges[edge_count, 1]
+                            else:
+                                annihilate_site, create_site = edges[edge_count, 1], edges[edge_count, 0]
+                            x_prime[c, :] = x[batch_id, :]
+                            mels[c] = -t[edge_count] * apply_hopping(annihilate_site, create_site, x_prime[c], spin_int,
+                                                                     cummulative_count=cumulative_count)
+                            c += 1
+
+            # padding
+            while c < sections[batch_id]:
+                x_prime[c, :] = x[batch_id, :]
+                mels[c] = 0.
+                c += 1
         return x_prime, mels
 
+""" Returns the list of hopping edges together with the hopping amplitudes for a netket graph.
+The edges are selected by their color which, for netket lattices constructed with max_neighbor_order > 1, corresponds to the
+neighbour order, i.e. t=[t, t', t''] (or any other sequence, e.g. a tuple or an array) specifies the nearest, next-nearest and next-next-nearest neighbour hopping amplitudes.
+"""
+def get_hopping_from_graph(graph: nk.graph.AbstractGraph, t: Union[float, Sequence[float]]=1.) -> Tuple[List[Tuple[int, int]], List[float]]:
+    if np.ndim(t) == 0:
+        t = [t]
+    edges = []
+    hoppings = []
+    for color, t_color in enumerate(t):
+        color_edges = graph.edges(filter_color=color)
+        edges.extend(color_edges)
+        hoppings.extend([t_color] * len(color_edges))
+    return edges, hoppings
+
+""" Sets up the Hubbard model on a netket graph (with hopping amplitudes per neighbour order, see get_hopping_from_graph).
+If on_the_fly_en is set, the FermiHubbardOnTheFly operator is returned (constructed with the additional kwargs). """
+def get_Fermi_Hubbard_Hamiltonian(graph: nk.graph.AbstractGraph, U: float=0., t: Union[float, Sequence[float]]=1.,
+                                  n_elec: Optional[Tuple[int, int]]=None, on_the_fly_en: bool=False, **kwargs):
+    hilbert = FermionicDiscreteHilbert(graph.n_nodes, n_elec=n_elec)
+    edges, hoppings = get_hopping_from_graph(graph, t)
+    if on_the_fly_en:
+        return FermiHubbardOnTheFly(hilbert, edges, U=U, t=hoppings, **kwargs)
+    else:
+        return FermiHubbard(hilbert, edges, U=U, t=hoppings, **kwargs)
+
 """ Wrapper class which can be used to apply the on-the-fly updating,
 also includes another flag specifying if fast updating should be applied or not.
+The excitation_chunk_size specifies how many edges (or hopping candidates) are processed simultaneously for each sample
+in the local energy evaluation (all at once if None).
+For real models (see use_real_arithmetic), the local energies are evaluated in real arithmetic.
+If mixed_precision is set, the model is evaluated in single precision (see get_mixed_precision_logpsi).
+If vectorized_hopping is set, all allowed hops of a sample (from an occupied to an unoccupied site for each spin) are
+determined from the occupancies in one vectorized step and only those are evaluated. The number of evaluated hops per
+sample is bounded by max_hops, which (for a fixed number of electrons) is typically much smaller than the four hops per edge
+otherwise considered (of which the forbidden ones are still evaluated and only masked out under vmap).
 """
 class FermiHubbardOnTheFly(FermiHubbard):
-    pass
+    def __init__(self, *args, excitation_chunk_size: Optional[int]=None, mixed_precision: bool=False, vectorized_hopping: bool=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.excitation_chunk_size = excitation_chunk_size
+        self.mixed_precision = mixed_precision
+        self.vectorized_hopping = vectorized_hopping
 
-def local_en_on_the_fly(logpsi, pars, samples, args, use_fast_update=False, chunk_size=None):
+    @property
+    def max_hops(self) -> Tuple[int, int]:
+        """ Upper bounds for the number of allowed hops of a configuration for each spin species. """
+        n_directed_edges = 2 * self.edges.shape[0]
+        n_elec = self.hilbert._n_elec
+        if n_elec is None or n_directed_edges == 0:
+            return (n_directed_edges, n_directed_edges)
+        max_degree = np.max(np.bincount(self.edges.flatten(), minlength=self.hilbert.size))
+        n_sites = self.hilbert.size
+        return tuple(int(min(n_directed_edges, min(n, n_sites - n) * max_degree)) for n in n_elec)
+
+def local_en_on_the_fly(logpsi, pars, samples, args, use_fast_update=False, chunk_size=None, excitation_chunk_size=None, real_arithmetic=False,
+                        mixed_precision=False, max_hops=None):
     edges, U, t = args
+    if mixed_precision:
+        logpsi = get_mixed_precision_logpsi(logpsi)
+    amp_dtype = jnp.float_ if real_arithmetic else jnp.complex_
     def vmap_fun(sample):
         sample = jnp.asarray(sample, np.uint8)
         is_occ_up = (sample & 1)
@@ -129,12 +223,12 @@ def local_en_on_the_fly(logpsi, pars, samples, args, use_fast_update=False, chun
 
                     # Evaluate amplitude ratio
                     log_amp_connected = get_connected_log_amp(new_occ, update_sites)
-                    amp_ratio = jnp.squeeze(jnp.exp(log_amp_connected - log_amp))
+                    amp_ratio = jnp.squeeze(get_amplitude_ratios(log_amp_connected, log_amp, real_arithmetic))
 
-                    return parity_multiplicator*amp_ratio.astype(jnp.complex_)
+                    return parity_multiplicator*amp_ratio.astype(amp_dtype)
 
                 def no_hop(operands):
-                    return 0.*1j
+                    return jnp.zeros((), dtype=amp_dtype)
 
                 start_occ = sample[annihilate_site]
                 end_occ = sample[create_site]
@@ -152,11 +246,47 @@ def local_en_on_the_fly(logpsi, pars, samples, args, use_fast_update=False, chun
                 value += apply_hopping(edge[1], edge[0])
                 value *= -t[index]
                 return value
-            return jnp.sum(jax.vmap(hopping_loop)(jnp.arange(edges.shape[0])))
+            return jnp.sum(nkjax.vmap_chunked(hopping_loop, chunk_size=excitation_chunk_size)(jnp.arange(edges.shape[0])))
+
+        """ Returns the (padded) allowed hops (from an occupied to an unoccupied site) for the given spin, specified by the
+        updated sites, the new occupancies at the update sites and the weights (the matrix elements, zero for padded hops)."""
+        def get_hop_candidates(spin_int, cumulative_count, n_max):
+            hop_from = jnp.concatenate((edges[:, 0], edges[:, 1]))
+            hop_to = jnp.concatenate((edges[:, 1], edges[:, 0]))
+            hop_t = jnp.concatenate((t, t))
+
+            is_occ = (sample & spin_int).astype(bool)
+            allowed = jnp.logical_and(is_occ[hop_from], ~is_occ[hop_to])
+            hop_ids = jnp.nonzero(allowed, size=n_max, fill_value=0)[0]
+            valid = jnp.arange(n_max) < jnp.sum(allowed)
+
+            update_sites = jnp.stack((hop_from[hop_ids], hop_to[hop_ids]), axis=-1)
+            # Padded hops leave the configuration unchanged (and have zero weight)
+            occ_change = spin_int * valid.astype(jnp.uint8)
+            new_occ = jnp.stack((sample[update_sites[:, 0]] - occ_change, sample[update_sites[:, 1]] + occ_change), axis=-1)
+
+            parity_multiplicator = jax.vmap(get_parity_multiplicator_hop, in_axes=(0, None))(update_sites, cumulative_count)
+            weights = jnp.where(valid, -hop_t[hop_ids] * parity_multiplicator, 0.)
+            return update_sites, new_occ.astype(jnp.uint8), weights
+
+        def get_vectorized_hopping_term():
+            candidates_up = get_hop_candidates(1, up_count, max_hops[0])
+            candidates_down = get_hop_candidates(2, down_count, max_hops[1])
+            update_sites, new_occ, weights = jax.tree_map(lambda x, y: jnp.concatenate((x, y)), candidates_up, candidates_down)
+
+            if use_fast_update:
+                log_amps_connected = apply_batched_fast_updates(logpsi, parameters, new_occ, update_sites, excitation_chunk_size)
+            else:
+                log_amps_connected = nkjax.vmap_chunked(get_connected_log_amp, in_axes=(0, 0), chunk_size=excitation_chunk_size)(new_occ, update_sites)
+            amp_ratios = get_amplitude_ratios(log_amps_connected.reshape(-1), log_amp, real_arithmetic).astype(amp_dtype)
+            return jnp.sum(weights * amp_ratios)
 
         if edges.shape[0] > 0:
-            local_en += get_hopping_term(1, up_count)
-            local_en += get_hopping_term(2, down_count)
+            if max_hops is not None:
+                local_en += get_vectorized_hopping_term()
+            else:
+                local_en += get_hopping_term(1, up_count)
+                local_en += get_hopping_term(2, down_count)
 
         return local_en
     return nkjax.vmap_chunked(vmap_fun, chunk_size=chunk_size)(samples)
@@ -175,4 +305,6 @@ def get_local_kernel(vstate: nk.vqs.MCState, op: FermiHubbardOnTheFly, chunk_siz
         use_fast_update = vstate.model.apply_fast_update
     except:
         use_fast_update = False
-    return nkjax.HashablePartial(local_en_on_the_fly, use_fast_update=use_fast_update, chunk_size=chunk_size)
\ No newline at end of file
+    return nkjax.HashablePartial(local_en_on_the_fly, use_fast_update=use_fast_update, chunk_size=chunk_size,
+                                 excitation_chunk_size=op.excitation_chunk_size, real_arithmetic=use_real_arithmetic(vstate, op),
+                                 mixed_precision=op.mixed_precision, max_hops=op.max_hops if op.vectorized_hopping else None)
\ No newline at end of file
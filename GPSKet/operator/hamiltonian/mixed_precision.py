@@ -0,0 +1,33 @@
+import jax
+import jax.numpy as jnp
+
+"""
+Helpers for the mixed-precision evaluation of the local energies with the on-the-fly kernels.
+The model (including its fast updating) is evaluated with single precision parameters, which makes up the bulk of the
+computational cost, whereas the log-amplitudes, the amplitude ratios and all accumulated sums (e.g. the local energies)
+are kept in double precision.
+"""
+
+_single_precision_types = {jnp.dtype(jnp.float64): jnp.float32, jnp.dtype(jnp.complex128): jnp.complex64}
+
+""" Casts all double precision (real and complex) leaves of the pytree to single precision. """
+def to_single_precision(tree):
+    return jax.tree_map(lambda x: x.astype(_single_precision_types[x.dtype]) if x.dtype in _single_precision_types else x, tree)
+
+""" Promotes the (real or complex) array to double precision. """
+def to_double_precision(x):
+    return x.astype(jnp.promote_types(x.dtype, jnp.float64))
+
+"""
+Wraps the logpsi function so that the model is evaluated with single precision parameters (and intermediates),
+while the returned log-amplitudes are promoted to double precision. If the function is applied with mutable variables
+(i.e. returning the log-amplitudes together with the updated variables), only the log-amplitudes are promoted.
+"""
+def get_mixed_precision_logpsi(logpsi):
+    def logpsi_mixed_precision(pars, *args, **kwargs):
+        out = logpsi(to_single_precision(pars), *args, **kwargs)
+        if isinstance(out, tuple):
+            return (to_double_precision(out[0]), *out[1:])
+        else:
+            return to_double_precision(out)
+    return logpsi_mixed_precision
@@ -0,0 +1,101 @@
+import numpy as np
+import jax.numpy as jnp
+
+from netket.utils.mpi import (
+    MPI_py_comm as _MPI_comm,
+    available as _mpi_available
+)
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+"""
+Helpers to store (large) read-only arrays, such as the integrals of the ab initio Hamiltonians, in MPI-3 shared memory
+windows so that only a single copy per node is held, instead of one copy per MPI rank.
+The windows are owned by the object whose arrays are moved into shared memory (see move_attributes_to_shared_memory)
+and need to be released with free_shared_memory (e.g. in the __del__ method of the object). As MPI_Win_free is
+collective over the ranks of a node, the object needs to be released on all ranks of the node at the same point.
+"""
+
+# Alignment (in bytes) of the shared arrays, which is required for the zero-copy device arrays (see to_device_array)
+_ALIGNMENT = 64
+
+"""
+Allocates a shared memory window holding an array of the given shape and dtype for all ranks of the node communicator
+(the memory is only allocated on the first rank of the node). Returns the window and the array, which is a NumPy view
+(obtained with np.frombuffer) onto the shared memory.
+"""
+def allocate_shared_array(shape, dtype, node_comm):
+    dtype = np.dtype(dtype)
+    n_bytes = int(np.prod(shape)) * dtype.itemsize + _ALIGNMENT
+    window = MPI.Win.Allocate_shared(n_bytes if node_comm.Get_rank() == 0 else 0, 1, comm=node_comm)
+    buffer, _ = window.Shared_query(0)
+    raw_array = np.frombuffer(buffer, dtype=np.uint8, count=n_bytes)
+    # The offset is determined on the first rank, as the shared memory can be mapped to different addresses on the ranks
+    offset = node_comm.bcast((-raw_array.ctypes.data) % _ALIGNMENT if node_comm.Get_rank() == 0 else None, root=0)
+    return window, raw_array[offset:n_bytes - _ALIGNMENT + offset].view(dtype).reshape(shape)
+
+"""
+Returns a window and a copy of the array in the shared memory of all ranks on the node (see allocate_shared_array).
+The data is only written from the first rank of each node, the arrays of the other ranks are never accessed
+(so that these can also be dummy arrays of the correct shape and dtype). The returned array is read-only.
+"""
+def to_shared_memory(array, node_comm):
+    array = np.asarray(array)
+    window, shared_array = allocate_shared_array(array.shape, array.dtype, node_comm)
+    if node_comm.Get_rank() == 0:
+        shared_array[...] = array
+    node_comm.Barrier()
+    shared_array.flags.writeable = False
+    return window, shared_array
+
+"""
+Replaces all NumPy array attributes of the object by copies in shared memory (see to_shared_memory), the windows are
+stored in the attribute _shared_memory_windows of the object. By default the NetKet communicator is used, and nothing
+is done if NetKet is not run with MPI.
+"""
+def move_attributes_to_shared_memory(obj, comm=None):
+    if comm is None:
+        if not _mpi_available:
+            return
+        comm = _MPI_comm
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    windows = list(getattr(obj, "_shared_memory_windows", []))
+    for name, value in list(vars(obj).items()):
+        if isinstance(value, np.ndarray) and value.size > 0:
+            window, shared_array = to_shared_memory(value, node_comm)
+            windows.append(window)
+            setattr(obj, name, shared_array)
+    node_comm.Free()
+    obj._shared_memory_windows = windows
+
+"""
+Frees all shared memory windows of the object (see move_attributes_to_shared_memory). Nothing is done once MPI is
+finalized (e.g. for objects which are only deleted at interpreter shutdown), the MPI module is bound as a default argument
+as the module globals can already be cleared at this point.
+"""
+def free_shared_memory(obj, _MPI=MPI):
+    windows = getattr(obj, "_shared_memory_windows", [])
+    obj._shared_memory_windows = []
+    if len(windows) > 0 and not _MPI.Is_finalized():
+        for window in windows:
+            window.Free()
+
+"""
+Converts the array to a JAX array. For aligned read-only arrays (such as the arrays in shared memory) the device array on
+the CPU is created without a copy, so that the local energy kernels directly access the shared memory. This requires the
+shared memory windows to be kept alive as long as the returned arrays are in use. All other arrays are copied as usual.
+"""
+def to_device_array(array):
+    if (isinstance(array, np.ndarray) and not array.flags.writeable and array.flags.c_contiguous
+        and array.ctypes.data % _ALIGNMENT == 0):
+        try:
+            from jax._src import xla_bridge
+            from jax._src.lib import xla_client
+            backend = xla_bridge.get_backend("cpu")
+            return backend.buffer_from_pyval(array, backend.local_devices()[0], False, xla_client.HostBufferSemantics.ZERO_COPY)
+        except Exception:
+            pass
+    return jnp.asarray(array)
@@ -0,0 +1,231 @@
+import numpy as np
+import scipy.sparse as sparse
+import jax
+import jax.numpy as jnp
+import netket as nk
+import netket.jax as nkjax
+from typing import Optional
+from functools import partial
+from netket.stats import Stats, statistics
+from GPSKet.operator.hamiltonian.ab_initio import get_amplitude_ratios, use_real_arithmetic
+from GPSKet.operator.hamiltonian.mixed_precision import get_mixed_precision_logpsi
+from GPSKet.models.fast_update import apply_batched_fast_updates
+import GPSKet.vqs.mc.mc_state.expect
+
+
+""" Converts PauliStrings into a LocalOperator, each string only acts on the sites with non-identity Pauli operators. """
+def pauli_strings_to_local_operator(op: nk.operator.PauliStrings) -> nk.operator.LocalOperator:
+    local_op = nk.operator.LocalOperator(op.hilbert, dtype=op.dtype)
+    for string, weight in zip(op._orig_operators, op._orig_weights):
+        acting_on = [i for i, pauli in enumerate(string) if pauli != "I"]
+        if len(acting_on) == 0:
+            local_op += weight
+        else:
+            if isinstance(op.hilbert, nk.hilbert.Qubit):
+                sub_hilbert = nk.hilbert.Qubit(len(acting_on))
+            else:
+                sub_hilbert = nk.hilbert.Spin(0.5, len(acting_on))
+            sub_string = "".join(string[i] for i in acting_on)
+            matrix = nk.operator.PauliStrings(sub_hilbert, [sub_string], [weight]).to_dense()
+            local_op += nk.operator.LocalOperator(op.hilbert, [matrix], [acting_on], dtype=op.dtype)
+    return local_op
+
+
+""" Wrapper class which can be used to evaluate the local estimators of arbitrary local operators on the fly,
+so that the fast updating of the models (e.g. the qGPS) can be applied.
+The wrapped operator can be a LocalOperator, PauliStrings or any operator which implements to_local_operator (e.g. Ising).
+
+For each term of the operator (acting on k sites), the non-zero off-diagonal matrix elements are tabulated in a sparse
+form, i.e. for each local basis state of the sites the term acts on, the connected local states and the corresponding
+matrix elements are stored (padded to the maximal number of connections of the term group, padded entries do not change the
+configuration and have a zero matrix element). Terms are grouped by the number of sites they act on, terms without any
+off-diagonal elements only contribute to the diagonal and never require an evaluation of the model.
+The excitation_chunk_size specifies how many connected configurations are processed simultaneously for each sample
+(all at once if None).
+For real models (see use_real_arithmetic), the local estimators are evaluated in real arithmetic.
+If mixed_precision is set, the model is evaluated in single precision (see get_mixed_precision_logpsi).
+"""
+class LocalOperatorOnTheFly(nk.operator.LocalOperator):
+    def __init__(self, operator: nk.operator.DiscreteOperator, excitation_chunk_size: Optional[int]=None, mixed_precision: bool=False):
+        if isinstance(operator, nk.operator.PauliStrings):
+            operator = pauli_strings_to_local_operator(operator)
+        elif not isinstance(operator, nk.operator.LocalOperator):
+            operator = operator.to_local_operator()
+        super().__init__(operator.hilbert, operator.operators, operator.acting_on, constant=operator.constant, dtype=operator.dtype)
+        self.excitation_chunk_size = excitation_chunk_size
+        self.mixed_precision = mixed_precision
+
+        hilbert = self.hilbert
+        assert(hilbert.is_finite and all(size == hilbert.shape[0] for size in hilbert.shape))
+        self.local_states = np.sort(np.asarray(hilbert.local_states))
+        local_size = len(self.local_states)
+
+        """ For each group of terms acting on k sites, diagonal_tables holds the tuple (acting_on, basis, diagonal elements)
+        and off_diagonal_tables the tuple (acting_on, basis, matrix elements, connected local states). """
+        self.diagonal_tables = []
+        self.off_diagonal_tables = []
+        for k in sorted(set(len(aon) for aon in self.acting_on)):
+            terms = [(np.asarray(aon), mat.toarray() if sparse.issparse(mat) else np.asarray(mat)) for (aon, mat) in zip(self.acting_on, self.operators) if len(aon) == k]
+            acting_on = np.array([aon for (aon, _) in terms], dtype=np.int32).reshape((-1, k))
+            # The first site is the most significant one for the local basis index
+            basis = local_size ** np.arange(k-1, -1, -1)
+            local_configs = self.local_states[(np.arange(local_size**k)[:, None] // basis) % local_size]
+            self.diagonal_tables.append((acting_on, basis, np.array([np.diag(mat) for (_, mat) in terms])))
+
+            off_diagonal = [mat - np.diag(np.diag(mat)) for (_, mat) in terms]
+            nonzero = [np.abs(mat) > self.mel_cutoff for mat in off_diagonal]
+            has_off_diagonal = np.array([np.any(nz) for nz in nonzero], dtype=bool)
+            if np.any(has_off_diagonal):
+                n_conn = max(np.max(np.sum(nz, axis=1)) for nz in nonzero)
+                n_terms = np.sum(has_off_diagonal)
+                mels = np.zeros((n_terms, local_size**k, n_conn), dtype=self.dtype)
+                connected_states = np.tile(local_configs[None, :, None, :], (n_terms, 1, n_conn, 1))
+                for term_id, term in enumerate(np.flatnonzero(has_off_diagonal)):
+                    for row in range(local_size**k):
+                        cols = np.flatnonzero(nonzero[term][row])
+                        mels[term_id, row, :len(cols)] = off_diagonal[term][row, cols]
+                        connected_states[term_id, row, :len(cols), :] = local_configs[cols]
+                self.off_diagonal_tables.append((acting_on[has_off_diagonal], basis, mels, connected_states))
+
+
+""" Stacks the tables of several operators (see LocalOperatorOnTheFly) for their evaluation in a single pass.
+The terms of all operators acting on the same number of sites are concatenated (padded to the maximal number of connections),
+the observable ids specify to which operator each term belongs. """
+def get_stacked_tables(operators):
+    local_states = operators[0].local_states
+    assert(all(np.array_equal(op.local_states, local_states) for op in operators))
+    constants = np.array([op.constant for op in operators])
+
+    diagonal_terms = {}
+    off_diagonal_terms = {}
+    for observable_id, op in enumerate(operators):
+        for (acting_on, basis, diagonal) in op.diagonal_tables:
+            observable_ids = np.full(acting_on.shape[0], observable_id, dtype=np.int32)
+            diagonal_terms.setdefault(acting_on.shape[-1], []).append((acting_on, basis, diagonal, observable_ids))
+        for (acting_on, basis, mels, connected_states) in op.off_diagonal_tables:
+            observable_ids = np.full(acting_on.shape[0], observable_id, dtype=np.int32)
+            off_diagonal_terms.setdefault(acting_on.shape[-1], []).append((acting_on, basis, mels, connected_states, observable_ids))
+
+    diagonal_tables = []
+    for terms in diagonal_terms.values():
+        diagonal_tables.append((np.concatenate([t[0] for t in terms]), terms[0][1], np.concatenate([t[2] for t in terms]),
+                                np.concatenate([t[3] for t in terms])))
+
+    off_diagonal_tables = []
+    for terms in off_diagonal_terms.values():
+        n_conn = max(t[2].shape[-1] for t in terms)
+        basis = terms[0][1]
+        local_configs = local_states[(np.arange(len(local_states)**len(basis))[:, None] // basis) % len(local_states)]
+        mels = []
+        connected_states = []
+        for (acting_on, _, term_mels, term_states, _) in terms:
+            n_pad = n_conn - term_mels.shape[-1]
+            # Padded connections do not change the configuration and have a zero matrix element
+            mels.append(np.concatenate((term_mels, np.zeros(term_mels.shape[:-1] + (n_pad,), dtype=term_mels.dtype)), axis=-1))
+            states_pad = np.tile(local_configs[None, :, None, :], (term_states.shape[0], 1, n_pad, 1))
+            connected_states.append(np.concatenate((term_states, states_pad), axis=-2))
+        off_diagonal_tables.append((np.concatenate([t[0] for t in terms]), basis, np.concatenate(mels), np.concatenate(connected_states),
+                                    np.concatenate([t[4] for t in terms])))
+
+    return (local_states, constants, tuple(diagonal_tables), tuple(off_diagonal_tables))
+
+
+""" Evaluates the local values of n_observables operators (specified by the stacked tables, see get_stacked_tables) in a single pass,
+i.e. the log-amplitude and the intermediates cache (for fast updating) are only computed once per sample.
+Returns an array of shape (n_samples, n_observables). """
+def local_values_on_the_fly(logpsi, pars, samples, args, n_observables=1, use_fast_update=False, chunk_size=None, excitation_chunk_size=None,
+                            real_arithmetic=False, mixed_precision=False):
+    local_states, constants, diagonal_tables, off_diagonal_tables = args
+    if mixed_precision:
+        logpsi = get_mixed_precision_logpsi(logpsi)
+    amp_dtype = jnp.float_ if real_arithmetic else jnp.complex_
+    def vmap_fun(sample):
+        local_indices = jnp.searchsorted(local_states, sample)
+
+        # Compute log_amp of sample
+        if use_fast_update:
+            log_amp, intermediates_cache = logpsi(pars, jnp.expand_dims(sample, 0), mutable="intermediates_cache", cache_intermediates=True)
+            parameters = {**pars, **intermediates_cache}
+        else:
+            log_amp = logpsi(pars, jnp.expand_dims(sample, 0))
+
+        """ This function returns the amplitude ratio of the connected configuration which is only specified
+        by the occupancy on the updated sites as well as the indices of the sites updated."""
+        def get_amp_ratio(updated_occ_partial, update_sites):
+            updated_config = sample.at[update_sites].set(updated_occ_partial)
+            log_amp_connected = logpsi(pars, jnp.expand_dims(updated_config, 0))
+            return jnp.squeeze(get_amplitude_ratios(log_amp_connected, log_amp, real_arithmetic)).astype(amp_dtype)
+
+        local_vals = constants
+        for (acting_on, basis, diagonal, observable_ids) in diagonal_tables:
+            rows = jnp.sum(local_indices[acting_on] * basis, axis=-1)
+            diagonal_vals = jnp.take_along_axis(diagonal, rows[:, None], axis=1)[:, 0]
+            local_vals = local_vals + jax.ops.segment_sum(diagonal_vals, observable_ids, num_segments=n_observables)
+
+        for (acting_on, basis, mels, connected_states, observable_ids) in off_diagonal_tables:
+            rows = jnp.sum(local_indices[acting_on] * basis, axis=-1)
+            term_ids = jnp.arange(acting_on.shape[0])
+            mels_sample = mels[term_ids, rows].reshape(-1)
+            updated_occs = connected_states[term_ids, rows].reshape((-1, acting_on.shape[-1])).astype(sample.dtype)
+            update_sites = jnp.repeat(acting_on, mels.shape[-1], axis=0)
+            if use_fast_update:
+                log_amps_connected = apply_batched_fast_updates(logpsi, parameters, updated_occs, update_sites, excitation_chunk_size)
+                amp_ratios = get_amplitude_ratios(log_amps_connected, log_amp, real_arithmetic).astype(amp_dtype)
+            else:
+                amp_ratios = nkjax.vmap_chunked(get_amp_ratio, in_axes=(0, 0), chunk_size=excitation_chunk_size)(updated_occs, update_sites)
+            local_vals = local_vals + jax.ops.segment_sum(mels_sample * amp_ratios, jnp.repeat(observable_ids, mels.shape[-1]),
+                                                          num_segments=n_observables)
+
+        return local_vals
+    return nkjax.vmap_chunked(vmap_fun, chunk_size=chunk_size)(samples)
+
+def local_en_on_the_fly(logpsi, pars, samples, args, **kwargs):
+    return local_values_on_the_fly(logpsi, pars, samples, args, n_observables=1, **kwargs)[:, 0]
+
+@nk.vqs.get_local_kernel_arguments.dispatch
+def get_local_kernel_arguments(vstate: nk.vqs.MCState, op: LocalOperatorOnTheFly):
+    samples = vstate.samples
+    return (samples, jax.tree_map(jnp.array, get_stacked_tables([op])))
+
+@nk.vqs.get_local_kernel.dispatch(precedence=1)
+def get_local_kernel(vstate: nk.vqs.MCState, op: LocalOperatorOnTheFly, chunk_size: Optional[int] = None):
+    try:
+        use_fast_update = vstate.model.apply_fast_update
+    except:
+        use_fast_update = False
+    return nkjax.HashablePartial(local_en_on_the_fly, use_fast_update=use_fast_update, chunk_size=chunk_size,
+                                 excitation_chunk_size=op.excitation_chunk_size, real_arithmetic=use_real_arithmetic(vstate, op), mixed_precision=op.mixed_precision)
+
+
+"""
+Evaluates the expectation values of several operators in a single pass over the samples of the variational state,
+e.g. to measure all correlation functions <S_i S_j> for a trained state. The log-amplitudes and the intermediates
+cache for the fast updating are computed only once per sample (instead of once per operator and sample), and all
+connected amplitudes of all operators are evaluated against it.
+The operators are wrapped into LocalOperatorOnTheFly objects if required.
+Returns a Stats object where each field is stacked along a leading axis corresponding to the operators.
+"""
+def expect_multiple(vstate: nk.vqs.MCState, operators, chunk_size: Optional[int] = None, excitation_chunk_size: Optional[int] = None,
+                    mixed_precision: bool = False) -> Stats:
+    operators = [op if isinstance(op, LocalOperatorOnTheFly) else LocalOperatorOnTheFly(op) for op in operators]
+    if chunk_size is None:
+        chunk_size = vstate.chunk_size
+    try:
+        use_fast_update = vstate.model.apply_fast_update
+    except:
+        use_fast_update = False
+    real_arithmetic = all(use_real_arithmetic(vstate, op) for op in operators)
+    kernel = nkjax.HashablePartial(local_values_on_the_fly, n_observables=len(operators), use_fast_update=use_fast_update, chunk_size=chunk_size,
+                                   excitation_chunk_size=excitation_chunk_size, real_arithmetic=real_arithmetic, mixed_precision=mixed_precision)
+    samples = vstate.samples
+    local_vals = _local_values(kernel, vstate._apply_fun, vstate.variables, samples, jax.tree_map(jnp.array, get_stacked_tables(operators)))
+    return _stacked_statistics(local_vals)
+
+@partial(jax.jit, static_argnums=(0, 1))
+def _local_values(kernel, model_apply_fun, variables, samples, args):
+    return kernel(model_apply_fun, variables, samples.reshape((-1, samples.shape[-1])), args).reshape(samples.shape[:-1] + (-1,))
+
+""" Returns the (stacked) statistics of the local values for each observable (the last axis of the local values). """
+@jax.jit
+def _stacked_statistics(local_values):
+    return jax.lax.map(lambda vals: statistics(vals.reshape((vals.shape[0], -1)).T), jnp.moveaxis(local_values, -1, 0))
@@ -8,6 +8,8 @@ from netket.vqs.mc import get_local_kernel_arguments, get_local_kernel
 
 from netket.utils import wrap_afun
 
+from GPSKet.vqs.mc.mc_state.local_energy_cache import get_local_energies, get_log_values
+
 from flax.core import freeze
 
 from functools import partial
@@ -17,18 +19,26 @@ class ImagTimeStep():
         self.vstate = vstate
         self.hamiltonian = hamiltonian
 
-    def get_local_energies(self, samples):
+    def get_log_amps_and_local_energies(self, samples):
         # This is a little bit hacky, the interface should probably be improved at one point
+        # The values are cached on the state, i.e. these are only re-evaluated for new samples or parameters
         old_samples = self.vstate._samples
         self.vstate._samples = samples
-        loc_ens = self.vstate.local_estimators(self.hamiltonian, chunk_size=self.vstate.chunk_size)
-        self.vstate._samples = old_samples
-        return loc_ens
+        try:
+            log_amps = get_log_values(self.vstate)
+            loc_ens = get_local_energies(self.vstate, self.hamiltonian, chunk_size=self.vstate.chunk_size)
+        finally:
+            self.vstate._samples = old_samples
+        return log_amps, loc_ens
+
+    def get_local_energies(self, samples):
+        return self.get_log_amps_and_local_energies(samples)[1]
 
     def log_imag_time_step(self, tau, samples):
-        samples_reshaped = samples.reshape((-1, samples.shape[-1]))
-        self.log_amps = self.vstate.log_value(samples_reshaped)
-        self.local_energies = self.get_local_energies(samples_reshaped)
+        # The samples are not reshaped before the evaluation so that the cache is hit for repeated calls with the same samples
+        log_amps, local_energies = self.get_log_amps_and_local_energies(samples)
+        self.log_amps = log_amps.reshape(-1)
+        self.local_energies = local_energies.reshape(-1)
         return self.log_amps + jnp.log(1 - tau * self.local_energies)
 
 def get_imag_time_step_vstate(tau, hamiltonian, vstate):
@@ -1 +1 @@
-from .mc import MCStateUniqueSamples, MCStateStratifiedSampling
\ No newline at end of file
+from .mc import MCStateUniqueSamples, MCStateStratifiedSampling, MCStateDeduplicatedSamples
\ No newline at end of file
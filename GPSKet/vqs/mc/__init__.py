@@ -1 +1 @@
-from .mc_state import MCStateUniqueSamples, MCStateStratifiedSampling
\ No newline at end of file
+from .mc_state import MCStateUniqueSamples, MCStateStratifiedSampling, MCStateDeduplicatedSamples
\ No newline at end of file
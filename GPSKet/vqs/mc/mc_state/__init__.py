@@ -1,3 +1,5 @@
 from .state_unique_samples import MCStateUniqueSamples
 
-from .state_stratified_sampling import MCStateStratifiedSampling
\ No newline at end of file
+from .state_stratified_sampling import MCStateStratifiedSampling
+
+from .state_deduplicated_samples import MCStateDeduplicatedSamples
\ No newline at end of file
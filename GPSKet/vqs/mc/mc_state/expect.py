@@ -1,88 +1,95 @@
 from functools import partial
-from typing import Callable, Optional
+from typing import Callable, Optional, Tuple
 import jax
 import jax.numpy as jnp
 import netket as nk
+from flax.core.scope import CollectionFilter
+from netket.utils import mpi
 from netket.utils.types import PyTree
-from netket.stats import Stats
+from netket.stats import Stats, statistics
 from netket import jax as nkjax
 from netket.vqs.mc.mc_state.state import MCState
 
 from netket.vqs.mc.mc_state.expect import get_local_kernel, get_local_kernel_arguments
+from netket.vqs.mc.mc_state.expect_forces import forces_expect_hermitian
+from netket.vqs.mc.mc_state.expect_forces_chunked import forces_expect_hermitian_chunked
+
+from .local_energy_cache import get_local_energies
 
 """
-This simply overrides the NetKet default implementation in order to be able to pass
-additional arguments to the model apply function (e.g. required for fast updates).
+This overrides the NetKet default implementation in order to be able to pass
+additional arguments to the model apply function (e.g. required for fast updates)
+and to reuse the local estimators cached on the variational state (see local_energy_cache.py).
 Ultimately this should probably at one point be merged into NetKet.
 """
 
 @nk.vqs.expect.dispatch
 def expect_chunked(vstate: MCState, op: nk.operator.AbstractOperator, chunk_size: int) -> Stats:  # noqa: F811
-    samples, args = get_local_kernel_arguments(vstate, op)
-    local_estimator_fun = get_local_kernel(vstate, op, chunk_size)
-    return _expect(
-        chunk_size,
-        local_estimator_fun,
-        vstate._apply_fun,
-        vstate.sampler.machine_pow,
-        vstate.parameters,
-        vstate.model_state,
-        samples,
-        args,
-    )
+    return _statistics(get_local_energies(vstate, op, chunk_size))
 
 
 @nk.vqs.expect.dispatch
 def expect(vstate: MCState, op: nk.operator.AbstractOperator) -> Stats:  # noqa: F811
-    samples, args = get_local_kernel_arguments(vstate, op)
-    local_estimator_fun = get_local_kernel(vstate, op)
-    return _expect(
-        None,
-        local_estimator_fun,
-        vstate._apply_fun,
-        vstate.sampler.machine_pow,
-        vstate.parameters,
-        vstate.model_state,
-        samples,
-        args,
-    )
-
-
-@partial(jax.jit, static_argnums=(0, 1, 2))
-def _expect(
+    return _statistics(get_local_energies(vstate, op))
+
+
+@jax.jit
+def _statistics(local_values: jnp.ndarray) -> Stats:
+    return statistics(local_values.reshape((local_values.shape[0], -1)).T)
+
+
+"""
+The forces (used by expect_and_grad) are also computed from the cached local estimators (see local_energy_cache.py),
+so that these are only evaluated once if the same operator is evaluated multiple times for the same samples and parameters.
+If the model has mutable variables, we fall back to the NetKet implementation as the model state is updated in the process.
+"""
+
+@nk.vqs.expect_and_forces.dispatch
+def expect_and_forces(vstate: MCState, op: nk.operator.AbstractOperator, *, mutable: CollectionFilter) -> Tuple[Stats, PyTree]:  # noqa: F811
+    if mutable is not False:
+        samples, args = get_local_kernel_arguments(vstate, op)
+        local_estimator_fun = get_local_kernel(vstate, op)
+        op_stats, forces, vstate.model_state = forces_expect_hermitian(local_estimator_fun, vstate._apply_fun, mutable,
+                                                                       vstate.parameters, vstate.model_state, samples, args)
+        return op_stats, forces
+    local_values = get_local_energies(vstate, op)
+    return _forces_from_local_values(None, vstate._apply_fun, vstate.parameters, vstate.model_state, vstate.samples, local_values)
+
+
+@nk.vqs.expect_and_forces.dispatch
+def expect_and_forces_chunked(vstate: MCState, op: nk.operator.AbstractOperator, chunk_size: int, *,  # noqa: F811
+                              mutable: CollectionFilter) -> Tuple[Stats, PyTree]:
+    if mutable is not False:
+        samples, args = get_local_kernel_arguments(vstate, op)
+        local_estimator_fun = get_local_kernel(vstate, op, chunk_size)
+        op_stats, forces, vstate.model_state = forces_expect_hermitian_chunked(chunk_size, local_estimator_fun, vstate._apply_fun, mutable,
+                                                                               vstate.parameters, vstate.model_state, samples, args)
+        return op_stats, forces
+    local_values = get_local_energies(vstate, op, chunk_size)
+    return _forces_from_local_values(chunk_size, vstate._apply_fun, vstate.parameters, vstate.model_state, vstate.samples, local_values)
+
+
+@partial(jax.jit, static_argnums=(0, 1))
+def _forces_from_local_values(
     chunk_size: Optional[int],
-    local_value_kernel: Callable,
     model_apply_fun: Callable,
-    machine_pow: int,
     parameters: PyTree,
     model_state: PyTree,
     samples: jnp.ndarray,
-    local_value_args: PyTree,
-) -> Stats:
-    samples_shape = samples.shape
+    local_values: jnp.ndarray,
+) -> Tuple[Stats, PyTree]:
+    samples = samples.reshape((-1, samples.shape[-1]))
+    n_samples = samples.shape[0] * mpi.n_nodes
 
-    if jnp.ndim(samples) != 2:
-        samples = samples.reshape((-1, samples_shape[-1]))
-
-    def log_pdf(w, samples):
-        return machine_pow * model_apply_fun({"params": w, **model_state}, samples).real
+    local_value_stats = _statistics(local_values)
+    local_values_centered = local_values.reshape(-1) - local_value_stats.mean
 
     if chunk_size is not None:
-        _, op_stats = nkjax.expect(
-            log_pdf,
-            partial(local_value_kernel, model_apply_fun, chunk_size=chunk_size),
-            {"params": parameters, **model_state},
-            samples,
-            local_value_args,
-            n_chains=samples_shape[0],
-        )
+        vjp_fun = nkjax.vjp_chunked(lambda w, samps: model_apply_fun({"params": w, **model_state}, samps), parameters, samples,
+                                    conjugate=True, chunk_size=chunk_size, chunk_argnums=1, nondiff_argnums=1)
     else:
-        _, op_stats = nkjax.expect(
-            log_pdf,
-            partial(local_value_kernel, model_apply_fun),
-            {"params": parameters, **model_state},
-            samples,
-            local_value_args,
-            n_chains=samples_shape[0],
-        )
-    return op_stats
+        vjp_fun = nkjax.vjp(lambda w, samps: model_apply_fun({"params": w, **model_state}, samps), parameters, samples, conjugate=True)[1]
+
+    forces = vjp_fun(jnp.conjugate(local_values_centered) / n_samples)[0]
+
+    return local_value_stats, jax.tree_map(lambda x: mpi.mpi_sum_jax(x)[0], forces)
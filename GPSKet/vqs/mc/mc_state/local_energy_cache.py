@@ -0,0 +1,54 @@
+import jax.numpy as jnp
+
+from typing import Optional
+
+import netket as nk
+
+"""
+Cache of the log-amplitudes and the local estimators of an MC state for its current samples.
+Within a single optimization step, the local estimators are often required several times for the same samples and
+parameters (e.g. for expect_and_grad and a separate expect call for logging or in the minSR driver). As the local energy
+is typically by far the most expensive kernel, the evaluated values are stored on the variational state together with
+references to the samples, parameters and model state they were computed for.
+The cache is only valid as long as all of these are still the same objects, i.e. it is automatically invalidated
+whenever the state is reset (and new samples are drawn) or the parameters/model state are updated.
+The local estimators are cached per operator (identified by the operator object), they are evaluated with the
+local_estimators method of the variational state so that this also works for the custom MC states of this package.
+"""
+
+""" Returns the cache of the variational state, a new (empty) cache is set up if the stored one is invalid. """
+def get_local_energy_cache(vstate: nk.vqs.MCState) -> dict:
+    samples = vstate.samples
+    cache = getattr(vstate, "_local_energy_cache", None)
+    if (cache is None or cache["samples"] is not samples or cache["parameters"] is not vstate.parameters
+        or cache["model_state"] is not vstate.model_state):
+        cache = {"samples": samples, "parameters": vstate.parameters, "model_state": vstate.model_state,
+                 "log_values": None, "local_estimators": {}}
+        vstate._local_energy_cache = cache
+    return cache
+
+""" Removes the cache from the variational state (e.g. to free the memory). """
+def clear_local_energy_cache(vstate: nk.vqs.MCState):
+    vstate._local_energy_cache = None
+
+"""
+Returns the (cached) local estimators of the operator for the current samples of the variational state, the returned
+array has the same shape as the samples without the last axis.
+"""
+def get_local_energies(vstate: nk.vqs.MCState, op: nk.operator.AbstractOperator, chunk_size: Optional[int] = None) -> jnp.ndarray:
+    cache = get_local_energy_cache(vstate)
+    cached = cache["local_estimators"].get(id(op))
+    if cached is None or cached[0] is not op:
+        # Transposed as the local_estimators method returns the values with flipped axes
+        loc_vals = vstate.local_estimators(op, chunk_size=chunk_size).T
+        cached = (op, loc_vals)
+        cache["local_estimators"][id(op)] = cached
+    return cached[1]
+
+""" Returns the (cached) log-amplitudes for the current samples of the variational state. """
+def get_log_values(vstate: nk.vqs.MCState) -> jnp.ndarray:
+    cache = get_local_energy_cache(vstate)
+    if cache["log_values"] is None:
+        samples = cache["samples"]
+        cache["log_values"] = vstate.log_value(samples.reshape((-1, samples.shape[-1]))).reshape(samples.shape[:-1])
+    return cache["log_values"]
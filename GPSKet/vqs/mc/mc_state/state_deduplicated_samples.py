@@ -0,0 +1,139 @@
+import netket as nk
+import netket.jax as nkjax
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from typing import Tuple, Optional, Callable, Any
+
+from netket.utils.types import PyTree
+from netket.utils.dispatch import TrueT
+from netket.utils.mpi import (
+    n_nodes as _n_nodes,
+    mpi_sum_jax as _mpi_sum_jax
+)
+from netket.stats import statistics as _statistics
+
+from functools import partial
+
+from netket.vqs import get_local_kernel_arguments, get_local_kernel
+
+from .local_energy_cache import get_local_energies
+
+""" MC state which evaluates the local estimators only once for each distinct configuration among the samples.
+For strongly peaked distributions (e.g. for molecular systems), a large fraction of the Markov chain samples can be
+exact duplicates. The distinct configurations are identified (on each rank) with a sort-based np.unique over the
+configurations (packed into single void entries), the local estimators are evaluated for the unique configurations only and then scattered back to all the samples, so that
+all statistics (including the autocorrelation estimates over the chains) are exactly the same as for the standard MCState.
+Similarly, the gradient is obtained from a single vjp over the unique configurations, weighted by their multiplicities.
+The local estimators are cached on the state (see local_energy_cache.py), i.e. they are only evaluated once per operator
+for the same samples and parameters.
+To reduce the number of recompilations, the unique configurations are padded (with zero weight) to the next power of two
+(rounded up to a multiple of the chunk size, if specified).
+Custom kernel arguments (see get_local_kernel_arguments) are set up with the samples property returning the
+unique configurations, so that this also works for kernels with sample dependent arguments (e.g. for DiscreteOperators).
+"""
+class MCStateDeduplicatedSamples(nk.vqs.MCState):
+    def __init__(self, *args, **kwargs):
+        self._unique_samples = None
+        self._samples_override = None
+        super().__init__(*args, **kwargs)
+
+    def reset(self):
+        super().reset()
+        self._unique_samples = None
+
+    @property
+    def samples(self) -> jnp.ndarray:
+        if self._samples_override is not None:
+            return self._samples_override
+        return super().samples
+
+    def get_unique_samples(self, chunk_size: Optional[int] = None) -> Tuple[jnp.ndarray, jnp.ndarray]:
+        """
+        Returns the (padded) unique configurations of the samples of this rank, together with the indices of the unique
+        configuration for each sample (with the same shape as the samples without the last axis).
+        """
+        samples = self.samples
+        if self._unique_samples is None or self._unique_samples[0] is not samples or self._unique_samples[1] != chunk_size:
+            samples_flat = np.ascontiguousarray(np.asarray(samples).reshape((-1, samples.shape[-1])))
+            packed = samples_flat.view(np.dtype((np.void, samples_flat.dtype.itemsize * samples_flat.shape[-1]))).reshape(-1)
+            _, unique_ids, inverse = np.unique(packed, return_index=True, return_inverse=True)
+            n_padded = min(1 << int(np.ceil(np.log2(len(unique_ids)))), samples_flat.shape[0])
+            if chunk_size is not None:
+                n_padded = -(-n_padded // chunk_size) * chunk_size
+            unique_ids = np.concatenate((unique_ids, np.full(n_padded - len(unique_ids), unique_ids[0])))
+            self._unique_samples = (samples, chunk_size, jnp.array(samples_flat[unique_ids]), jnp.array(inverse.reshape(samples.shape[:-1]), dtype=jnp.int32))
+        return self._unique_samples[2:]
+
+    def get_unique_local_kernel_arguments(self, op: nk.operator.AbstractOperator, chunk_size: Optional[int] = None):
+        """ Returns the unique configurations, the sample indices and the kernel arguments set up for the unique configurations. """
+        unique_samples, inverse = self.get_unique_samples(chunk_size)
+        self._samples_override = unique_samples
+        try:
+            _, args = get_local_kernel_arguments(self, op)
+        finally:
+            self._samples_override = None
+        return unique_samples, inverse, args
+
+    def local_estimators(self, op: nk.operator.AbstractOperator, *, chunk_size: Optional[int] = None):
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        unique_samples, inverse, args = self.get_unique_local_kernel_arguments(op, chunk_size)
+        if chunk_size is None:
+            local_estimator = get_local_kernel(self, op)
+        else:
+            local_estimator = get_local_kernel(self, op, chunk_size)
+        # Transposed to match the (n_chains, n_samples_per_chain) shape of the NetKet implementation
+        return deduplicated_local_values(chunk_size, local_estimator, self._apply_fun, self.variables, unique_samples, inverse, args).T
+
+
+""" Evaluates the local values for the unique configurations and scatters them back to all samples. """
+@partial(jax.jit, static_argnums=(0, 1, 2))
+def deduplicated_local_values(chunk_size: Optional[int], estimator_fun: Callable, model_apply_fun: Callable, variables: PyTree,
+                              unique_samples: jnp.ndarray, inverse: jnp.ndarray, estimator_args: PyTree):
+    if chunk_size is not None:
+        loc_vals = estimator_fun(model_apply_fun, variables, unique_samples, estimator_args, chunk_size=chunk_size)
+    else:
+        loc_vals = estimator_fun(model_apply_fun, variables, unique_samples, estimator_args)
+    return loc_vals[inverse]
+
+
+""" The following functions override the NetKet implementation to evaluate the local estimators over the unique configurations.
+The local estimators are obtained from the cache of the state (see local_energy_cache.py). """
+@nk.vqs.expect_and_grad.dispatch(precedence=10)
+def expect_and_grad(vstate: MCStateDeduplicatedSamples, op: nk.operator.AbstractOperator, use_covariance: TrueT, chunk_size: Optional[int], *, mutable:Any):
+    assert(mutable is False)
+    loc_vals = get_local_energies(vstate, op, chunk_size)
+    unique_samples, inverse = vstate.get_unique_samples(chunk_size)
+
+    return grad_expect_hermitian_deduplicated(chunk_size, vstate._apply_fun, vstate.parameters, vstate.model_state,
+                                              unique_samples, inverse, loc_vals)
+
+@nk.vqs.expect.dispatch(precedence=10)
+def expect(vstate: MCStateDeduplicatedSamples, op: nk.operator.AbstractOperator, chunk_size: Optional[int]):
+    return _statistics_jit(get_local_energies(vstate, op, chunk_size).T)
+
+_statistics_jit = jax.jit(_statistics)
+
+@partial(jax.jit, static_argnums=(0, 1))
+def grad_expect_hermitian_deduplicated(chunk_size: Optional[int], model_apply_fun: Callable, parameters: PyTree, model_state: PyTree,
+                                       unique_samples: jnp.ndarray, inverse: jnp.ndarray, loc_vals: jnp.ndarray):
+    # Statistics over all samples (as for the standard MCState)
+    loc_val_stats = _statistics(loc_vals.T)
+
+    n_samples = inverse.size * _n_nodes
+    multiplicities = jnp.zeros(unique_samples.shape[0]).at[inverse.reshape(-1)].add(1.)
+    loc_vals_unique = jnp.zeros(unique_samples.shape[0], dtype=loc_vals.dtype).at[inverse.reshape(-1)].set(loc_vals.reshape(-1))
+    loc_vals_centered = multiplicities * (loc_vals_unique - loc_val_stats.mean)
+
+    if chunk_size is not None:
+        vjp_fun = nkjax.vjp_chunked(lambda w, samps: model_apply_fun({"params": w, **model_state}, samps), parameters, unique_samples, conjugate=True, chunk_size=chunk_size, chunk_argnums=1, nondiff_argnums=1)
+    else:
+        vjp_fun = nkjax.vjp(lambda w, samps: model_apply_fun({"params": w, **model_state}, samps), parameters, unique_samples, conjugate=True)[1]
+
+    val_grad = vjp_fun((jnp.conjugate(loc_vals_centered) / n_samples))[0]
+
+    val_grad = jax.tree_map(lambda x, target: (x if jnp.iscomplexobj(target) else 2 * x.real).astype(target.dtype), val_grad, parameters)
+
+    return loc_val_stats, jax.tree_map(lambda x: _mpi_sum_jax(x)[0], val_grad)
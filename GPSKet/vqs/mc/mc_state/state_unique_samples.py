@@ -28,6 +28,8 @@ from functools import partial
 
 from netket.vqs import get_local_kernel_arguments, get_local_kernel
 
+from .local_energy_cache import get_local_energies
+
 import jax
 
 """ Very hacky implementation of an MC state which samples until it has accumulated n_samples
@@ -112,41 +114,28 @@ class MCStateUniqueSamples(nk.vqs.MCState):
 """ The following functions just override the NetKet implementation to inject the sample counts into the expectation value evaluation."""
 @nk.vqs.expect_and_grad.dispatch(precedence=10)
 def expect_and_grad(vstate: MCStateUniqueSamples, op: nk.operator.AbstractOperator, use_covariance: TrueT, chunk_size: Optional[int], *, mutable:Any):
-    _, args = get_local_kernel_arguments(vstate, op)
     samples_and_counts = vstate.samples_with_counts
-    if chunk_size is not None:
-        local_estimator = get_local_kernel(vstate, op, chunk_size)
-    else:
-        local_estimator = get_local_kernel(vstate, op)
     assert(mutable is False)
+    loc_vals = get_local_energies(vstate, op, chunk_size)
 
-    exp, grad = grad_expect_hermitian_chunked(chunk_size, local_estimator, vstate._apply_fun, vstate.parameters, vstate.model_state, samples_and_counts, args, compute_grad=True)
+    exp, grad = grad_expect_hermitian_chunked(chunk_size, vstate._apply_fun, vstate.parameters, vstate.model_state, samples_and_counts, loc_vals, compute_grad=True)
 
     return exp, grad
 
 @nk.vqs.expect.dispatch(precedence=10)
 def expect(vstate: MCStateUniqueSamples, op: nk.operator.AbstractOperator, chunk_size: Optional[int]):
-    _, args = get_local_kernel_arguments(vstate, op)
     samples_and_counts = vstate.samples_with_counts
-    if chunk_size is not None:
-        local_estimator = get_local_kernel(vstate, op, chunk_size)
-    else:
-        local_estimator = get_local_kernel(vstate, op)
+    loc_vals = get_local_energies(vstate, op, chunk_size)
 
-    exp = grad_expect_hermitian_chunked(chunk_size, local_estimator, vstate._apply_fun, vstate.parameters, vstate.model_state, samples_and_counts, args, compute_grad=False)
+    exp = grad_expect_hermitian_chunked(chunk_size, vstate._apply_fun, vstate.parameters, vstate.model_state, samples_and_counts, loc_vals, compute_grad=False)
 
     return exp
 
-@partial(jax.jit, static_argnums=(0,1,2,7))
-def grad_expect_hermitian_chunked(chunk_size: Optional[int], estimator_fun: Callable, model_apply_fun: Callable, parameters: PyTree, model_state: PyTree, samples_and_counts: Tuple[jnp.ndarray, jnp.ndarray], estimator_args: PyTree, compute_grad=False):
+@partial(jax.jit, static_argnums=(0,1,6))
+def grad_expect_hermitian_chunked(chunk_size: Optional[int], model_apply_fun: Callable, parameters: PyTree, model_state: PyTree, samples_and_counts: Tuple[jnp.ndarray, jnp.ndarray], loc_vals: jnp.ndarray, compute_grad=False):
     samples = samples_and_counts[0]
     counts = samples_and_counts[1]
 
-    if chunk_size is not None:
-        loc_vals = estimator_fun(model_apply_fun, {"params": parameters, **model_state}, samples, estimator_args, chunk_size=chunk_size)
-    else:
-        loc_vals = estimator_fun(model_apply_fun, {"params": parameters, **model_state}, samples, estimator_args)
-
     mean = _sum(counts * loc_vals)
 
     variance = _sum(counts * (jnp.abs(loc_vals - mean)**2))
@@ -0,0 +1,81 @@
+import os
+import tempfile
+import h5py
+import numpy as np
+from tqdm import tqdm
+from GPSKet.hilbert import FermionicDiscreteHilbert
+from GPSKet.operator.hamiltonian import AbInitioHamiltonianOnTheFly, load_ab_initio_hamiltonian
+from GPSKet.operator.hamiltonian.ab_initio import pack_eri
+
+
+rng = np.random.default_rng(np.random.randint(0, 100))
+L = 4
+n_elec = [2, 2]
+core_energy = rng.normal()
+
+# Random integrals with the (8-fold) permutation symmetries of real orbitals
+h1 = rng.normal(size=(L, L))
+h1 = 0.5 * (h1 + h1.T)
+factors = rng.normal(size=(3, L, L))
+factors = 0.5 * (factors + np.swapaxes(factors, 1, 2))
+eri = np.einsum("Ppq,Prs->pqrs", factors, factors)
+
+hi = FermionicDiscreteHilbert(L, n_elec=n_elec)
+ha_ref = AbInitioHamiltonianOnTheFly(hi, h1, eri)
+x = hi.all_states()
+x_conn_ref, mels_ref = ha_ref.get_conn_padded(x)
+
+def assert_same_hamiltonian(ha, atol=1.e-10):
+    np.testing.assert_allclose(ha.h_mat, h1, atol=atol)
+    x_conn, mels = ha.get_conn_padded(x)
+    # Compare the dense matrices in the basis of all states
+    for i in range(x.shape[0]):
+        rows_ref = hi.states_to_numbers(x_conn_ref[i])
+        rows = hi.states_to_numbers(x_conn[i])
+        row_ref = np.zeros(x.shape[0])
+        row = np.zeros(x.shape[0])
+        np.add.at(row_ref, rows_ref, mels_ref[i])
+        np.add.at(row, rows, mels[i])
+        np.testing.assert_allclose(row, row_ref, atol=atol)
+
+with tempfile.TemporaryDirectory() as directory:
+    # FCIDUMP file with all symmetry unique elements (1-based indices)
+    fcidump_file = os.path.join(directory, "integrals.fcidump")
+    with open(fcidump_file, "w") as file:
+        file.write("&FCI NORB={},NELEC={},MS2={},\n ORBSYM={}\n ISYM=1,\n&END\n".format(L, sum(n_elec), n_elec[0]-n_elec[1], "1,"*L))
+        for i in range(L):
+            for j in range(i+1):
+                for k in range(L):
+                    for l in range(k+1):
+                        if i*(i+1)//2 + j >= k*(k+1)//2 + l:
+                            file.write("{:.16e} {} {} {} {}\n".format(eri[i,j,k,l], i+1, j+1, k+1, l+1))
+        for i in range(L):
+            for j in range(i+1):
+                file.write("{:.16e} {} {} 0 0\n".format(h1[i,j], i+1, j+1))
+        file.write("{:.16e} 0 0 0 0\n".format(core_energy))
+
+    # HDF5 files with the 4-fold symmetric (over the lower triangular orbital pairs) and the 8-fold packed integrals
+    p, q = np.tril_indices(L)
+    hdf5_files = []
+    for name, eri_data in [("4fold", eri[p, q][:, p, q]), ("8fold", pack_eri(eri))]:
+        hdf5_file = os.path.join(directory, "integrals_{}.h5".format(name))
+        with h5py.File(hdf5_file, "w") as file:
+            file["h1"] = h1
+            file["eri"] = eri_data
+            file["core_energy"] = core_energy
+        hdf5_files.append(hdf5_file)
+
+    # Test #1
+    # The Hamiltonians of all types loaded from all file formats (also reading in small chunks)
+    # should be equal to the Hamiltonian set up from the dense integrals
+    for filename in tqdm([fcidump_file] + hdf5_files, desc="Test #1"):
+        for hamiltonian_type in ["packed", "dense", "sparse", "factorized"]:
+            for chunk_size in [2**20, 7]:
+                ha, core = load_ab_initio_hamiltonian(filename, hilbert=hi, hamiltonian_type=hamiltonian_type, chunk_size=chunk_size)
+                np.testing.assert_allclose(core, core_energy)
+                assert_same_hamiltonian(ha, atol=1.e-6 if hamiltonian_type == "factorized" else 1.e-10)
+
+    # Test #2
+    # Without a hilbert space, the number of electrons should be read from the FCIDUMP header
+    ha, _ = load_ab_initio_hamiltonian(fcidump_file)
+    assert(tuple(ha.hilbert._n_elec) == tuple(n_elec))
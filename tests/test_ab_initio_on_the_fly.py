@@ -0,0 +1,125 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import netket as nk
+import netket.jax as nkjax
+from tqdm import tqdm
+from GPSKet.models import qGPS, Slater
+from GPSKet.nn.initializers import normal
+from GPSKet.hilbert import FermionicDiscreteHilbert
+from GPSKet.sampler import MetropolisHopping
+from GPSKet.operator.hamiltonian import AbInitioHamiltonian, AbInitioHamiltonianOnTheFly, AbInitioHamiltonianFactorized, AbInitioHamiltonianSparse
+from GPSKet.operator.hamiltonian.ab_initio import pack_eri, cholesky_decompose_eri, use_real_arithmetic
+
+
+key_in, key_ma = jax.random.split(jax.random.PRNGKey(np.random.randint(0, 100)))
+rng = np.random.default_rng(np.random.randint(0, 100))
+B = 8
+L = 6
+n_elec = (2, 2)
+M = 2
+dtype = jnp.complex128
+
+# Random integrals with the (8-fold) permutation symmetries of real orbitals
+h1 = rng.normal(size=(L, L))
+h1 = 0.5 * (h1 + h1.T)
+factors = rng.normal(size=(3, L, L))
+factors = 0.5 * (factors + np.swapaxes(factors, 1, 2))
+h2 = np.einsum("Ppq,Prs->pqrs", factors, factors)
+
+# Random integrals with the (4-fold) permutation symmetries of complex orbitals, i.e. eri[p,q,r,s] = eri[r,s,p,q]
+# and eri[p,q,r,s] = conj(eri[q,p,s,r]), obtained from Hermitian factors
+h1_complex = h1 + 1.j * rng.normal(size=(L, L))
+h1_complex = 0.5 * (h1_complex + h1_complex.conj().T)
+factors_complex = factors + 1.j * rng.normal(size=(3, L, L))
+factors_complex = 0.5 * (factors_complex + np.swapaxes(factors_complex, 1, 2).conj())
+h2_complex = np.einsum("Ppq,Prs->pqrs", factors_complex, factors_complex)
+
+hi = FermionicDiscreteHilbert(L, n_elec=n_elec)
+ma = qGPS(hi, M, dtype=dtype, init_fun=normal(0.5, dtype=dtype))
+x = jnp.asarray(hi.random_state(key_in, B), jnp.uint8)
+variables = ma.init(key_ma, x)
+vs = nk.vqs.MCState(MetropolisHopping(hi), ma, n_samples=B, variables=variables)
+
+def local_energies(ha):
+    _, args = nk.vqs.get_local_kernel_arguments(vs, ha)
+    kernel = nk.vqs.get_local_kernel(vs, ha)
+    return jax.jit(lambda args: kernel(ma.apply, variables, x, args))(args)
+
+# Reference local energies from the explicitly generated connected configurations
+def local_energies_exact(ha):
+    x_conn, mels = ha.get_conn_padded(np.asarray(x))
+    log_amps_conn = ma.apply(variables, jnp.asarray(x_conn.reshape((-1, L)))).reshape(mels.shape)
+    return np.sum(mels * np.exp(log_amps_conn - np.expand_dims(ma.apply(variables, x), -1)), axis=-1)
+
+# Test #1
+# The on-the-fly local energies with the packed integrals (set up from the dense integrals, or passed directly)
+# should be equal to those with the dense integrals as well as to the local energies obtained from the explicitly
+# generated connected configurations, for real and complex integrals and with chunked excitations
+for h, eri in tqdm([(h1, h2), (h1_complex, h2_complex)], desc="Test #1"):
+    loc_en_exact = local_energies_exact(AbInitioHamiltonian(hi, h, eri))
+    eri_packed = pack_eri(eri)
+    assert(eri_packed.ndim == (1 if np.isrealobj(eri) else 2))
+    for excitation_chunk_size in [None, 3]:
+        ha_dense = AbInitioHamiltonianOnTheFly(hi, h, eri, excitation_chunk_size=excitation_chunk_size)
+        loc_en_dense = local_energies(ha_dense)
+        np.testing.assert_allclose(loc_en_dense, loc_en_exact)
+        for ha in [AbInitioHamiltonianOnTheFly(hi, h, eri, use_packed_eri=True, excitation_chunk_size=excitation_chunk_size),
+                   AbInitioHamiltonianOnTheFly(hi, h, None, eri_packed=eri_packed, excitation_chunk_size=excitation_chunk_size)]:
+            assert(ha.eri_mat is None)
+            np.testing.assert_allclose(local_energies(ha), loc_en_dense)
+
+# Test #2
+# The factorized local energies should be equal to the dense on-the-fly local energies, with the exact factors as well as
+# with the factors of a (pivoted) Cholesky decomposition of the dense or the packed integrals. For integrals with additional
+# small contributions, the Cholesky decomposition with a larger threshold is truncated, the truncated integrals then deviate
+# from the exact integrals by less than the threshold, and the local energies are those of the truncated integrals
+small_factors = 1.e-2 * rng.normal(size=(5, L, L))
+small_factors = 0.5 * (small_factors + np.swapaxes(small_factors, 1, 2))
+h2_perturbed = h2 + np.einsum("Ppq,Prs->pqrs", small_factors, small_factors)
+for excitation_chunk_size in tqdm([None, 3], desc="Test #2"):
+    loc_en_dense = local_energies(AbInitioHamiltonianOnTheFly(hi, h1, h2, excitation_chunk_size=excitation_chunk_size))
+    ha = AbInitioHamiltonianFactorized(hi, h1, factors, excitation_chunk_size=excitation_chunk_size)
+    np.testing.assert_allclose(local_energies(ha), loc_en_dense)
+    for cholesky_factors in [cholesky_decompose_eri(h2, threshold=1.e-12),
+                             cholesky_decompose_eri(pack_eri(h2), threshold=1.e-12, n_orbs=L)]:
+        assert(cholesky_factors.shape[0] <= factors.shape[0])
+        ha = AbInitioHamiltonianFactorized(hi, h1, cholesky_factors, excitation_chunk_size=excitation_chunk_size)
+        np.testing.assert_allclose(ha.get_dense_eri(), h2, atol=1.e-10)
+        np.testing.assert_allclose(local_energies(ha), loc_en_dense)
+
+    threshold = 1.e-3
+    cholesky_factors = cholesky_decompose_eri(h2_perturbed, threshold=threshold)
+    assert(cholesky_factors.shape[0] < cholesky_decompose_eri(h2_perturbed, threshold=1.e-12).shape[0])
+    ha = AbInitioHamiltonianFactorized(hi, h1, cholesky_factors, excitation_chunk_size=excitation_chunk_size)
+    h2_truncated = ha.get_dense_eri()
+    assert(np.max(abs(h2_truncated - h2_perturbed)) < threshold)
+    loc_en_truncated = local_energies(AbInitioHamiltonianOnTheFly(hi, h1, h2_truncated, excitation_chunk_size=excitation_chunk_size))
+    np.testing.assert_allclose(local_energies(ha), loc_en_truncated)
+
+# Test #3
+# For real models (qGPS, and the Slater determinant for which the amplitudes can be negative) and real integrals the
+# local energies are evaluated in real arithmetic, these should be equal to the local energies of the complex path.
+# For complex models or complex integrals, the complex path should be used
+# Local energies of the variational state, the evaluation path chosen by the kernel can be overridden with real_arithmetic
+def local_energies_of_path(vs, ha, real_arithmetic=None):
+    _, args = nk.vqs.get_local_kernel_arguments(vs, ha)
+    kernel = nk.vqs.get_local_kernel(vs, ha)
+    if real_arithmetic is not None:
+        kernel = nkjax.HashablePartial(kernel.func, *kernel.args, **{**kernel.keywords, "real_arithmetic": real_arithmetic})
+    return jax.jit(lambda args: kernel(vs._apply_fun, vs.variables, x, args))(args)
+
+models = [qGPS(hi, M, dtype=jnp.float64, init_fun=normal(0.5, dtype=jnp.float64)), Slater(hi, dtype=jnp.float64),
+          qGPS(hi, M, dtype=jnp.complex128, init_fun=normal(0.5, dtype=jnp.complex128))]
+for ma in tqdm(models, desc="Test #3"):
+    model_dtype = ma.dtype
+    vs = nk.vqs.MCState(MetropolisHopping(hi), ma, n_samples=B, variables=ma.init(key_ma, x))
+    for h, eri in [(h1, h2), (h1_complex, h2_complex)]:
+        real_path = np.isrealobj(eri) and model_dtype == jnp.float64
+        for ha in [AbInitioHamiltonianOnTheFly(hi, h, eri), AbInitioHamiltonianOnTheFly(hi, h, eri, use_packed_eri=True),
+                   AbInitioHamiltonianSparse(hi, h, eri)]:
+            assert(use_real_arithmetic(vs, ha) == real_path)
+            loc_en = local_energies_of_path(vs, ha)
+            assert(np.iscomplexobj(loc_en) != real_path)
+            if real_path:
+                np.testing.assert_allclose(loc_en, local_energies_of_path(vs, ha, False), atol=1.e-12)
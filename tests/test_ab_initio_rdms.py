@@ -0,0 +1,67 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import netket as nk
+from tqdm import tqdm
+from GPSKet.models import qGPS
+from GPSKet.nn.initializers import normal
+from GPSKet.hilbert import FermionicDiscreteHilbert
+from GPSKet.sampler import MetropolisHopping
+from GPSKet.operator.hamiltonian import AbInitioHamiltonianOnTheFly
+from GPSKet.operator.hamiltonian.ab_initio import (local_RDMs_accumulated, local_en_on_the_fly_blockwise, symmetrize_eri_RDM,
+                                                   get_packed_eri_index, pack_eri)
+
+
+key_in, key_ma = jax.random.split(jax.random.PRNGKey(np.random.randint(0, 100)))
+rng = np.random.default_rng(np.random.randint(0, 100))
+B = 32
+L = 5
+n_elec = (2, 2)
+dtype = jnp.complex128
+orbital_subset = [0, 2, 3]
+
+hi = FermionicDiscreteHilbert(L, n_elec=n_elec)
+ma = qGPS(hi, 2, dtype=dtype, init_fun=normal(0.5, dtype=dtype))
+x = jnp.asarray(hi.random_state(key_in, B), jnp.uint8)
+variables = ma.init(key_ma, x)
+vs = nk.vqs.MCState(MetropolisHopping(hi), ma, n_samples=B, variables=variables)
+
+# Random real integrals with the 8-fold permutation symmetries and complex integrals with the symmetries of complex orbitals
+factors = rng.normal(size=(3, L, L))
+factors_complex = factors + 1.j * rng.normal(size=(3, L, L))
+integrals = []
+for f, h1 in [(factors + np.swapaxes(factors, 1, 2), rng.normal(size=(L, L))),
+              (factors_complex + np.conj(np.swapaxes(factors_complex, 1, 2)), rng.normal(size=(L, L)) + 1.j * rng.normal(size=(L, L)))]:
+    integrals.append((h1 + np.conj(h1.T), np.einsum("Ppq,Prs->pqrs", f, f)))
+
+# Test #1
+# The accumulated RDMs should be equal to the means of the local RDMs of the blockwise kernel (after the symmetrization
+# of the eri_RDM), also for chunked accumulation, an orbital subset and the packed format (for real integrals)
+for h1, h2 in tqdm(integrals, desc="Test #1"):
+    real_integrals = not np.iscomplexobj(h2)
+    ha = AbInitioHamiltonianOnTheFly(hi, h1, h2)
+    _, args = nk.vqs.get_local_kernel_arguments(vs, ha)
+    local_en, t_RDM, eri_RDM = local_en_on_the_fly_blockwise(hi._n_elec, ma.apply, variables, x, args, return_local_RDMs=True)
+    t_RDM_ref = np.mean(t_RDM, axis=0)
+    eri_RDM_ref = symmetrize_eri_RDM(np.mean(eri_RDM, axis=0), real_integrals=real_integrals, xp=np)
+
+    for chunk_size in [None, 5]:
+        en, t_RDM, eri_RDM = local_RDMs_accumulated(hi._n_elec, ma.apply, variables, x, args, chunk_size=chunk_size)
+        np.testing.assert_allclose(en, np.mean(local_en))
+        np.testing.assert_allclose(t_RDM, t_RDM_ref, atol=1.e-12)
+        np.testing.assert_allclose(eri_RDM, eri_RDM_ref, atol=1.e-12)
+        np.testing.assert_allclose(np.sum(ha.t_mat * t_RDM) + np.sum(h2 * eri_RDM), en)
+
+        en, t_RDM, eri_RDM = local_RDMs_accumulated(hi._n_elec, ma.apply, variables, x, args, chunk_size=chunk_size,
+                                                    orbital_subset=jnp.array(orbital_subset))
+        np.testing.assert_allclose(t_RDM, t_RDM_ref[np.ix_(orbital_subset, orbital_subset)], atol=1.e-12)
+        np.testing.assert_allclose(eri_RDM, eri_RDM_ref[np.ix_(orbital_subset, orbital_subset, orbital_subset, orbital_subset)], atol=1.e-12)
+
+        if real_integrals:
+            en, t_RDM, eri_RDM = local_RDMs_accumulated(hi._n_elec, ma.apply, variables, x, args, chunk_size=chunk_size, packed=True)
+            packed_ids = get_packed_eri_index(*np.indices((L,)*4), xp=np)[0]
+            eri_RDM_packed_ref = np.zeros(eri_RDM.shape, dtype=eri_RDM_ref.dtype)
+            np.add.at(eri_RDM_packed_ref, packed_ids, eri_RDM_ref)
+            np.testing.assert_allclose(t_RDM, t_RDM_ref, atol=1.e-12)
+            np.testing.assert_allclose(eri_RDM, eri_RDM_packed_ref, atol=1.e-12)
+            np.testing.assert_allclose(np.sum(ha.t_mat * t_RDM) + np.sum(pack_eri(h2) * eri_RDM), en)
@@ -0,0 +1,117 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import netket as nk
+from tqdm import tqdm
+from GPSKet.models import qGPS
+from GPSKet.nn.initializers import normal
+from GPSKet.hilbert import FermionicDiscreteHilbert
+from GPSKet.sampler import MetropolisHopping
+from GPSKet.operator.hamiltonian import AbInitioHamiltonianSparse
+
+
+key_in, key_ma = jax.random.split(jax.random.PRNGKey(np.random.randint(0, 100)))
+rng = np.random.default_rng(np.random.randint(0, 100))
+B = 8
+L = 6
+n_elec = (2, 2)
+M = 2
+dtype = jnp.complex128
+
+# Random integrals with the (8-fold) permutation symmetries of real orbitals
+h1 = rng.normal(size=(L, L))
+h1 = 0.5 * (h1 + h1.T)
+factors = rng.normal(size=(3, L, L))
+factors = 0.5 * (factors + np.swapaxes(factors, 1, 2))
+h2 = np.einsum("Ppq,Prs->pqrs", factors, factors)
+
+hi = FermionicDiscreteHilbert(L, n_elec=n_elec)
+ma = qGPS(hi, M, dtype=dtype, init_fun=normal(0.5, dtype=dtype))
+x = jnp.asarray(hi.random_state(key_in, B), jnp.uint8)
+variables = ma.init(key_ma, x)
+vs = nk.vqs.MCState(MetropolisHopping(hi), ma, n_samples=B, variables=variables)
+
+def local_energies(ha):
+    _, args = nk.vqs.get_local_kernel_arguments(vs, ha)
+    kernel = nk.vqs.get_local_kernel(vs, ha)
+    return jax.jit(lambda args: kernel(ma.apply, variables, x, args))(args)
+
+# Number of exactly evaluated two-body entries of all occupied (i,j) pairs for each of the samples
+def work_list_sizes(ha):
+    row_lengths = ha.h2_screened_end - ha.h2_nonzero_range[:, :-1]
+    sizes = []
+    for sample in np.asarray(x):
+        up_occ = np.nonzero(sample & 1)[0]
+        down_occ = np.nonzero(sample & 2)[0]
+        size = np.sum(np.triu(row_lengths[np.ix_(up_occ, up_occ)], k=1))
+        size += np.sum(np.triu(row_lengths[np.ix_(down_occ, down_occ)], k=1))
+        size += np.sum(row_lengths[np.ix_(up_occ, down_occ)])
+        sizes.append(size)
+    return np.array(sizes)
+
+# Test #1
+# The local energies with the flat work list should be equal to those of the default sparse kernel (with and without
+# chunking of the excitations). For the dense integrals all rows have the same length, so that the work-list size is
+# reached by every sample (i.e. the bound is tight), for pruned integrals and with a screening of the small entries
+# (without stochastic estimate) the rows have different lengths
+pruning_threshold = np.median(abs(h2))
+screening_threshold = np.quantile(abs(h2[abs(h2) > pruning_threshold]), 0.5)
+for kwargs in tqdm([{}, {"pruning_threshold": pruning_threshold},
+                    {"screening_threshold": screening_threshold, "n_stochastic_excitations": 0}], desc="Test #1"):
+    loc_en_ref = local_energies(AbInitioHamiltonianSparse(hi, h1, h2, **kwargs))
+    ha = AbInitioHamiltonianSparse(hi, h1, h2, use_flat_work_list=True, **kwargs)
+    sizes = work_list_sizes(ha)
+    assert(np.all(sizes <= ha.get_max_work_list_size()))
+    if len(kwargs) == 0:
+        assert(np.all(sizes == ha.get_max_work_list_size()))
+    for excitation_chunk_size in [None, 7]:
+        ha = AbInitioHamiltonianSparse(hi, h1, h2, use_flat_work_list=True, excitation_chunk_size=excitation_chunk_size, **kwargs)
+        np.testing.assert_allclose(local_energies(ha), loc_en_ref)
+
+# Reference construction of the sparse (CSR) tables with explicit loops over the rows
+def sparse_tables_reference(h_mat, eri_mat, pruning_threshold):
+    n_orbs = h_mat.shape[0]
+    h1_range = np.zeros(n_orbs + 1, dtype=int)
+    h1_ids = []
+    h1_vals = []
+    for i in range(n_orbs):
+        nonzeros = np.nonzero(abs(h_mat[i, :]) > pruning_threshold)[0]
+        h1_range[i+1] = h1_range[i] + len(nonzeros)
+        h1_ids.extend(nonzeros)
+        h1_vals.extend(h_mat[i, nonzeros])
+    h2_range = np.zeros((n_orbs, n_orbs + 1), dtype=int)
+    h2_rows = []
+    for i in range(n_orbs):
+        if i > 0:
+            h2_range[i, 0] = h2_range[i-1, -1]
+        for j in range(n_orbs):
+            nonzeros = np.array(np.nonzero(abs(eri_mat[i, :, j, :]) > pruning_threshold))
+            h2_range[i, j+1] = h2_range[i, j] + nonzeros.shape[1]
+            h2_rows.append({(a, b): eri_mat[i, a, j, b] for a, b in nonzeros.T})
+    return h1_range, np.array(h1_ids), np.array(h1_vals), h2_range, h2_rows
+
+# Test #2
+# The vectorized set up of the sparse tables (from the dense integrals or from a COO list of the integrals) should give the
+# same tables as a construction with loops over the rows for different pruning thresholds (within each (i,j) row the
+# entries are sorted by magnitude, so that only the content of the rows is compared). The Coulomb and exchange tables set
+# up from the (pruned) COO list should be those of the pruned dense integrals
+coo_ids = np.array(np.nonzero(h2)).T
+coo = (coo_ids, h2[tuple(coo_ids.T)])
+for pruning_threshold in tqdm([0., np.median(abs(h2)), np.quantile(abs(h2), 0.9)], desc="Test #2"):
+    h1_range, h1_ids, h1_vals, h2_range, h2_rows = sparse_tables_reference(h1, h2, pruning_threshold)
+    h2_pruned = np.where(abs(h2) > pruning_threshold, h2, 0.)
+    ha_pruned = AbInitioHamiltonianSparse(hi, h1, h2_pruned)
+    for ha in [AbInitioHamiltonianSparse(hi, h1, h2, pruning_threshold=pruning_threshold),
+               AbInitioHamiltonianSparse(hi, h1, eri_coo=coo, pruning_threshold=pruning_threshold)]:
+        np.testing.assert_array_equal(ha.h1_nonzero_range, h1_range)
+        np.testing.assert_array_equal(ha.h1_nonzero_ids_flat, h1_ids)
+        np.testing.assert_array_equal(ha.h1_nonzero_vals_flat, h1_vals)
+        np.testing.assert_array_equal(ha.h2_nonzero_range, h2_range)
+        for row, (start, end) in enumerate(zip(h2_range[:, :-1].flatten(), h2_range[:, 1:].flatten())):
+            entries = {(a, b): val for (a, b), val in zip(ha.h2_nonzero_ids_flat[start:end], ha.h2_nonzero_vals_flat[start:end])}
+            assert(entries == h2_rows[row])
+            assert(np.all(np.diff(abs(ha.h2_nonzero_vals_flat[start:end])) <= 0.))
+    # The dense integrals are only reconstructed from the sparse tables if these were set up from the COO list
+    np.testing.assert_allclose(ha.get_dense_eri(), h2_pruned)
+    for table in ["t_mat", "j_mat", "k_mat", "eri_j", "eri_k"]:
+        np.testing.assert_allclose(getattr(ha, table), getattr(ha_pruned, table), atol=1.e-12)
@@ -0,0 +1,65 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import netket as nk
+from tqdm import tqdm
+from GPSKet.models import qGPS
+from GPSKet.nn.initializers import normal
+from GPSKet.hilbert import FermionicDiscreteHilbert
+from GPSKet.sampler import MetropolisHopping
+from GPSKet.operator.hamiltonian import AbInitioHamiltonianOnTheFly, AbInitioHamiltonianSparse
+
+
+key_in, key_ma = jax.random.split(jax.random.PRNGKey(np.random.randint(0, 100)))
+rng = np.random.default_rng(np.random.randint(0, 100))
+B = 8
+L = 6
+n_elec = [2, 2]
+M = 2
+n_keys = 400
+dtype = jnp.complex128
+
+# Random integrals with the (8-fold) permutation symmetries of real orbitals
+h1 = rng.normal(size=(L, L))
+h1 = 0.5 * (h1 + h1.T)
+factors = rng.normal(size=(3, L, L))
+factors = 0.5 * (factors + np.swapaxes(factors, 1, 2))
+h2 = np.einsum("Ppq,Prs->pqrs", factors, factors)
+
+hi = FermionicDiscreteHilbert(L, n_elec=n_elec)
+ma = qGPS(hi, M, dtype=dtype, init_fun=normal(0.5, dtype=dtype))
+x = jnp.asarray(hi.random_state(key_in, B), jnp.uint8)
+variables = ma.init(key_ma, x)
+vs = nk.vqs.MCState(MetropolisHopping(hi), ma, n_samples=B, variables=variables)
+
+def local_energies(ha, stochastic_keys=None):
+    _, args = nk.vqs.get_local_kernel_arguments(vs, ha)
+    kernel = nk.vqs.get_local_kernel(vs, ha)
+    if stochastic_keys is None:
+        return jax.jit(lambda args: kernel(ma.apply, variables, x, args))(args)
+    # Evaluate the local energies for all keys of the stochastic estimate
+    return jax.jit(jax.vmap(lambda key: kernel(ma.apply, variables, x, (*args[:-1], key))))(stochastic_keys)
+
+ha_exact = AbInitioHamiltonianOnTheFly(hi, h1, h2)
+loc_en_exact = local_energies(ha_exact)
+
+# Test #1
+# Without screening (and with a vanishing screening threshold) the sparse Hamiltonian
+# should reproduce the deterministic local energies
+for screening_threshold in tqdm([None, 0.], desc="Test #1"):
+    ha = AbInitioHamiltonianSparse(hi, h1, h2, screening_threshold=screening_threshold)
+    np.testing.assert_allclose(local_energies(ha), loc_en_exact)
+
+# Test #2
+# The semistochastic estimate of the screened contributions should be unbiased, i.e. the mean
+# over different keys should converge to the exact local energies (within the statistical error)
+screening_threshold = np.quantile(abs(h2[abs(h2) > 0.]), 0.75)
+ha = AbInitioHamiltonianSparse(hi, h1, h2, screening_threshold=screening_threshold, n_stochastic_excitations=4)
+assert(np.any(ha.h2_screened_end < ha.h2_nonzero_range[:, 1:]))
+keys = jax.random.split(jax.random.PRNGKey(np.random.randint(0, 100)), n_keys)
+loc_ens = np.asarray(local_energies(ha, keys))
+assert(np.max(np.abs(loc_ens - loc_en_exact)) > 1.e-8)
+mean = np.mean(loc_ens, axis=0)
+for part in [np.real, np.imag]:
+    std_err = np.std(part(loc_ens), axis=0) / np.sqrt(n_keys)
+    assert(np.all(np.abs(part(mean) - part(loc_en_exact)) < 5 * std_err + 1.e-10))
@@ -0,0 +1,49 @@
+import numpy as np
+import netket as nk
+from tqdm import tqdm
+from GPSKet.operator.asep import apply_creation, apply_annihilation, apply_hopping, apply_particle_hole
+from GPSKet.operator.hamiltonian import AsymmetricSimpleExclusionProcess
+
+
+rng = np.random.default_rng(np.random.randint(0, 100))
+L = 6
+
+# Reference construction of the connected configurations and matrix elements of a single configuration,
+# generating all terms (including the ones with vanishing matrix elements)
+def get_conn_reference(x, lambd, alpha, beta, gamma, delta, p, q):
+    exp_lambd = np.exp(lambd)
+    exp_minus_lambd = np.exp(-lambd)
+    x_primes = []
+    mels = []
+    def add_term(fun):
+        x_prime = x.copy()
+        mels.append(fun(x_prime))
+        x_primes.append(x_prime)
+    add_term(lambda x_prime: alpha * exp_lambd * apply_creation(0, x_prime))
+    add_term(lambda x_prime: -alpha * (1-x_prime[0]))
+    add_term(lambda x_prime: gamma * exp_minus_lambd * apply_annihilation(0, x_prime))
+    add_term(lambda x_prime: -gamma * x_prime[0])
+    add_term(lambda x_prime: beta * exp_minus_lambd * apply_creation(L-1, x_prime))
+    add_term(lambda x_prime: -beta * (1-x_prime[L-1]))
+    add_term(lambda x_prime: delta * exp_lambd * apply_annihilation(L-1, x_prime))
+    add_term(lambda x_prime: -delta * x_prime[L-1])
+    for i in range(L-1):
+        add_term(lambda x_prime: p * exp_lambd * apply_hopping(i, i+1, x_prime))
+        add_term(lambda x_prime: -p * apply_particle_hole(i, i+1, x_prime))
+        add_term(lambda x_prime: q * exp_minus_lambd * apply_hopping(i+1, i, x_prime))
+        add_term(lambda x_prime: -q * apply_particle_hole(i+1, i, x_prime))
+    return np.array(x_primes), np.array(mels)
+
+# Test #1
+# The dense matrix of the ASEP generator (from the connected configurations of get_conn_flattened) should be equal
+# to the reference construction for random rates (including vanishing rates)
+hi = nk.hilbert.Qubit(L)
+states = hi.all_states()
+for rates in tqdm([rng.uniform(size=6), np.array([0.3, 0., 0.7, 0., 0.4, 0.]), np.array([0., 0.5, 0., 0.2, 0., 0.9])], desc="Test #1"):
+    lambd = rng.normal()
+    ha = AsymmetricSimpleExclusionProcess(hi, lambd, *rates)
+    matrix_ref = np.zeros((hi.n_states, hi.n_states))
+    for k, state in enumerate(states):
+        x_primes, mels = get_conn_reference(np.array(state), lambd, *rates)
+        np.add.at(matrix_ref, (k, hi.states_to_numbers(x_primes)), mels)
+    np.testing.assert_allclose(ha.to_dense(), matrix_ref, atol=1.e-14)
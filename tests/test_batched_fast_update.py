@@ -0,0 +1,79 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import netket as nk
+from tqdm import tqdm
+from GPSKet.models import qGPS, Slater, ARqGPSFull, apply_batched_fast_updates
+from GPSKet.models.qGPS import no_syms, get_sym_transformation_spin
+from GPSKet.hilbert import FermionicDiscreteHilbert
+
+
+key_in, key_ma = jax.random.split(jax.random.PRNGKey(np.random.randint(0, 100)))
+rng = np.random.default_rng(np.random.randint(0, 100))
+L = 8
+n_updates = 7
+dtype = jnp.complex128
+
+# Evaluates the log-amplitudes of the updates of the base configuration x (with a batch size of one) with the batched
+# fast updates for different chunk sizes (none, one not dividing the number of updates and one exceeding it)
+# and compares these to the fast updates of the single configurations as well as to the full evaluation
+def check_batched_fast_updates(ma, x, update_sites, updated_configs):
+    variables = ma.init(key_ma, x)
+    _, cache = ma.apply(variables, x, mutable="intermediates_cache", cache_intermediates=True)
+    parameters = {**variables, **cache}
+    updated_occ = jnp.take_along_axis(updated_configs, update_sites, axis=1)
+    log_psi_ref = np.array([ma.apply(parameters, updated_occ[k:k+1], update_sites=update_sites[k:k+1])[0]
+                            for k in range(update_sites.shape[0])])
+    log_psi_full = ma.apply(variables, updated_configs)
+    # The log-amplitudes can differ by multiples of 2*pi*i
+    np.testing.assert_allclose(np.exp(log_psi_ref - log_psi_full), 1.)
+    for excitation_chunk_size in [None, 3, 2*n_updates]:
+        log_psi = apply_batched_fast_updates(ma.apply, parameters, updated_occ, update_sites,
+                                             excitation_chunk_size=excitation_chunk_size)
+        assert(log_psi.shape == (n_updates,))
+        np.testing.assert_allclose(np.exp(log_psi - log_psi_ref), 1.)
+
+# Test #1
+# Batched fast updates of double spin flips of a spin configuration for the qGPS (without and with symmetries)
+# and the ARqGPSFull (where the cache is of shape (B, L, M, T))
+hi = nk.hilbert.Spin(1/2, L)
+x = hi.random_state(key_in, 1)
+update_sites = []
+updated_configs = []
+for _ in range(n_updates):
+    sites = rng.choice(L, size=2, replace=False)
+    config = np.array(x[0])
+    config[sites] = -config[sites]
+    update_sites.append(sites)
+    updated_configs.append(config)
+update_sites = jnp.array(update_sites)
+updated_configs = jnp.array(updated_configs)
+
+symmetries = get_sym_transformation_spin(nk.graph.Chain(L))
+models = [qGPS(hi, 2, dtype=dtype, syms=no_syms()),
+          qGPS(hi, 2, dtype=dtype, syms=symmetries),
+          ARqGPSFull(hi, 2, dtype=dtype),
+          ARqGPSFull(hi, 2, dtype=dtype, apply_symmetries=symmetries)]
+for ma in tqdm(models, desc="Test #1"):
+    check_batched_fast_updates(ma, x, update_sites, updated_configs)
+
+# Test #2
+# Batched fast updates of single electron hops for the Slater determinant
+hi = FermionicDiscreteHilbert(L, n_elec=(3, 3))
+x = jnp.asarray(hi.random_state(key_in, 1), jnp.uint8)
+update_sites = []
+updated_configs = []
+for _ in range(n_updates):
+    config = np.array(x[0])
+    spin = rng.choice([1, 2])
+    i = rng.choice(np.nonzero(config & spin)[0])
+    a = rng.choice(np.nonzero(~config & spin)[0])
+    config[i] -= spin
+    config[a] += spin
+    update_sites.append([i, a])
+    updated_configs.append(config)
+update_sites = jnp.array(update_sites)
+updated_configs = jnp.array(updated_configs)
+
+for kwargs in tqdm([{}, {"n_determinants": 3}, {"fixed_magnetization": False}], desc="Test #2"):
+    check_batched_fast_updates(Slater(hi, dtype=dtype, **kwargs), x, update_sites, updated_configs)
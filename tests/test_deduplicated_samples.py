@@ -0,0 +1,42 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import netket as nk
+from tqdm import tqdm
+from GPSKet.models import qGPS
+from GPSKet.vqs import MCStateDeduplicatedSamples
+
+
+seed = np.random.randint(0, 100)
+L = 6
+M = 2
+n_samples = 512
+dtype = jnp.complex128
+
+g = nk.graph.Chain(length=L, pbc=True)
+hi = nk.hilbert.Spin(1/2, N=g.n_nodes)
+ha = nk.operator.Ising(hi, g, h=1.0)
+ma = qGPS(hi, M, dtype=dtype)
+sa = nk.sampler.MetropolisLocal(hi, n_chains=16)
+
+# Test #1
+# For the same samples, the mean, the error of the mean and the gradient evaluated
+# over the unique configurations should be equal to the ones of the standard MCState
+for chunk_size in tqdm([None, 32], desc="Test #1"):
+    vs = nk.vqs.MCState(sa, ma, n_samples=n_samples, seed=seed, sampler_seed=seed, chunk_size=chunk_size)
+    vs_dedup = MCStateDeduplicatedSamples(sa, ma, n_samples=n_samples, variables=vs.variables, sampler_seed=seed,
+                                          chunk_size=chunk_size)
+    np.testing.assert_array_equal(vs.samples, vs_dedup.samples)
+    unique_samples, inverse = vs_dedup.get_unique_samples(chunk_size)
+    assert(len(np.unique(inverse)) < n_samples)
+    np.testing.assert_array_equal(unique_samples[inverse], vs.samples)
+
+    stats, grad = vs.expect_and_grad(ha)
+    stats_dedup, grad_dedup = vs_dedup.expect_and_grad(ha)
+    np.testing.assert_allclose(stats_dedup.mean, stats.mean)
+    np.testing.assert_allclose(stats_dedup.error_of_mean, stats.error_of_mean)
+    jax.tree_map(np.testing.assert_allclose, grad_dedup, grad)
+
+    stats_dedup = vs_dedup.expect(ha)
+    np.testing.assert_allclose(stats_dedup.mean, stats.mean)
+    np.testing.assert_allclose(stats_dedup.error_of_mean, stats.error_of_mean)
@@ -0,0 +1,120 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import netket as nk
+import netket.jax as nkjax
+from tqdm import tqdm
+from GPSKet.models import qGPS, Slater
+from GPSKet.nn.initializers import normal
+from GPSKet.hilbert import FermionicDiscreteHilbert
+from GPSKet.sampler import MetropolisHopping
+from GPSKet.operator.fermion import apply_hopping
+from GPSKet.operator.hamiltonian import FermiHubbard, get_Fermi_Hubbard_Hamiltonian, get_hopping_from_graph
+from GPSKet.operator.hamiltonian.ab_initio import use_real_arithmetic
+
+
+key_in, key_ma = jax.random.split(jax.random.PRNGKey(np.random.randint(0, 100)))
+rng = np.random.default_rng(np.random.randint(0, 100))
+L = 5
+U = 2.3
+B = 8
+M = 2
+
+# Reference construction of the connected configurations and matrix elements of a single configuration,
+# generating all four hops of each edge (including the forbidden ones with vanishing matrix elements)
+def get_conn_reference(x, U, edges, t):
+    is_occ_up = (x & 1).astype(bool)
+    is_occ_down = (x & 2).astype(bool)
+    up_count = np.cumsum(is_occ_up)
+    down_count = np.cumsum(is_occ_down)
+    x_primes = [x.copy()]
+    mels = [U * np.sum(x == 3)]
+    for edge, t_edge in zip(edges, t):
+        for spin_int, cumulative_count in [(1, up_count), (2, down_count)]:
+            for annihilate_site, create_site in [(edge[0], edge[1]), (edge[1], edge[0])]:
+                x_prime = x.copy()
+                mels.append(-t_edge * apply_hopping(annihilate_site, create_site, x_prime, spin_int, cummulative_count=cumulative_count))
+                x_primes.append(x_prime)
+    return np.array(x_primes), np.array(mels)
+
+def dense_matrix_reference(hi, get_conn):
+    states = hi.all_states()
+    matrix = np.zeros((hi.n_states, hi.n_states))
+    for k, state in enumerate(states):
+        x_primes, mels = get_conn(np.asarray(state, dtype=np.uint8))
+        np.add.at(matrix, (k, hi.states_to_numbers(x_primes.astype(states.dtype))), mels)
+    return matrix
+
+# Test #1
+# The dense matrix of the Hubbard Hamiltonian (from the connected configurations of get_conn_flattened) should be equal
+# to the reference construction for different edge sets (with random and vanishing hoppings, as well as self-loop edges)
+# and fixed or unconstrained electron numbers
+chain_edges = [(i, i+1) for i in range(L-1)]
+next_nearest_edges = [(i, i+2) for i in range(L-2)]
+self_loop_edges = [(0, 0), (3, 3)]
+for n_elec in tqdm([(2, 1), (2, 2), None], desc="Test #1"):
+    hi = FermionicDiscreteHilbert(L, n_elec=n_elec)
+    for edges in [chain_edges, chain_edges + next_nearest_edges, chain_edges + self_loop_edges]:
+        t = rng.normal(size=len(edges))
+        t[1] = 0.
+        ha = FermiHubbard(hi, edges, U=U, t=t)
+        matrix_ref = dense_matrix_reference(hi, lambda x: get_conn_reference(x, U, ha.edges, t))
+        np.testing.assert_allclose(ha.to_dense(), matrix_ref, atol=1.e-14)
+
+# Test #2
+# On a chain with nearest and next-nearest neighbour hoppings (i.e. edges of two colors), the local energies with the
+# vectorized hopping (evaluating at most max_hops allowed hops) should be equal to those of the per-edge kernel and to those
+# from the explicitly generated connected configurations, with and without chunking of the excitations, with and without
+# fast updating and for complex and real models
+graph = nk.graph.Chain(6, max_neighbor_order=2)
+t = (1., 0.3)
+edges, hoppings = get_hopping_from_graph(graph, t)
+assert(len(edges) == graph.n_edges)
+for color, t_color in enumerate(t):
+    assert(sorted(edge for edge, t_edge in zip(edges, hoppings) if t_edge == t_color) == sorted(graph.edges(filter_color=color)))
+
+# Local energies of the variational state, the evaluation path chosen by the kernel can be overridden with real_arithmetic
+def local_energies(vs, ha, real_arithmetic=None):
+    _, args = nk.vqs.get_local_kernel_arguments(vs, ha)
+    kernel = nk.vqs.get_local_kernel(vs, ha)
+    if real_arithmetic is not None:
+        kernel = nkjax.HashablePartial(kernel.func, *kernel.args, **{**kernel.keywords, "real_arithmetic": real_arithmetic})
+    return jax.jit(lambda args: kernel(vs._apply_fun, vs.variables, vs.samples.reshape((-1, vs.hilbert.size)), args))(args)
+
+for n_elec in tqdm([(2, 2), (3, 1)], desc="Test #2"):
+    ha_exact = get_Fermi_Hubbard_Hamiltonian(graph, U, t, n_elec)
+    hi = ha_exact.hilbert
+    for dtype, apply_fast_update in [(jnp.complex128, True), (jnp.complex128, False), (jnp.float64, True)]:
+        ma = qGPS(hi, M, dtype=dtype, init_fun=normal(0.5, dtype=dtype), apply_fast_update=apply_fast_update)
+        vs = nk.vqs.MCState(MetropolisHopping(hi), ma, n_samples=B, seed=key_ma, sampler_seed=key_in)
+        x = vs.samples.reshape((-1, hi.size))
+        x_conn, mels = ha_exact.get_conn_padded(np.asarray(x))
+        log_amps_conn = vs.log_value(jnp.asarray(x_conn.reshape((-1, hi.size)))).reshape(mels.shape)
+        loc_en_exact = np.sum(mels * np.exp(log_amps_conn - np.expand_dims(vs.log_value(x), -1)), axis=-1)
+        for excitation_chunk_size in [None, 3]:
+            ha_edges = get_Fermi_Hubbard_Hamiltonian(graph, U, t, n_elec, on_the_fly_en=True, excitation_chunk_size=excitation_chunk_size)
+            ha = get_Fermi_Hubbard_Hamiltonian(graph, U, t, n_elec, on_the_fly_en=True, excitation_chunk_size=excitation_chunk_size,
+                                               vectorized_hopping=True)
+            assert(all(max_hops < 2 * len(edges) for max_hops in ha.max_hops))
+            loc_en_edges = local_energies(vs, ha_edges)
+            np.testing.assert_allclose(loc_en_edges, loc_en_exact, atol=1.e-12)
+            np.testing.assert_allclose(local_energies(vs, ha), loc_en_edges, atol=1.e-12)
+
+# Test #3
+# For real models (qGPS, and the Slater determinant for which the amplitudes can be negative) the local energies are
+# evaluated in real arithmetic, these should be equal to the local energies of the complex path (for the per-edge and the
+# vectorized hopping). For complex models, the complex path should be used
+n_elec = (2, 2)
+hi = FermionicDiscreteHilbert(graph.n_nodes, n_elec=n_elec)
+models = [qGPS(hi, M, dtype=jnp.float64, init_fun=normal(0.5, dtype=jnp.float64)), Slater(hi, dtype=jnp.float64),
+          qGPS(hi, M, dtype=jnp.complex128, init_fun=normal(0.5, dtype=jnp.complex128))]
+for ma in tqdm(models, desc="Test #3"):
+    real_path = (ma.dtype == jnp.float64)
+    vs = nk.vqs.MCState(MetropolisHopping(hi), ma, n_samples=B, seed=key_ma, sampler_seed=key_in)
+    for vectorized_hopping in [False, True]:
+        ha = get_Fermi_Hubbard_Hamiltonian(graph, U, t, n_elec, on_the_fly_en=True, vectorized_hopping=vectorized_hopping)
+        assert(use_real_arithmetic(vs, ha) == real_path)
+        loc_en = local_energies(vs, ha)
+        assert(np.iscomplexobj(loc_en) != real_path)
+        if real_path:
+            np.testing.assert_allclose(loc_en, local_energies(vs, ha, False), atol=1.e-12)
@@ -0,0 +1,61 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import netket as nk
+from GPSKet.models import qGPS
+from GPSKet.vqs.mc.mc_state.local_energy_cache import get_local_energies, get_log_values
+from GPSKet.vqs.mc.mc_state.expect import get_local_kernel, get_local_kernel_arguments
+from netket.vqs.mc.mc_state.expect_forces import forces_expect_hermitian
+
+
+seed = np.random.randint(0, 100)
+L = 8
+M = 2
+n_samples = 256
+dtype = jnp.complex128
+
+g = nk.graph.Chain(length=L, pbc=True)
+hi = nk.hilbert.Spin(1/2, N=g.n_nodes)
+ha = nk.operator.Ising(hi, g, h=1.0)
+ma = qGPS(hi, M, dtype=dtype)
+sa = nk.sampler.MetropolisLocal(hi, n_chains=16)
+vs = nk.vqs.MCState(sa, ma, n_samples=n_samples, seed=seed, sampler_seed=seed)
+
+# Test #1
+# The local energies should be evaluated once and reused for the same samples and parameters
+loc_vals = get_local_energies(vs, ha)
+np.testing.assert_allclose(loc_vals, vs.local_estimators(ha).T)
+stats = vs.expect(ha)
+assert(get_local_energies(vs, ha) is loc_vals)
+np.testing.assert_allclose(stats.mean, jnp.mean(loc_vals))
+log_values = get_log_values(vs)
+np.testing.assert_allclose(log_values, vs.log_value(vs.samples.reshape((-1, L))).reshape(vs.samples.shape[:-1]))
+assert(get_log_values(vs) is log_values)
+
+# Test #2
+# The cache should be invalidated after a reset (i.e. for new samples)
+vs.reset()
+loc_vals_reset = get_local_energies(vs, ha)
+assert(loc_vals_reset is not loc_vals)
+np.testing.assert_allclose(loc_vals_reset, vs.local_estimators(ha).T)
+np.testing.assert_allclose(vs.expect(ha).mean, jnp.mean(loc_vals_reset))
+
+# Test #3
+# The cache should be invalidated after an update of the parameters
+vs.parameters = jax.tree_map(lambda x: 1.1 * x, vs.parameters)
+loc_vals_update = get_local_energies(vs, ha)
+assert(loc_vals_update is not loc_vals_reset)
+np.testing.assert_allclose(loc_vals_update, vs.local_estimators(ha).T)
+
+# Test #4
+# The forces from the cached local energies (with and without chunking) and from the fallback
+# for mutable model states should be equal to the NetKet implementation
+samples, args = get_local_kernel_arguments(vs, ha)
+stats_ref, forces_ref, _ = forces_expect_hermitian(get_local_kernel(vs, ha), vs._apply_fun, False, vs.parameters,
+                                                   vs.model_state, samples, args)
+for chunk_size, mutable in [(None, False), (64, False), (None, "batch_stats")]:
+    vs.chunk_size = chunk_size
+    stats, forces = vs.expect_and_forces(ha, mutable=mutable)
+    np.testing.assert_allclose(stats.mean, stats_ref.mean)
+    np.testing.assert_allclose(stats.error_of_mean, stats_ref.error_of_mean)
+    jax.tree_map(np.testing.assert_allclose, forces, forces_ref)
@@ -0,0 +1,65 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import netket as nk
+from tqdm import tqdm
+from netket.operator.spin import sigmax, sigmaz
+from GPSKet.models import qGPS
+from GPSKet.nn.initializers import normal
+from GPSKet.operator import LocalOperatorOnTheFly, expect_multiple
+
+
+seed = np.random.randint(0, 100)
+rng = np.random.default_rng(seed)
+L = 6
+M = 3
+n_samples = 64
+dtype = jnp.complex128
+g = nk.graph.Chain(length=L, pbc=True)
+
+def random_local_operator(hi):
+    local_size = hi.local_size
+    op = nk.operator.LocalOperator(hi, [rng.normal(size=(local_size**3,)*2) + 1j*rng.normal(size=(local_size**3,)*2)], [[1, 4, 2]])
+    op += nk.operator.LocalOperator(hi, [np.diag(rng.normal(size=local_size**2))], [[0, 5]])
+    return op + 0.7
+
+hi = nk.hilbert.Spin(1/2, N=L)
+hi_spin_one = nk.hilbert.Spin(1, N=L)
+operators = [
+    nk.operator.Ising(hi, g, h=0.7),
+    nk.operator.PauliStrings(hi, ["XYZIII", "IIZZIX", "IIIIII", "ZIIIIZ"], [1., 0.5, 0.3, -0.2]),
+    random_local_operator(hi),
+    sum(sigmax(hi_spin_one, i) @ sigmax(hi_spin_one, (i+1) % L) + 0.3 * sigmaz(hi_spin_one, i) for i in range(L)),
+    random_local_operator(hi_spin_one),
+]
+
+def get_vstate(hilbert, apply_fast_update=True, chunk_size=None):
+    ma = qGPS(hilbert, M, dtype=dtype, init_fun=normal(0.3, dtype=dtype), apply_fast_update=apply_fast_update)
+    sa = nk.sampler.MetropolisLocal(hilbert, n_chains=8)
+    return nk.vqs.MCState(sa, ma, n_samples=n_samples, seed=seed, sampler_seed=seed, chunk_size=chunk_size)
+
+# Test #1
+# The local estimators evaluated on the fly (with and without fast updating) should be
+# equal to the local estimators of the wrapped operator
+for op in tqdm(operators, desc="Test #1"):
+    for apply_fast_update in [True, False]:
+        vs = get_vstate(op.hilbert, apply_fast_update=apply_fast_update)
+        loc_vals = vs.local_estimators(op)
+        for excitation_chunk_size in [None, 3]:
+            op_otf = LocalOperatorOnTheFly(op, excitation_chunk_size=excitation_chunk_size)
+            np.testing.assert_allclose(vs.local_estimators(op_otf), loc_vals)
+
+# Test #2
+# The stacked statistics of expect_multiple should be equal to the statistics
+# of the operators evaluated separately
+for hilbert in tqdm([hi, hi_spin_one], desc="Test #2"):
+    ops = [op for op in operators if op.hilbert == hilbert]
+    for chunk_size in [None, 16]:
+        vs = get_vstate(hilbert, chunk_size=chunk_size)
+        stats = expect_multiple(vs, ops)
+        for k, op in enumerate(ops):
+            stats_ref = vs.expect(op)
+            np.testing.assert_allclose(stats.mean[k], stats_ref.mean)
+            np.testing.assert_allclose(stats.error_of_mean[k], stats_ref.error_of_mean)
+            np.testing.assert_allclose(stats.variance[k], stats_ref.variance)
+            np.testing.assert_allclose(stats.R_hat[k], stats_ref.R_hat)
@@ -0,0 +1,67 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import netket as nk
+from tqdm import tqdm
+from GPSKet.models import qGPS
+from GPSKet.nn.initializers import normal
+from GPSKet.hilbert import FermionicDiscreteHilbert
+from GPSKet.sampler import MetropolisHopping
+from GPSKet.operator.hamiltonian import (AbInitioHamiltonianOnTheFly, AbInitioHamiltonianSparse, get_Fermi_Hubbard_Hamiltonian,
+                                         get_J1_J2_Hamiltonian)
+
+
+key_in, key_ma = jax.random.split(jax.random.PRNGKey(np.random.randint(0, 100)))
+rng = np.random.default_rng(np.random.randint(0, 100))
+B = 8
+L = 6
+n_elec = (2, 2)
+M = 2
+
+# Random integrals with the (8-fold) permutation symmetries of real orbitals
+h1 = rng.normal(size=(L, L))
+h1 = 0.5 * (h1 + h1.T)
+factors = rng.normal(size=(3, L, L))
+factors = 0.5 * (factors + np.swapaxes(factors, 1, 2))
+h2 = np.einsum("Ppq,Prs->pqrs", factors, factors)
+
+def local_energies(vs, ha):
+    _, args = nk.vqs.get_local_kernel_arguments(vs, ha)
+    kernel = nk.vqs.get_local_kernel(vs, ha)
+    return jax.jit(lambda args: kernel(vs._apply_fun, vs.variables, vs.samples.reshape((-1, vs.hilbert.size)), args))(args)
+
+# Compares the local energies with mixed precision (which should be returned in double precision) to those in double precision
+def check_mixed_precision(vs, ha, ha_mixed, out_dtype):
+    loc_en = local_energies(vs, ha)
+    loc_en_mixed = local_energies(vs, ha_mixed)
+    assert(loc_en.dtype == out_dtype)
+    assert(loc_en_mixed.dtype == out_dtype)
+    # The single precision evaluation of the model should only agree to single precision accuracy
+    assert(np.max(abs(loc_en_mixed - loc_en)) > 0.)
+    np.testing.assert_allclose(loc_en_mixed, loc_en, rtol=1.e-3, atol=1.e-3)
+
+# Test #1
+# Mixed precision local energies of the ab initio (dense and sparse) and the Hubbard Hamiltonians for complex and real models
+hi = FermionicDiscreteHilbert(L, n_elec=n_elec)
+x = jnp.asarray(hi.random_state(key_in, B), jnp.uint8)
+graph = nk.graph.Chain(L)
+hamiltonians = [lambda mixed_precision: AbInitioHamiltonianOnTheFly(hi, h1, h2, mixed_precision=mixed_precision),
+                lambda mixed_precision: AbInitioHamiltonianSparse(hi, h1, h2, mixed_precision=mixed_precision),
+                lambda mixed_precision: get_Fermi_Hubbard_Hamiltonian(graph, 4., 1., n_elec, on_the_fly_en=True,
+                                                                      mixed_precision=mixed_precision),
+                lambda mixed_precision: get_Fermi_Hubbard_Hamiltonian(graph, 4., 1., n_elec, on_the_fly_en=True,
+                                                                      mixed_precision=mixed_precision, vectorized_hopping=True)]
+for dtype, out_dtype in tqdm([(jnp.complex128, jnp.complex128), (jnp.float64, jnp.float64)], desc="Test #1"):
+    ma = qGPS(hi, M, dtype=dtype, init_fun=normal(0.5, dtype=dtype))
+    vs = nk.vqs.MCState(MetropolisHopping(hi), ma, n_samples=B, variables=ma.init(key_ma, x))
+    for get_hamiltonian in hamiltonians:
+        check_mixed_precision(vs, get_hamiltonian(False), get_hamiltonian(True), out_dtype)
+
+# Test #2
+# Mixed precision local energies of the J1-J2 Hamiltonian for complex and real models
+ha = get_J1_J2_Hamiltonian(L, J2=0.5, sign_rule=[True, False], on_the_fly_en=True)
+ha_mixed = get_J1_J2_Hamiltonian(L, J2=0.5, sign_rule=[True, False], on_the_fly_en=True, mixed_precision=True)
+for dtype, out_dtype in tqdm([(jnp.complex128, jnp.complex128), (jnp.float64, jnp.float64)], desc="Test #2"):
+    ma = qGPS(ha.hilbert, M, dtype=dtype, init_fun=normal(0.5, dtype=dtype))
+    vs = nk.vqs.MCState(nk.sampler.MetropolisExchange(ha.hilbert, graph=ha.graph), ma, n_samples=B, seed=key_ma)
+    check_mixed_precision(vs, ha, ha_mixed, out_dtype)
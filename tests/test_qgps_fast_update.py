@@ -0,0 +1,72 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import netket as nk
+from tqdm import tqdm
+from netket.utils import HashableArray
+from GPSKet.models import qGPS, PlaquetteqGPS
+from GPSKet.models.qGPS import get_sym_transformation_spin
+from GPSKet.nn.initializers import normal
+
+
+key_in, key_ma = jax.random.split(jax.random.PRNGKey(np.random.randint(0, 100)))
+rng = np.random.default_rng(np.random.randint(0, 100))
+B = 8
+L = 9
+M = 3
+n_updates = 4
+dtype = jnp.complex128
+
+g = nk.graph.Square(3, pbc=True)
+hi = nk.hilbert.Spin(1/2, N=g.n_nodes)
+syms = get_sym_transformation_spin(g)
+plaquettes = HashableArray(np.array([[(i + j) % L for j in range(3)] for i in range(L)]))
+init_fun = normal(0.3, dtype=dtype)
+x = jnp.asarray(hi.random_state(key_in, B))
+
+# Log-amplitudes obtained from a sequence of fast updates (each flipping two sites) of the cached intermediates
+# should be equal to the full evaluation of the updated configurations with the reference model
+def check_fast_updates(ma, ma_ref, variables, desc):
+    np.testing.assert_allclose(ma.apply(variables, x), ma_ref.apply(variables, x))
+    _, cache = ma.apply(variables, x, mutable="intermediates_cache", cache_intermediates=True)
+    x_updated = np.array(x)
+    for _ in tqdm(range(n_updates), desc=desc):
+        update_sites = jnp.array([rng.choice(L, 2, replace=False) for _ in range(B)])
+        x_updated[np.arange(B)[:, None], update_sites] *= -1
+        updated_occ = jnp.take_along_axis(jnp.asarray(x_updated), update_sites, axis=1)
+        log_psi_ref = ma_ref.apply(variables, jnp.asarray(x_updated))
+        log_psi = ma.apply({**variables, **cache}, updated_occ, update_sites=update_sites)
+        np.testing.assert_allclose(log_psi, log_psi_ref)
+        log_psi, cache = ma.apply({**variables, **cache}, updated_occ, update_sites=update_sites, mutable="intermediates_cache",
+                                  cache_intermediates=True)
+        np.testing.assert_allclose(log_psi, log_psi_ref)
+
+ma_ref = qGPS(hi, M, dtype=dtype, init_fun=init_fun, syms=syms)
+variables = ma_ref.init(key_ma, x)
+
+# Test #1
+# qGPS with log_site_products, also with some exactly vanishing parameters
+ma = qGPS(hi, M, dtype=dtype, init_fun=init_fun, syms=syms, log_site_products=True)
+check_fast_updates(ma, ma_ref, variables, "Test #1")
+epsilon = variables["params"]["epsilon"].at[0, 1:, :2].set(0.)
+variables_zeros = {**variables, "params": {**variables["params"], "epsilon": epsilon}}
+check_fast_updates(ma, ma_ref, variables_zeros, "Test #1")
+
+# Test #2
+# qGPS and PlaquetteqGPS with ratio tables
+ma = qGPS(hi, M, dtype=dtype, init_fun=init_fun, syms=syms, ratio_tables=True)
+check_fast_updates(ma, ma_ref, variables, "Test #2")
+ma_plaquette_ref = PlaquetteqGPS(hi, M, plaquettes, dtype=dtype, init_fun=init_fun, syms=syms, apply_fast_update=True)
+variables_plaquette = ma_plaquette_ref.init(key_ma, x)
+ma = PlaquetteqGPS(hi, M, plaquettes, dtype=dtype, init_fun=init_fun, syms=syms, apply_fast_update=True, ratio_tables=True)
+check_fast_updates(ma, ma_plaquette_ref, variables_plaquette, "Test #2")
+
+# Test #3
+# qGPS (also with log_site_products and ratio tables) and PlaquetteqGPS evaluated in chunks of symmetry operations
+for symmetry_chunk_size in [3, 5]:
+    for kwargs in [{}, {"log_site_products": True}, {"ratio_tables": True}]:
+        ma = qGPS(hi, M, dtype=dtype, init_fun=init_fun, syms=syms, symmetry_chunk_size=symmetry_chunk_size, **kwargs)
+        check_fast_updates(ma, ma_ref, variables, "Test #3")
+    ma = PlaquetteqGPS(hi, M, plaquettes, dtype=dtype, init_fun=init_fun, syms=syms, apply_fast_update=True,
+                       symmetry_chunk_size=symmetry_chunk_size)
+    check_fast_updates(ma, ma_plaquette_ref, variables_plaquette, "Test #3")
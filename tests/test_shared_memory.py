@@ -0,0 +1,54 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import netket as nk
+from mpi4py import MPI
+from tqdm import tqdm
+from GPSKet.models import qGPS
+from GPSKet.nn.initializers import normal
+from GPSKet.hilbert import FermionicDiscreteHilbert
+from GPSKet.sampler import MetropolisHopping
+from GPSKet.operator.hamiltonian import AbInitioHamiltonianOnTheFly, AbInitioHamiltonianSparse
+from GPSKet.operator.hamiltonian.shared_memory import move_attributes_to_shared_memory, free_shared_memory
+
+
+key_in, key_ma = jax.random.split(jax.random.PRNGKey(np.random.randint(0, 100)))
+rng = np.random.default_rng(np.random.randint(0, 100))
+B = 8
+L = 6
+n_elec = [2, 2]
+dtype = jnp.complex128
+
+# Random integrals with the (8-fold) permutation symmetries of real orbitals
+h1 = rng.normal(size=(L, L))
+h1 = 0.5 * (h1 + h1.T)
+factors = rng.normal(size=(3, L, L))
+factors = 0.5 * (factors + np.swapaxes(factors, 1, 2))
+h2 = np.einsum("Ppq,Prs->pqrs", factors, factors)
+
+hi = FermionicDiscreteHilbert(L, n_elec=n_elec)
+ma = qGPS(hi, 2, dtype=dtype, init_fun=normal(0.5, dtype=dtype))
+x = jnp.asarray(hi.random_state(key_in, B), jnp.uint8)
+variables = ma.init(key_ma, x)
+vs = nk.vqs.MCState(MetropolisHopping(hi), ma, n_samples=B, variables=variables)
+
+def local_energies(ha):
+    _, args = nk.vqs.get_local_kernel_arguments(vs, ha)
+    return nk.vqs.get_local_kernel(vs, ha)(ma.apply, variables, x, args)
+
+# Test #1
+# Hamiltonians with the arrays in shared memory windows (of the node communicator) should give the same
+# local energies and matrix elements, the arrays are passed to the kernel without a copy
+for ha_type, kwargs in tqdm([(AbInitioHamiltonianOnTheFly, {}), (AbInitioHamiltonianOnTheFly, {"use_packed_eri": True}),
+                             (AbInitioHamiltonianSparse, {})], desc="Test #1"):
+    ha_ref = ha_type(hi, h1, h2, **kwargs)
+    ha = ha_type(hi, h1, h2, **kwargs)
+    move_attributes_to_shared_memory(ha, comm=MPI.COMM_WORLD)
+    assert(len(ha._shared_memory_windows) > 0 and not ha.t_mat.flags.writeable)
+    np.testing.assert_allclose(local_energies(ha), local_energies(ha_ref))
+    np.testing.assert_allclose(ha.to_dense(), ha_ref.to_dense())
+    _, args = nk.vqs.get_local_kernel_arguments(vs, ha)
+    assert(args[-1].unsafe_buffer_pointer() == ha.eri_k.ctypes.data or ha_type is AbInitioHamiltonianSparse)
+    del args
+    free_shared_memory(ha)
+    assert(len(ha._shared_memory_windows) == 0)
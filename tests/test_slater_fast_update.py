@@ -0,0 +1,48 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+from tqdm import tqdm
+from GPSKet.models import Slater
+from GPSKet.hilbert import FermionicDiscreteHilbert
+
+
+key_in, key_ma = jax.random.split(jax.random.PRNGKey(np.random.randint(0, 100)))
+rng = np.random.default_rng(np.random.randint(0, 100))
+B = 8
+L = 8
+n_updates = 4
+dtype = jnp.complex128
+
+# Test #1
+# For a fixed magnetization (and without S^2 projection), the determinants and the cached inverses are
+# split into the up and down spin sectors. The log-amplitudes obtained from a sequence of fast updates
+# (each applying a random hop of one electron) should be equal to the full evaluation of the updated configurations
+for n_elec in [[4, 4], [5, 3]]:
+    hi = FermionicDiscreteHilbert(L, n_elec=n_elec)
+    x = jnp.asarray(hi.random_state(key_in, B), jnp.uint8)
+    for kwargs in tqdm([{}, {"constant_time_updates": False}, {"n_determinants": 3}, {"fixed_magnetization": False}],
+                       desc="Test #1"):
+        ma = Slater(hi, dtype=dtype, **kwargs)
+        variables = ma.init(key_ma, x)
+        _, cache = ma.apply(variables, x, mutable="intermediates_cache", cache_intermediates=True)
+        spin_split = kwargs.get("fixed_magnetization", True)
+        assert(isinstance(cache["intermediates_cache"]["inverted_submats"], tuple) == spin_split)
+        x_updated = np.array(x)
+        for _ in range(n_updates):
+            update_sites = []
+            for b in range(B):
+                spin = rng.choice([1, 2])
+                i = rng.choice(np.nonzero(x_updated[b] & spin)[0])
+                a = rng.choice(np.nonzero(~x_updated[b] & spin)[0])
+                x_updated[b, i] -= spin
+                x_updated[b, a] += spin
+                update_sites.append([i, a])
+            update_sites = jnp.array(update_sites)
+            updated_occ = jnp.take_along_axis(jnp.asarray(x_updated), update_sites, axis=1)
+            log_psi_ref = ma.apply(variables, jnp.asarray(x_updated))
+            log_psi = ma.apply({**variables, **cache}, updated_occ, update_sites=update_sites)
+            # The log-amplitudes can differ by multiples of 2*pi*i
+            np.testing.assert_allclose(np.exp(log_psi - log_psi_ref), 1.)
+            log_psi, cache = ma.apply({**variables, **cache}, updated_occ, update_sites=update_sites, mutable="intermediates_cache",
+                                      cache_intermediates=True)
+            np.testing.assert_allclose(np.exp(log_psi - log_psi_ref), 1.)